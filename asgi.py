@@ -0,0 +1,156 @@
+import io
+import sys
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.logger import get_logger
+from website import create_app
+from utils.config import Config
+from utils.model_manager import model_manager
+
+logger = get_logger('asgi')
+
+class FlaskASGI:
+    '''
+    ASGI adapter for the Flask app, used by the production server (serve.py).
+        - Requests run in a thread pool, like a threaded WSGI server, but inference requests (Config.ASGI_INFERENCE_ROUTES)
+          get their own pool, so long generations never take the threads that serve auth checks, session listing or /models.
+        - Response chunks are sent as soon as Flask yields them, so /answer/stream keeps streaming tokens.
+    '''
+
+    def __init__(self, wsgi_app=None, threads:int=None, inference_threads:int=None, inference_routes:list=None):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads or Config.ASGI_THREADS,
+            thread_name_prefix='asgi-request'
+            )
+        self.inference_executor = ThreadPoolExecutor(
+            max_workers=inference_threads or Config.ASGI_INFERENCE_THREADS,
+            thread_name_prefix='asgi-inference'
+            )
+        self.inference_routes = set(
+            (method, path) for method, path in (inference_routes or Config.ASGI_INFERENCE_ROUTES)
+            )
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Load and warm up the models before the first request
+                if Config.MODEL_PRELOAD_ON_START:
+                    threading.Thread(target=model_manager.preload, daemon=True).start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                self.inference_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def environ(self, scope:dict=None, body:bytes=None):
+        '''
+        Method to build the WSGI environ of an ASGI http scope.
+        '''
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'CONTENT_LENGTH':
+                environ['CONTENT_LENGTH'] = value
+            else:
+                key = f'HTTP_{name}'
+                environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    async def http(self, scope, receive, send):
+        body = b''
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        environ = self.environ(scope, body)
+        inference = (scope['method'], scope['path']) in self.inference_routes
+        executor = self.inference_executor if inference else self.executor
+
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue()
+
+        def put(*message):
+            loop.call_soon_threadsafe(messages.put_nowait, message)
+
+        def start_response(status, headers, exc_info=None):
+            put('start', int(status.split(' ', 1)[0]), [
+                (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers
+            ])
+
+        def run():
+            try:
+                result = self.wsgi_app(environ, start_response)
+                try:
+                    for chunk in result:
+                        if chunk:
+                            put('body', chunk)
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+            except Exception as e:
+                put('error', e)
+            finally:
+                put('end')
+
+        loop.run_in_executor(executor, run)
+
+        started = False
+        while True:
+            message = await messages.get()
+            if message[0] == 'start':
+                status, headers = message[1], message[2]
+            elif message[0] == 'body':
+                if not started:
+                    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+                    started = True
+                await send({'type': 'http.response.body', 'body': message[1], 'more_body': True})
+            elif message[0] == 'error':
+                logger.error('Error serving %s %s', scope["method"], scope["path"], exc_info=message[1])
+                if not started:
+                    status, headers = 500, [(b'content-type', b'application/json')]
+                    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+                    await send({'type': 'http.response.body', 'body': b'{"message": "Internal Server Error"}'})
+                    return
+            elif message[0] == 'end':
+                if not started:
+                    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+                return
+
+app = FlaskASGI(create_app(Config))
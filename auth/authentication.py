@@ -1,9 +1,136 @@
 from functools import wraps
 from flask import request
+import fcntl
+import hashlib
+import hmac
 import json
+import os
 import secrets
 import string
-from colorama import Fore as c
+import threading
+from utils.logger import get_logger
+from utils.metrics import timed, AUTH_REQUESTS
+
+logger = get_logger('auth')
+
+API_KEYS_PATH = 'data/api_keys.json'
+
+def hash_api_key(api_key:str):
+    '''
+    Method to hash an API key. Where:
+        - api_key: plain API key
+    '''
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+class APIKeyStore:
+    '''
+    Process-wide index of the API keys in api_keys.json.
+        - Keys are kept hashed in a dict (hash -> key number), so a lookup is O(1).
+        - The file is re-read only when its mtime, inode or size changes, or after generate_api_key writes it.
+    '''
+
+    def __init__(self, path:str=API_KEYS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = None
+        self._keys = {}
+        self._master = None
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def _file_signature(self):
+        stat = os.stat(self.path)
+        return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+    def _reload(self, signature):
+        with open(self.path, 'r') as f:
+            api_keys = json.load(f)
+
+        self._keys = {hash_api_key(value): key for key, value in api_keys.items() if value}
+        self._master = hash_api_key(api_keys['0']) if api_keys.get('0') else None
+        self._signature = signature
+        self.reloads += 1
+
+    def _refresh(self):
+        signature = self._file_signature()
+        if signature != self._signature:
+            with self._lock:
+                if signature != self._signature:
+                    self._reload(signature)
+
+    def invalidate(self):
+        '''
+        Method to force a reload on the next lookup.
+        '''
+        with self._lock:
+            self._signature = None
+
+    def _count(self, valid:bool=False):
+        # Requests are checked concurrently, the counters are updated under the lock
+        with self._lock:
+            if valid:
+                self.hits += 1
+            else:
+                self.misses += 1
+        AUTH_REQUESTS.inc(result='valid' if valid else 'invalid')
+
+    def is_valid(self, api_key:str=None):
+        '''
+        Method to check if an API key exists. Where:
+            - api_key: plain API key from the request header
+        '''
+        if not api_key:
+            self._count(False)
+            return False
+
+        self._refresh()
+        if hash_api_key(api_key) in self._keys:
+            self._count(True)
+            return True
+
+        self._count(False)
+        return False
+
+    def is_master(self, api_key:str=None):
+        '''
+        Method to check if an API key is the master key. Where:
+            - api_key: plain API key from the request header
+        '''
+        if not api_key:
+            self._count(False)
+            return False
+
+        self._refresh()
+        master = self._master
+        if master and hmac.compare_digest(hash_api_key(api_key), master):
+            self._count(True)
+            return True
+
+        self._count(False)
+        return False
+
+    def key_id(self, api_key:str=None):
+        '''
+        Method to get the key number of an API key, or None if it does not exist.
+        '''
+        if not api_key:
+            return None
+        self._refresh()
+        return self._keys.get(hash_api_key(api_key))
+
+    def stats(self):
+        '''
+        Method to get the counters of the store.
+        '''
+        return {
+            "keys": len(self._keys),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads
+        }
+
+key_store = APIKeyStore()
 
 def require_api_key(view_func):
     '''
@@ -13,10 +140,10 @@ def require_api_key(view_func):
     def decorated_view(*args, **kwargs):
         api_key = request.headers.get("Authorization")
 
-        with open('data/api_keys.json', 'r') as f:
-            api_keys = json.load(f)
+        with timed('auth'):
+            valid = key_store.is_valid(api_key)
 
-        if api_key and api_key in api_keys.values():
+        if valid:
             return view_func(*args, **kwargs)
         else:
             return {"message": "Unauthorized"}, 401
@@ -32,10 +159,10 @@ def require_master_key(view_func):
     def decorated_view(*args, **kwargs):
         master_key = request.headers.get("Authorization")
 
-        with open('data/api_keys.json', 'r') as f:
-            api_keys = json.load(f)
+        with timed('auth'):
+            valid = key_store.is_master(master_key)
 
-        if master_key and master_key == api_keys.get('0'):
+        if valid:
             return view_func(*args, **kwargs)
         else:
             return {"message": "Unauthorized"}, 401
@@ -50,21 +177,29 @@ def generate_api_key():
     alphabet = string.ascii_letters + string.digits
     api_key = ''.join(secrets.choice(alphabet) for i in range(20))
 
-    with open('data/api_keys.json', 'r') as f:
-        api_keys = json.load(f)
+    # The lock file serializes writers of every process, and os.replace makes readers see the old or the new file, never a partial one
+    with open(API_KEYS_PATH + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        with open(API_KEYS_PATH, 'r') as f:
+            api_keys = json.load(f)
+
+        # Get the las key value and increment it by 1
+        if len(api_keys) == 0:
+            api_key_number = 0
+        else:
+            api_key_number = list(api_keys.keys())[-1]
+            api_key_number = int(api_key_number) + 1
+            api_key_number = str(api_key_number)
+
+        api_keys[api_key_number] = api_key
 
-    # Get the las key value and increment it by 1
-    if len(api_keys) == 0:
-        api_key_number = 0
-    else:
-        api_key_number = list(api_keys.keys())[-1]
-        api_key_number = int(api_key_number) + 1
-        api_key_number = str(api_key_number)
-        print(f'\n[ {c.BLUE}KEY{c.RESET} ] {api_key_number}\n')
+        with open(API_KEYS_PATH + '.tmp', 'w') as f:
+            json.dump(api_keys, f, indent=4)
+        os.replace(API_KEYS_PATH + '.tmp', API_KEYS_PATH)
 
-    api_keys[api_key_number] = api_key
+    logger.info('API key %s generated', api_key_number)
 
-    with open('data/api_keys.json', 'w') as f:
-        json.dump(api_keys, f, indent=4)
+    key_store.invalidate()
 
     return api_key
\ No newline at end of file
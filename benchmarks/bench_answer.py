@@ -0,0 +1,261 @@
+'''
+Benchmark of the full POST /answer path with a fake LLM, to measure the overhead of the server itself.
+
+    python -m benchmarks.bench_answer --requests 200 --concurrency 8 --sessions 1 10 100 --history 0 50 500
+
+It runs in a temporary copy of the data folder, so it does not need model files and does not touch data/.
+'''
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_KEY = 'benchmark-master-key'
+
+def prepare_environment(response_cache:bool=False):
+    '''
+    Method to create a temporary data folder, point the server at it and disable what needs a real model.
+    '''
+    workdir = tempfile.mkdtemp(prefix='llm-api-bench-')
+    os.makedirs(os.path.join(workdir, 'data'))
+    os.makedirs(os.path.join(workdir, 'models'))
+    shutil.copy(os.path.join(ROOT, 'data', 'config.json'), os.path.join(workdir, 'data', 'config.json'))
+    with open(os.path.join(workdir, 'data', 'api_keys.json'), 'w') as f:
+        json.dump({"0": API_KEY}, f)
+    with open(os.path.join(workdir, 'data', 'sessions.json'), 'w') as f:
+        json.dump({}, f)
+
+    os.environ.setdefault('PROMPT_CACHE', 'false')
+    os.environ.setdefault('MODEL_WARMUP_TOKENS', '0')
+    os.environ.setdefault('MODEL_PRELOAD_ON_START', 'false')
+    os.environ.setdefault('RESPONSE_CACHE', 'true' if response_cache else 'false')
+    os.environ.setdefault('SCHEDULER_MAX_QUEUE', '100000')
+    os.environ.setdefault('SCHEDULER_MAX_PER_KEY', '0')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    return workdir
+
+class StageTimer:
+    '''
+    Accumulates the time spent in each stage of a request, from wrapped functions.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = {}
+        self.counts = {}
+
+    def add(self, stage:str=None, duration:float=0.0):
+        with self._lock:
+            self.totals[stage] = self.totals.get(stage, 0.0) + duration
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def wrap(self, stage:str=None, fn=None):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+    def reset(self):
+        with self._lock:
+            self.totals = {}
+            self.counts = {}
+
+def instrument(timer:StageTimer=None, llm=None):
+    '''
+    Method to wrap the stages of the answer path with the timer.
+    '''
+    import auth.authentication as authentication
+    import utils.generation as generation
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    key_store = authentication.key_store
+    key_store.is_valid = timer.wrap('auth', key_store.is_valid)
+    generation.memory_cache.get = timer.wrap('session_load', generation.memory_cache.get)
+    generation.save_session = timer.wrap('session_save', generation.save_session)
+
+    class LLMTimer(BaseCallbackHandler):
+        def __init__(self):
+            self.starts = {}
+
+        def on_llm_start(self, serialized, prompts, run_id=None, **kwargs):
+            self.starts[run_id] = time.perf_counter()
+
+        def on_llm_end(self, response, run_id=None, **kwargs):
+            start = self.starts.pop(run_id, None)
+            if start is not None:
+                timer.add('llm', time.perf_counter() - start)
+
+    llm.callbacks = [LLMTimer()]
+
+def percentile(values:list=None, p:float=None):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[index]
+
+def seed_sessions(store=None, first_id:int=0, sessions:int=1, history:int=0):
+    '''
+    Method to write history turns in every session of a scenario.
+    '''
+    for session_id in range(first_id, first_id + sessions):
+        for turn in range(history):
+            store.append_turn(
+                session_id=session_id,
+                question=f'Question {turn} of session {session_id}. ' * 4,
+                answer=f'Answer {turn} of session {session_id}. ' * 16,
+                name=f'Session {session_id}'
+            )
+
+def run_scenario(app=None, timer:StageTimer=None, first_id:int=0, sessions:int=1, requests:int=100, concurrency:int=4):
+    '''
+    Method to send requests to POST /answer from concurrency threads, spread randomly over the sessions.
+    '''
+    from utils.memory_cache import memory_cache
+    from utils.scheduler import scheduler
+
+    # Every scenario starts with a cold memory cache
+    with memory_cache._lock:
+        memory_cache._entries.clear()
+    timer.reset()
+
+    rng = random.Random(first_id)
+    session_ids = [first_id + rng.randrange(sessions) for i in range(requests)]
+    latencies = []
+    errors = []
+    local = threading.local()
+
+    def send(session_id):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        start = time.perf_counter()
+        response = client.post(
+            '/answer/',
+            json={"prompt": f"Benchmark prompt for session {session_id}", "session_id": session_id},
+            headers={"Authorization": API_KEY}
+        )
+        latency = time.perf_counter() - start
+        if response.status_code == 200:
+            latencies.append(latency)
+        else:
+            errors.append(response.status_code)
+
+    wait_before = scheduler.total_wait_time
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(send, session_ids))
+    elapsed = time.perf_counter() - start
+
+    stages = {stage: timer.totals[stage] / max(len(latencies), 1) for stage in timer.totals}
+    total = sum(latencies) / max(len(latencies), 1)
+    stages['queue_wait'] = (scheduler.total_wait_time - wait_before) / max(len(latencies), 1)
+    stages['server_overhead'] = max(total - stages['llm'] - stages['queue_wait'], 0.0) if 'llm' in stages else 0.0
+
+    return {
+        "sessions": sessions,
+        "requests": requests,
+        "errors": len(errors),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "mean": total,
+        "stages": stages
+    }
+
+def print_report(results:list=None):
+    stages = ['auth', 'queue_wait', 'session_load', 'llm', 'session_save', 'server_overhead']
+    header = f'{"sessions":>8} {"history":>8} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} ' + ' '.join(f'{s:>15}' for s in stages)
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        line = f'{r["sessions"]:>8} {r["history"]:>8} {r["throughput"]:>8.1f} {r["p50"] * 1000:>8.1f} {r["p95"] * 1000:>8.1f} {r["p99"] * 1000:>8.1f} '
+        line += ' '.join(f'{r["stages"].get(s, 0.0) * 1000:>12.2f} ms' for s in stages)
+        if r["errors"]:
+            line += f'  ({r["errors"]} errors)'
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of POST /answer with a fake LLM')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 10, 100], help='number of sessions of each scenario')
+    parser.add_argument('--history', type=int, nargs='+', default=[0, 50, 500], help='stored turns per session of each scenario')
+    parser.add_argument('--tokens', type=int, default=32, help='tokens generated per answer')
+    parser.add_argument('--token-latency', type=float, default=0.001, help='seconds per generated token')
+    parser.add_argument('--prefill-latency', type=float, default=0.0, help='seconds per prompt token')
+    parser.add_argument('--response-cache', action='store_true', help='keep the response cache on')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = prepare_environment(response_cache=args.response_cache)
+
+    from benchmarks.fake_llm import FakeLlamaCpp
+    import utils.model_manager as model_manager
+    from utils.session_store import get_session_store
+    from utils.config import Config
+    from website import create_app
+
+    llm = FakeLlamaCpp(token_latency=args.token_latency, prefill_latency=args.prefill_latency, n_tokens=args.tokens)
+
+    def load_model(model_config_name:str=None):
+        config = model_manager.read_config()
+        return llm, config[model_config_name or config['SelectedModel']]['template']
+
+    model_manager.load_model = load_model
+
+    timer = StageTimer()
+    instrument(timer=timer, llm=llm)
+
+    app = create_app(Config)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        store = get_session_store()
+
+    results = []
+    first_id = 0
+    try:
+        for history in args.history:
+            for sessions in args.sessions:
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    seed_sessions(store=store, first_id=first_id, sessions=sessions, history=history)
+                result = run_scenario(
+                    app=app,
+                    timer=timer,
+                    first_id=first_id,
+                    sessions=sessions,
+                    requests=args.requests,
+                    concurrency=args.concurrency
+                )
+                result["history"] = history
+                results.append(result)
+                first_id += sessions
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(results)
+
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == '__main__':
+    main()
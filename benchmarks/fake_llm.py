@@ -0,0 +1,44 @@
+import time
+import hashlib
+from typing import Any, List, Optional
+from langchain.llms.base import LLM
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+
+class FakeLlamaCpp(LLM):
+    '''
+    Deterministic stand-in for LlamaCpp, to measure the server without model files.
+        - Sleeps prefill_latency seconds per prompt token (4 characters), then token_latency seconds per generated token.
+        - The answer only depends on the prompt, and every token is sent to the callbacks like LlamaCpp does when streaming.
+    '''
+
+    token_latency: float = 0.01
+    prefill_latency: float = 0.0
+    n_tokens: int = 32
+    streaming: bool = True
+
+    @property
+    def _llm_type(self):
+        return "fake-llamacpp"
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text) // 4 + 1
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        time.sleep(self.prefill_latency * len(prompt) / 4)
+
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        tokens = []
+        for i in range(self.n_tokens):
+            time.sleep(self.token_latency)
+            token = f" {digest[(2 * i) % len(digest):(2 * i) % len(digest) + 2]}"
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+            tokens.append(token)
+
+        return ''.join(tokens)
@@ -0,0 +1,2 @@
+from client.client import LLMClient, TokenStream, LatencyStats, APIError
+from client.async_client import AsyncLLMClient
@@ -0,0 +1,124 @@
+import asyncio
+import threading
+from client.client import LLMClient, DEFAULT_URL
+
+_END = object()
+
+class AsyncLLMClient:
+    '''
+    asyncio client of the LLM Local API Server, with the same methods as LLMClient as coroutines.
+        - Requests run on threads of the event loop executor over the pooled session of an LLMClient, so it needs no
+          other HTTP library. At most max_concurrency requests are in flight, the size of the connection pool.
+        - stream returns an async iterator over the tokens.
+    '''
+
+    def __init__(self, url:str=DEFAULT_URL, api_key:str=None, timeout:tuple=(5, 600), retries:int=3, backoff:float=0.5, max_concurrency:int=10):
+        self.client = LLMClient(url=url, api_key=api_key, timeout=timeout, retries=retries, backoff=backoff, pool_size=max_concurrency)
+        self.stats = self.client.stats
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _call(self, fn, *args, **kwargs):
+        async with self._semaphore:
+            return await asyncio.to_thread(fn, *args, **kwargs)
+
+    async def answer(self, prompt:str=None, session_id:int=None, model_config:str=None, priority:int=None, cache:bool=True):
+        return await self._call(self.client.answer, prompt, session_id, model_config, priority, cache)
+
+    async def answers(self, prompts:list=None, **kwargs):
+        '''
+        Method to get the answers of several prompts with concurrent requests, in the order of the prompts.
+        '''
+        return await asyncio.gather(*(self.answer(prompt, **kwargs) for prompt in prompts))
+
+    async def batch(self, items:list=None, priority:int=None, cache:bool=True):
+        return await self._call(self.client.batch, items, priority, cache)
+
+    async def stream(self, prompt:str=None, session_id:int=None, model_config:str=None, priority:int=None, cache:bool=True):
+        '''
+        Method to get the tokens of an answer as they are generated:
+            async for token in client.stream("Hello"):
+                print(token, end="", flush=True)
+        '''
+        loop = asyncio.get_running_loop()
+        tokens = asyncio.Queue()
+        stop = threading.Event()
+        opened = []
+
+        def produce():
+            try:
+                stream = self.client.stream(prompt, session_id, model_config, priority, cache)
+                opened.append(stream)
+                with stream:
+                    if stop.is_set():
+                        return
+                    for token in stream:
+                        if stop.is_set():
+                            break
+                        loop.call_soon_threadsafe(tokens.put_nowait, token)
+            except BaseException as e:
+                loop.call_soon_threadsafe(tokens.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(tokens.put_nowait, _END)
+
+        async with self._semaphore:
+            loop.run_in_executor(None, produce)
+            try:
+                while True:
+                    token = await tokens.get()
+                    if token is _END:
+                        break
+                    if isinstance(token, BaseException):
+                        raise token
+                    yield token
+            finally:
+                # The producer may be blocked reading the next token: closing the response ends it, without waiting
+                # for the rest of the answer
+                stop.set()
+                for stream in opened:
+                    stream.close()
+
+    async def submit_job(self, prompt:str=None, session_id:int=None, model_config:str=None, priority:int=None, cache:bool=True):
+        return await self._call(self.client.submit_job, prompt, session_id, model_config, priority, cache)
+
+    async def job(self, job_id:str=None):
+        return await self._call(self.client.job, job_id)
+
+    async def cancel_job(self, job_id:str=None):
+        return await self._call(self.client.cancel_job, job_id)
+
+    async def wait_job(self, job_id:str=None, poll:float=0.5, timeout:float=None):
+        '''
+        Method to poll a job until it is done, failed or cancelled, without blocking the event loop.
+        '''
+        async def poll_job():
+            while True:
+                job = await self.job(job_id)
+                if job["status"] in ("done", "failed", "cancelled"):
+                    return job
+                await asyncio.sleep(poll)
+
+        return await asyncio.wait_for(poll_job(), timeout)
+
+    async def sessions(self, limit:int=None, cursor:str=None, sort:str=None, prefix:str=None):
+        return await self._call(self.client.sessions, limit, cursor, sort, prefix)
+
+    async def models(self):
+        return await self._call(self.client.models)
+
+    async def set_model(self, model:str=None, model_config:str=None):
+        return await self._call(self.client.set_model, model, model_config)
+
+    async def check_auth(self):
+        return await self._call(self.client.check_auth)
+
+    async def queue(self):
+        return await self._call(self.client.queue)
+
+    async def close(self):
+        self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
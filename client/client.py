@@ -0,0 +1,357 @@
+import json
+import time
+import threading
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_URL = 'http://127.0.0.1:5000'
+
+class APIError(Exception):
+    '''
+    Error answered by the LLM Local API Server. status is the HTTP status, 0 for an error event of a stream.
+    '''
+
+    def __init__(self, status:int=None, message:str=None, body=None):
+        super().__init__(f'{status}: {message}')
+        self.status = status
+        self.message = message
+        self.body = body
+
+class LatencyStats:
+    '''
+    Client-side latency of the requests, by endpoint: count, errors, average, percentiles and max in seconds.
+        - The last window requests of each endpoint are kept for the percentiles.
+        - Streams also record their time to first token.
+    '''
+
+    def __init__(self, window:int=1000):
+        self.window = window
+        self._samples = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint:str=None, seconds:float=None, error:bool=False, metric:str='latency'):
+        key = (endpoint, metric)
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+                self._counts[key] = [0, 0]
+            samples.append(seconds)
+            self._counts[key][0] += 1
+            if error:
+                self._counts[key][1] += 1
+
+    def summary(self):
+        with self._lock:
+            items = [(key, sorted(samples), list(self._counts[key])) for key, samples in self._samples.items()]
+
+        summary = {}
+        for (endpoint, metric), samples, (count, errors) in items:
+            def percentile(p):
+                return samples[min(len(samples) - 1, int(p * len(samples)))]
+            entry = {
+                "count": count,
+                "avg": sum(samples) / len(samples),
+                "p50": percentile(0.50),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": samples[-1]
+            }
+            if metric == 'latency':
+                entry["errors"] = errors
+            summary.setdefault(endpoint, {})[metric] = entry
+        return summary
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+
+class TokenStream:
+    '''
+    Iterator over the tokens of a streamed answer (POST /answer/stream). After the last token, result has the whole
+    answer and done the final event (cached, time to first token, tokens per second).
+    '''
+
+    def __init__(self, response:requests.Response=None, stats:LatencyStats=None, endpoint:str=None, start:float=None):
+        self.response = response
+        self.stats = stats
+        self.endpoint = endpoint
+        self.start = start
+        self.result = None
+        self.done = None
+        self.time_to_first_token = None
+
+    def _events(self):
+        event, data = None, []
+        for line in self.response.iter_lines(decode_unicode=True):
+            if line.startswith('event:'):
+                event = line[len('event:'):].strip()
+            elif line.startswith('data:'):
+                data.append(line[len('data:'):].strip())
+            elif not line and event is not None:
+                yield event, json.loads('\n'.join(data)) if data else {}
+                event, data = None, []
+
+    def __iter__(self):
+        error = False
+        try:
+            for event, data in self._events():
+                if event == 'token':
+                    if self.time_to_first_token is None:
+                        self.time_to_first_token = time.perf_counter() - self.start
+                        self.stats.record(self.endpoint, self.time_to_first_token, metric='time_to_first_token')
+                    yield data["token"]
+                elif event == 'done':
+                    self.done = data
+                    self.result = data.get("result")
+                elif event == 'error':
+                    error = True
+                    raise APIError(0, data.get("message"), data)
+        finally:
+            self.stats.record(self.endpoint, time.perf_counter() - self.start, error=error)
+            self.response.close()
+
+    def text(self):
+        '''
+        Method to consume the stream and get the whole answer.
+        '''
+        for _ in self:
+            pass
+        return self.result
+
+    def close(self):
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class _Retry(Retry):
+    '''
+    Retry policy of LLMClient. The server answers 429 and 503 before it generates anything, so they are retried for
+    every method. A 502 or 504 can come from a proxy after the server generated the answer, so they are only retried
+    for idempotent methods.
+    '''
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code in (502, 504) and method.upper() not in Retry.DEFAULT_ALLOWED_METHODS:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+class LLMClient:
+    '''
+    Client of the LLM Local API Server.
+        - Requests go through one requests.Session with a pool of keep-alive connections (pool_size per host).
+        - Connection errors and 429/503 answers are retried up to retries times, with exponential backoff
+          (backoff, 2 * backoff, 4 * backoff... seconds, or the Retry-After of the server). 502/504 answers are only
+          retried for GET, DELETE and the other idempotent methods, so a POST is never generated twice. Read errors
+          are not retried.
+        - timeout is (connect, read) seconds. The read timeout is the longest wait between two bytes, so a stream
+          only needs it to cover the queue wait and the time to first token.
+        - Every request is timed in stats (see LatencyStats).
+    '''
+
+    def __init__(self, url:str=DEFAULT_URL, api_key:str=None, timeout:tuple=(5, 600), retries:int=3, backoff:float=0.5, pool_size:int=10):
+        self.url = url.rstrip('/')
+        self.api_key = api_key
+        self.timeout = timeout
+        self.stats = LatencyStats()
+
+        retry = _Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 502, 503, 504),
+            allowed_methods=None,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if api_key:
+            self.session.headers["Authorization"] = api_key
+
+    def _request(self, method:str=None, path:str=None, stream:bool=False, endpoint:str=None, headers:dict=None, **kwargs):
+        endpoint = endpoint or f'{method} {path}'
+        start = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, self.url + path, timeout=self.timeout, stream=stream, headers=headers, **kwargs
+            )
+        except requests.RequestException:
+            self.stats.record(endpoint, time.perf_counter() - start, error=True)
+            raise
+
+        if response.status_code >= 400:
+            self.stats.record(endpoint, time.perf_counter() - start, error=True)
+            try:
+                body = response.json()
+                message = body.get("message", response.text) if isinstance(body, dict) else response.text
+            except ValueError:
+                body, message = None, response.text
+            response.close()
+            raise APIError(response.status_code, message, body)
+
+        if not stream:
+            self.stats.record(endpoint, time.perf_counter() - start)
+        return response, start
+
+    def _json(self, method:str=None, path:str=None, **kwargs):
+        response, _ = self._request(method, path, **kwargs)
+        return response.json()
+
+    @staticmethod
+    def _answer_body(prompt:str=None, session_id:int=None, model_config:str=None, priority:int=None):
+        body = {"prompt": prompt, "session_id": session_id}
+        if model_config is not None:
+            body["model_config"] = model_config
+        if priority is not None:
+            body["priority"] = priority
+        return body
+
+    @staticmethod
+    def _cache_headers(cache:bool=True):
+        # Skip the response cache of the server (lookup and store)
+        return None if cache else {"Cache-Control": "no-cache, no-store"}
+
+    def answer(self, prompt:str=None, session_id:int=None, model_config:str=None, priority:int=None, cache:bool=True):
+        '''
+        Method to get the answer to a prompt. Where:
+            - session_id: session to continue (or create), None for no session
+            - model_config: profile of config.json, None for the selected one
+            - priority: queue priority from 0 to 9, lower is served first
+            - cache: False to skip the response cache of the server
+        '''
+        return self._json(
+            'POST', '/answer/', json=self._answer_body(prompt, session_id, model_config, priority),
+            headers=self._cache_headers(cache)
+        )["result"]
+
+    def stream(self, prompt:str=None, session_id:int=None, model_config:str=None, priority:int=None, cache:bool=True):
+        '''
+        Method to get the answer to a prompt as a TokenStream, an iterator over its tokens as they are generated:
+            for token in client.stream("Hello"):
+                print(token, end="", flush=True)
+        '''
+        response, start = self._request(
+            'POST', '/answer/stream', stream=True, json=self._answer_body(prompt, session_id, model_config, priority),
+            headers=self._cache_headers(cache)
+        )
+        return TokenStream(response=response, stats=self.stats, endpoint='POST /answer/stream', start=start)
+
+    def batch(self, items:list=None, priority:int=None, cache:bool=True):
+        '''
+        Method to get the answers of several prompts in one request. Returns the results in the order of the items,
+        each one a dict with "result" (or "error"), "status" and its timings. Where:
+            - items: prompts, or dicts with "prompt" and optionally "session_id" and "model_config"
+        '''
+        body = {"items": [{"prompt": item} if isinstance(item, str) else item for item in items]}
+        if priority is not None:
+            body["priority"] = priority
+        return self._json('POST', '/answer/batch', json=body, headers=self._cache_headers(cache))["results"]
+
+    def stream_batch(self, items:list=None, priority:int=None, cache:bool=True):
+        '''
+        Method to get the answers of several prompts in one request as they complete (in any order), an iterator of
+        dicts with the "index" of their item.
+        '''
+        body = {"items": [{"prompt": item} if isinstance(item, str) else item for item in items], "stream": True}
+        if priority is not None:
+            body["priority"] = priority
+        response, start = self._request(
+            'POST', '/answer/batch', stream=True, json=body, headers=self._cache_headers(cache)
+        )
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if line:
+                    yield json.loads(line)
+        finally:
+            self.stats.record('POST /answer/batch (stream)', time.perf_counter() - start)
+            response.close()
+
+    def submit_job(self, prompt:str=None, session_id:int=None, model_config:str=None, priority:int=None, cache:bool=True):
+        '''
+        Method to queue a generation in the background. Returns the job, with its "job_id".
+        '''
+        return self._json(
+            'POST', '/answer/jobs', json=self._answer_body(prompt, session_id, model_config, priority),
+            headers=self._cache_headers(cache)
+        )
+
+    def job(self, job_id:str=None):
+        return self._json('GET', f'/answer/jobs/{job_id}', endpoint='GET /answer/jobs/<job_id>')
+
+    def cancel_job(self, job_id:str=None):
+        return self._json('DELETE', f'/answer/jobs/{job_id}', endpoint='DELETE /answer/jobs/<job_id>')
+
+    def wait_job(self, job_id:str=None, poll:float=0.5, timeout:float=None):
+        '''
+        Method to poll a job until it is done, failed or cancelled, and get it. Raises TimeoutError after timeout seconds.
+        '''
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            job = self.job(job_id)
+            if job["status"] in ("done", "failed", "cancelled"):
+                return job
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f'Job {job_id} is still {job["status"]}')
+            time.sleep(poll)
+
+    def sessions(self, limit:int=None, cursor:str=None, sort:str=None, prefix:str=None):
+        '''
+        Method to get a page of the session catalog, {"sessions": [...], "next_cursor": ...}.
+        '''
+        params = {"limit": limit, "cursor": cursor, "sort": sort, "prefix": prefix}
+        return self._json('GET', '/answer/', params={key: value for key, value in params.items() if value is not None})
+
+    def iter_sessions(self, limit:int=None, sort:str=None, prefix:str=None):
+        '''
+        Method to iterate over the whole session catalog, one page at a time.
+        '''
+        cursor = None
+        while True:
+            page = self.sessions(limit=limit, cursor=cursor, sort=sort, prefix=prefix)
+            yield from page["sessions"]
+            cursor = page["next_cursor"]
+            if not cursor:
+                return
+
+    def models(self):
+        return self._json('GET', '/models/')
+
+    def set_model(self, model:str=None, model_config:str=None):
+        '''
+        Method to set the model file of a profile and select it. Returns True, or the reason it was not set.
+        '''
+        return self._json('POST', '/models/model', json={"model": model, "model_config": model_config})["model_status"]
+
+    def check_auth(self):
+        return self._json('GET', '/auth/')["auth"]
+
+    def generate_key(self):
+        '''
+        Method to generate a new API key. Requires the master key.
+        '''
+        return self._json('GET', '/auth/key')["key"]
+
+    def queue(self):
+        return self._json('GET', '/answer/queue')
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
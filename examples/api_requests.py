@@ -1,83 +1,69 @@
-import requests
-from dotenv import load_dotenv
 import os
+import sys
+from dotenv import load_dotenv
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from client import LLMClient, APIError
 
 class LLMRequests:
+    '''
+    Base class of the examples. All the requests go through one LLMClient, with a pool of keep-alive connections and
+    retries (see client/client.py).
+    '''
 
-    def __init__(self, url: str, api_key: str = None):
-        self.url = 'http://127.0.0.1:5000'
+    def __init__(self, url: str = 'http://127.0.0.1:5000', api_key: str = None, client: LLMClient = None):
+        self.url = url
         self.api_key = api_key
+        self.client = client or LLMClient(url=url, api_key=api_key)
+
+    def _run(self, method, *args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except APIError as e:
+            # Request encountered an error
+            print("Error:", e.status)
+            print("Response:", e.message)
 
 class AnswerRequest(LLMRequests):
     '''
     Class to make requests to the LLM Local API Server. This class agrupates the methods to get an answer.
     '''
 
-    def get_answer(self, endpoint="/answer", prompt: str = None, session_id: int = None):
+    def get_answer(self, prompt: str = None, session_id: int = None):
         '''
         Method to get an answer from the LLM Local API Server. Where:
             - prompt: is the question to be answered.
         '''
+        return self._run(self.client.answer, prompt=prompt, session_id=session_id)
 
-        data = {"prompt": f"{prompt}", "session_id": session_id}
-        headers = {"Authorization": self.api_key, "charset": "UTF-8", "pageEncoding": "UTF-8"}
-        url = self.url + endpoint
-
-        response = requests.post(url, json=data, headers=headers)
-
-        if response.status_code == 200:
-            # Request was successful
-            result = response.json()  # result is a dict
-            text = result['result']
-
-            return text
-        else:
-            # Request encountered an error
-            print("Error:", response.status_code)
-            print("Response:", response.text)
-
-    def get_raw_answer(self, endpoint="/answer", prompt: str = None, session_id: int = None):
+    def stream_answer(self, prompt: str = None, session_id: int = None):
         '''
-        Method to get an answer from the LLM Local API Server. Where:
+        Method to print an answer from the LLM Local API Server as it is generated, and get it. Where:
             - prompt: is the question to be answered.
         '''
-
-        data = {"prompt": f"{prompt}", "session_id": session_id}
-        headers = {"Authorization": self.api_key}
-        url = self.url + endpoint
-
-        response = requests.post(url, json=data, headers=headers)
-
-        if response.status_code == 200:
-            # Request was successful
-            result = response.json()
-
-            return result
-        else:
-            # Request encountered an error
-            print("Error:", response.status_code)
-            print("Response:", response.text)
-
-    def get_sessions(self, endpoint="/answer"):
+        try:
+            stream = self.client.stream(prompt=prompt, session_id=session_id)
+            for token in stream:
+                print(token, end="", flush=True)
+            print()
+            return stream.result
+        except APIError as e:
+            print("Error:", e.status)
+            print("Response:", e.message)
+
+    def get_answers(self, prompts: list = None):
         '''
-        Method to get the sessions from the LLM Local API Server. Where:
-            - prompt: is the question to be answered.
+        Method to get the answers of several independent prompts in one request.
         '''
+        return self._run(self.client.batch, prompts)
 
-        headers = {"Authorization": self.api_key}
-        url = self.url + endpoint
-
-        response = requests.get(url, headers=headers)
-
-        if response.status_code == 200:
-            # Request was successful
-            result = response.json()
-            return result
-        
-        else:
-            # Request encountered an error
-            print("Error:", response.status_code)
-            print("Response:", response.text)
+    def get_sessions(self, limit: int = None, sort: str = None, prefix: str = None):
+        '''
+        Method to get all the sessions from the LLM Local API Server, one page at a time. Where:
+            - sort: 'updated' (last activity first), 'created' or 'name'
+            - prefix: only the sessions whose name starts with it
+        '''
+        return self._run(lambda: list(self.client.iter_sessions(limit=limit, sort=sort, prefix=prefix)))
 
 
 class ModelRequest(LLMRequests):
@@ -85,52 +71,24 @@ class ModelRequest(LLMRequests):
     This class agrupates the methods to set and see the available models in the LLM Local API Server.
     '''
 
-    def get_models(self, endpoint="/models"):
+    def get_models(self):
         '''
         Method to get the available models in the LLM Local API Server.
         '''
+        return self._run(self.client.models)
 
-        url = self.url + endpoint
-        headers = {"Authorization": self.api_key}
-
-        response = requests.get(url, headers=headers)
-
-        if response.status_code == 200:
-            # Request was successful
-            result = response.json()
-            return result
-        else:
-            # Request encountered an error
-            print("Error:", response.status_code)
-            print("Response:", response.text)
-
-    def set_model(self, endpoint="/models/model", model: str = None, model_config: str = None):
+    def set_model(self, model: str = None, model_config: str = None):
         '''
         Method to set the model to be used in the LLM Local API Server. Where:
             - model: is the name of the model to be used.
             - model_config: is the name of the model profile to be used.
         '''
-
-        data = {"model": f"{model}", "model_config": f"{model_config}"}
-        headers = {"Authorization": self.api_key}
-        url = self.url + endpoint
-
-        response = requests.post(url, json=data, headers=headers)
-
-        if response.status_code == 200:
-            # Request was successful
-            result = response.json()
-
-            if result['model_status'] == True:
-                print(f"Model {model} set successfully")
-            else:
-                print(f"Model {model} not set")
-                print("Error:", response.status_code)
-                print("Response:", response.text)
-        else:
-            # Request encountered an error
-            print("Error:", response.status_code)
-            print("Response:", response.text)
+        status = self._run(self.client.set_model, model=model, model_config=model_config)
+        if status == True:
+            print(f"Model {model} set successfully")
+        elif status is not None:
+            print(f"Model {model} not set")
+            print("Response:", status)
 
 
 class AuthRequest(LLMRequests):
@@ -138,52 +96,30 @@ class AuthRequest(LLMRequests):
     This class agrupates the methods to check the authorization (api key) of the LLM Local API Server.
     '''
 
-    def check_auth(self, endpoint="/auth"):
+    def check_auth(self):
         '''
         Method to check the authorization (api key) of the LLM Local API Server.
         '''
-        url = self.url + endpoint
-        headers = {"Authorization": self.api_key}
+        return self._run(self.client.check_auth)
 
-        response = requests.get(url, headers=headers)
-
-        if response.status_code == 200:
-            # Request was successful
-            result = response.json()
-            return result
-        else:
-            # Request encountered an error
-            print("Error:", response.status_code)
-            print("Response:", response.text)
-
-    def gen_key(self, endpoint="/auth/key"):
+    def gen_key(self):
         '''
         Method to generate a new api key for the LLM Local API Server. Requires master key.
         '''
-
-        url = self.url + endpoint
-        headers = {"Authorization": self.api_key}  # Only with master key
-
-        response = requests.get(url, headers=headers)
-
-        if response.status_code == 200:
-            # Request was successful
-            result = response.json()
-            return result
-        else:
-            # Request encountered an error
-            print("Error:", response.status_code)
-            print("Response:", response.text)
+        return self._run(self.client.generate_key)
 
 
 if __name__ == '__main__':
 
     load_dotenv()
     API_KEY = os.getenv('API_KEY')
+    API_URL = os.getenv('API_URL', 'http://127.0.0.1:5000')
 
-    ans = AnswerRequest(API_KEY)
-    mo = ModelRequest(API_KEY)
-    au = AuthRequest(API_KEY)
+    # The three share one client, and its connections
+    client = LLMClient(url=API_URL, api_key=API_KEY)
+    ans = AnswerRequest(API_URL, API_KEY, client=client)
+    mo = ModelRequest(API_URL, API_KEY, client=client)
+    au = AuthRequest(API_URL, API_KEY, client=client)
 
     # Get answer from the model throug API
     # prompt = "Genera un diálogo corto de 6 intercambios entre 2 personajes (Cosmo, Coscu (Streamer, Latin American Spanish)), con temática relacionada a las siguientes palabras clave: Economía, Anime. El sentimiento principal del diálogo es Tristeza. El sentimiento secundario del diálogo es Desengaño. El diálogo se desarrolla en La luna. En cuanto al tiempo, el diálogo tiene lugar al/ a la Noche. El clima del diálogo es Lluvia de meteoritos. El diálogo debe estar escrita al estilo de Stephen King. El diálogo debe ser del género Terror. El argumento principal del diálogo es el siguiente: Cosmo se encuentra con el fantasma de Coscu. El objetivo del diálogo (lo que se pretende lograr con el mismo dentro de la historia) es Asustar al lector."
@@ -198,15 +134,29 @@ if __name__ == '__main__':
     # answer = ans.get_answer(prompt=prompt)
     # print(answer)
 
-    # Get raw answer from the model throug API (dict format with extra info)
+    # Get the answer with its timings (cached, time to first token, tokens per second)
     # prompt = "Genera un diálogo corto de 6 intercambios entre 2 personajes (Cosmo, Coscu (Streamer, Latin American Spanish)), con temática relacionada a las siguientes palabras clave: Economía, Anime. El sentimiento principal del diálogo es Tristeza. El sentimiento secundario del diálogo es Desengaño. El diálogo se desarrolla en La luna. En cuanto al tiempo, el diálogo tiene lugar al/ a la Noche. El clima del diálogo es Lluvia de meteoritos. El diálogo debe estar escrita al estilo de Stephen King. El diálogo debe ser del género Terror. El argumento principal del diálogo es el siguiente: Cosmo se encuentra con el fantasma de Coscu. El objetivo del diálogo (lo que se pretende lograr con el mismo dentro de la historia) es Asustar al lector."
-    # answer = ans.get_raw_answer(prompt=prompt)
+    # stream = client.stream(prompt=prompt)
+    # answer = stream.text()
     # print(answer)
+    # print(stream.done)
+
+    # Stream the answer token by token
+    # answer = ans.stream_answer(prompt='Resumime el dialogo anterior.', session_id=1)
+
+    # Get the answers of several prompts in one request
+    # answers = ans.get_answers(['Hola', 'Contame un chiste'])
+    # print(answers)
+
+    # Generate in the background and poll the job until it ends
+    # job = client.submit_job(prompt='Contame un chiste', session_id=2)
+    # job = client.wait_job(job["job_id"], timeout=600)
+    # print(job["status"], job.get("result"))
 
     # Get sessions
-    # sessions = ans.get_sessions()
-    # sessions = json.dumps(sessions, indent=4)
-    # print(sessions)
+    # sessions = ans.get_sessions(sort='updated')
+    # for session in sessions:
+    #     print(session["id"], session["name"], session["turns"])
 
     # Get available models
     # available_models = mo.get_models()
@@ -222,3 +172,6 @@ if __name__ == '__main__':
     # Generate new api key (requires master key)
     # key = au.gen_key()
     # print(key)
+
+    # Client-side latency of the requests (avg, p50, p95, p99, max)
+    # print(client.stats.summary())
@@ -1,9 +1,16 @@
+import threading
 from website import create_app
 from utils.config import Config
+from utils.model_manager import model_manager
 
 if __name__ == '__main__':
 
     app = create_app(Config)
     port = Config.PORT
     host = Config.HOST 
+
+    # Load and warm up the models before the first request
+    if Config.MODEL_PRELOAD_ON_START:
+        threading.Thread(target=model_manager.preload, daemon=True).start()
+
     app.run(port=port, host=host)
\ No newline at end of file
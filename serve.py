@@ -0,0 +1,13 @@
+import uvicorn
+from utils.config import Config
+
+if __name__ == '__main__':
+
+    # Production server: one process, with the thread pools of asgi.FlaskASGI
+    uvicorn.run(
+        'asgi:app',
+        host=Config.HOST,
+        port=Config.PORT,
+        workers=1,
+        log_level=Config.ASGI_LOG_LEVEL
+        )
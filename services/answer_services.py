@@ -1,19 +1,21 @@
 from flask_restx import Namespace, Resource
-from flask import request
-from utils.load_model import load_model
-from utils.sessions import load_session, save_session, check_session, set_session
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from langchain.memory import ConversationBufferWindowMemory, ChatMessageHistory
+from flask import request, Response
+from utils.generation import run_answer, stream_answer, answer_from_cache, batch_answer, parse_request, RequestError
+from utils.response_cache import response_cache
+from utils.scheduler import scheduler, SchedulerError
+from utils.session_store import get_session_store, SESSION_SORTS
+from utils.memory_cache import memory_cache
+from utils.jobs import job_store
+from utils.summarizer import summarizer
+from utils.config import Config
+import json
 import time
-import copy
-from colorama import Fore as c
+from utils.logger import get_logger
 from auth.authentication import *
 
-answer = Namespace('answer', description='Answer related operations')
+logger = get_logger('answer')
 
-memory = None
-llm = None
+answer = Namespace('answer', description='Answer related operations')
 
 @answer.route('/')
 class Answer(Resource):
@@ -24,86 +26,274 @@ class Answer(Resource):
             - Requires an API key in the request header.
             - Requires a question in the request body.
         '''
-        start_time = time.time()
-        
-        global llm
-        global template
-        global memory
-
         request_data = request.get_json()
-        question = request_data.get("prompt")
-        session_id = request_data.get("session_id")
-
-        active_session = check_session()
+        question, session_id, model_config, priority = answer_request(request_data)
 
-        if type(session_id) != int:
-            return answer.abort(500, 'Session ID must be an integer')
+        # Without a session the response cache is read here, with one it is read on the worker in turn with the session
+        read_cache, store = cache_policy()
+        result = answer_from_cache(question=question, model_config=model_config) if read_cache and session_id is None else None
+        cached = result is not None
 
-        if str(active_session) != str(session_id):
-            # Reset memory and change session
-            session = load_session(session_id=session_id)
-            memory = ConversationBufferWindowMemory(
-                    k=5, 
-                    memory_key="chat_history", 
-                    chat_memory=session
+        # Run the chain on the inference worker
+        if result is None:
+            try:
+                result, cached = run_answer(
+                    question=question,
+                    session_id=session_id,
+                    model_config=model_config,
+                    client=key_store.key_id(request.headers.get("Authorization")),
+                    priority=priority,
+                    store=store,
+                    read_cache=read_cache and session_id is not None
                     )
-            # Change active session
-            set_session(session_id=session_id)
+            except SchedulerError as e:
+                return answer.abort(e.status, str(e))
+
+        return {"result": result}, 200, {"X-Cache": "HIT" if cached else "MISS"}
+
+    @require_api_key
+    def get(self):
+        '''
+        Method to get a page of the session catalog (id, name, created, updated, turns and tokens of each session).
+        Query parameters:
+            - limit: sessions per page, Config.SESSION_PAGE_SIZE by default
+            - cursor: next_cursor of the previous page
+            - sort: 'updated' (last activity first, default), 'created' (newest first) or 'name'
+            - prefix: only the sessions whose name starts with it
+            - Requires an API key in the request header.
+        '''
+        try:
+            limit = int(request.args.get("limit", Config.SESSION_PAGE_SIZE))
+        except ValueError:
+            return answer.abort(400, "limit must be an integer")
+        if limit < 1 or limit > Config.SESSION_PAGE_MAX:
+            return answer.abort(400, f"limit must be between 1 and {Config.SESSION_PAGE_MAX}")
+
+        sort = request.args.get("sort", "updated")
+        if sort not in SESSION_SORTS:
+            return answer.abort(400, f"sort must be one of {', '.join(SESSION_SORTS)}")
+
+        try:
+            sessions, next_cursor = get_session_store().list_sessions(
+                limit=limit,
+                cursor=request.args.get("cursor"),
+                sort=sort,
+                prefix=request.args.get("prefix")
+                )
+        except ValueError as e:
+            return answer.abort(400, str(e))
+
+        return {"sessions": sessions, "next_cursor": next_cursor}
+
+def request_priority(request_data:dict=None):
+    '''
+    Method to get the queue priority of a request (0 to 9, lower is served first).
+    '''
+    priority = request_data.get("priority", Config.SCHEDULER_DEFAULT_PRIORITY)
+    if type(priority) != int:
+        return Config.SCHEDULER_DEFAULT_PRIORITY
+    return min(max(priority, 0), 9)
+
+def answer_request(request_data:dict=None):
+    '''
+    Method to get the prompt, session_id, model_config and priority of a request, or abort with the status of the
+    first field that is not valid (see parse_request).
+    '''
+    try:
+        question, session_id, model_config, model = parse_request(request_data)
+    except RequestError as e:
+        return answer.abort(e.status, str(e))
+    return question, session_id, model_config, request_priority(request_data)
+
+def cache_policy():
+    '''
+    Method to get how a request uses the response cache from its Cache-Control header.
+        - no-cache: do not look up the answer in the cache.
+        - no-store: do not save the answer in the cache.
+    Returns (read, store).
+    '''
+    directives = [d.strip().lower() for d in request.headers.get("Cache-Control", "").split(",")]
+    return "no-cache" not in directives, "no-store" not in directives
 
-        if not llm:
+def sse_event(event:str=None, data:dict=None):
+    '''
+    Method to format a Server-Sent Event.
+    '''
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@answer.route('/stream')
+class AnswerStream(Resource):
+    @require_api_key
+    def post(self):
+        '''
+        Method to get the answer to a question as a stream of Server-Sent Events.
+            - Requires an API key in the request header.
+            - Requires a question in the request body.
+            - Sends a "token" event for every generated token and a final "done" event with the result, time to first token and tokens per second.
+        '''
+        request_data = request.get_json()
+        question, session_id, model_config, priority = answer_request(request_data)
+
+        read_cache, store = cache_policy()
+        cached = answer_from_cache(question=question, model_config=model_config) if read_cache and session_id is None else None
+
+        if cached is not None:
+            tokens = iter([("token", cached), ("done", {"result": cached, "cached": True})])
+        else:
             try:
-                llm, template = load_model()
-                if session_id is None:
-                    session = ChatMessageHistory()
-                else:
-                    session = load_session(session_id=session_id)
-                memory = ConversationBufferWindowMemory(
-                    k=5, 
-                    memory_key="chat_history", 
-                    chat_memory=session
+                tokens = stream_answer(
+                    question=question,
+                    session_id=session_id,
+                    model_config=model_config,
+                    client=key_store.key_id(request.headers.get("Authorization")),
+                    priority=priority,
+                    store=store,
+                    read_cache=read_cache and session_id is not None
                     )
-            except Exception as e:
-                error_message = str(e)
-                return answer.abort(500, error_message)
-            
-        if not question:
-            return answer.abort(400, "Question not provided in the request")
-
-        # Create prompt from template
-        ## input_variables reads the variables from the template
-        
-        prompt = PromptTemplate(template=template, input_variables=["chat_history", "input"])
-        conversation_chain = LLMChain(prompt=prompt, llm=llm, memory=memory, verbose=True)
-
-        # Run the chain and get the stream
-        stream = conversation_chain.predict(input=question)
-        result = copy.deepcopy(stream)
-
-        if session_id is not None:
-            history = memory.buffer_as_messages
-            print(f'\n[ {c.YELLOW}SAVING{c.RESET} ] Saving changes of session {session_id}')
-            save_session(history=history)
-        
+            except SchedulerError as e:
+                return answer.abort(e.status, str(e))
+
+        def events():
+            for event, data in tokens:
+                if event == "token":
+                    yield sse_event("token", {"token": data})
+                elif event == "done":
+                    if not data.get("cached"):
+                        logger.debug('Answer streamed', extra={"time_to_first_token": data['time_to_first_token'], "tokens_per_second": data['tokens_per_second']})
+                    yield sse_event("done", data)
+                else:
+                    yield sse_event("error", {"message": data})
+
+        return Response(
+            events(),
+            mimetype='text/event-stream',
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+
+@answer.route('/batch')
+class AnswerBatch(Resource):
+    @require_api_key
+    def post(self):
+        '''
+        Method to get the answers to a list of independent prompts.
+            - Requires an API key in the request header.
+            - Requires a list of items in the request body, each one with a prompt and optionally a session_id and a model_config.
+            - With "stream": true, the results are sent as they complete, one JSON object per line (application/x-ndjson).
+        '''
+        start_time = time.time()
+
+        request_data = request.get_json()
+        items = request_data.get("items")
+        stream = request_data.get("stream", False)
+
+        if not items or type(items) != list:
+            return answer.abort(400, "Items not provided in the request")
+        if len(items) > Config.BATCH_MAX_ITEMS:
+            return answer.abort(400, f"Too many items in the batch ({Config.BATCH_MAX_ITEMS} max)")
+
+        read_cache, store = cache_policy()
+        try:
+            completed = batch_answer(
+                items=items,
+                client=key_store.key_id(request.headers.get("Authorization")),
+                priority=request_priority(request_data),
+                read_cache=read_cache,
+                store=store
+                )
+        except SchedulerError as e:
+            return answer.abort(e.status, str(e))
+
+        if stream:
+            def lines():
+                for index, item in completed:
+                    yield json.dumps({"index": index, **item}, ensure_ascii=False) + "\n"
+
+            return Response(lines(), mimetype='application/x-ndjson', headers={"X-Accel-Buffering": "no"})
+
+        results = [None] * len(items)
+        for index, item in completed:
+            results[index] = {"index": index, **item}
+
         end_time = time.time()
         execution_time = end_time - start_time
-        print(f"\n[ {c.WHITE}MODEL{c.RESET} ] Execution time in seconds: {execution_time}\n")
+        logger.debug('Batch answered', extra={"items": len(items), "duration": round(execution_time, 3)})
 
-              
-        return {"result": result}
+        return {"results": results, "total_time": execution_time}
 
+@answer.route('/jobs')
+class AnswerJobs(Resource):
     @require_api_key
-    def get(self):
+    def post(self):
         '''
-        Method to get the sessions that are saved in the sessions.json file.
+        Method to queue a generation in the background and get its job ID right away.
+            - Requires an API key in the request header.
+            - Requires a question in the request body.
+            - The job is polled with GET /answer/jobs/<job_id> and cancelled with DELETE /answer/jobs/<job_id>.
         '''
+        request_data = request.get_json()
+        question, session_id, model_config, priority = answer_request(request_data)
 
-        sessions = {}
+        read_cache, store = cache_policy()
+        try:
+            job = job_store.create(
+                question=question,
+                session_id=session_id,
+                model_config=model_config,
+                client=key_store.key_id(request.headers.get("Authorization")),
+                priority=priority,
+                store=store
+                )
+        except SchedulerError as e:
+            return answer.abort(e.status, str(e))
 
-        with open(f"./data/sessions.json", "r") as f:
-            data = json.load(f)
+        return {"job_id": job.id, "status": job.status}, 202, {"Location": f"/answer/jobs/{job.id}"}
 
-        for key in data:
-            if key != "Active":
-                sessions[key] = data[key]["name"]
-        
-        return sessions
\ No newline at end of file
+def owned_job(job_id:str=None):
+    '''
+    Method to get a job of the API key of the request (any job with the master key), or abort with 404.
+    '''
+    api_key = request.headers.get("Authorization")
+    job = job_store.get(job_id)
+    if job is None or (job.owner != key_store.key_id(api_key) and not key_store.is_master(api_key)):
+        return answer.abort(404, "Job not found")
+    return job
+
+@answer.route('/jobs/<string:job_id>')
+class AnswerJob(Resource):
+    @require_api_key
+    def get(self, job_id):
+        '''
+        Method to get the status of a job, the output generated so far and its timings.
+            - Requires an API key in the request header.
+        '''
+        return owned_job(job_id).to_dict()
+
+    @require_api_key
+    def delete(self, job_id):
+        '''
+        Method to cancel a job. A running generation stops at its next token and is not saved in the session.
+            - Requires an API key in the request header.
+        '''
+        job = job_store.cancel(owned_job(job_id).id)
+        return job.to_dict()
+
+@answer.route('/cache')
+class MemoryCache(Resource):
+    @require_api_key
+    def get(self):
+        '''
+        Method to get the counters of the session memory cache and the response cache (hits, misses and evictions),
+        and of the session summarizer.
+            - Requires an API key in the request header.
+        '''
+        return {"memory_cache": memory_cache.stats(), "response_cache": response_cache.stats(), "summarizer": summarizer.stats()}
+
+@answer.route('/queue')
+class Queue(Resource):
+    @require_api_key
+    def get(self):
+        '''
+        Method to get the state of the inference queue (queue depth, wait time and service time).
+            - Requires an API key in the request header.
+        '''
+        return {"queue": scheduler.stats(), "jobs": job_store.stats()}
\ No newline at end of file
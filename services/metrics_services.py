@@ -0,0 +1,54 @@
+from flask_restx import Namespace, Resource
+from flask import request, Response
+from utils.metrics import registry, Gauge
+from utils.scheduler import scheduler
+from utils.model_manager import model_manager
+from utils.memory_cache import memory_cache
+from utils.response_cache import response_cache
+from utils.jobs import job_store
+from utils.config import Config
+from auth.authentication import *
+
+metrics = Namespace('metrics', description='Metrics related operations')
+
+registry.register(Gauge('llm_api_queue_depth', 'Requests waiting for the inference worker', fn=lambda: scheduler.queued))
+registry.register(Gauge('llm_api_queue_running', 'Generations running on the inference worker', fn=lambda: scheduler.running))
+registry.register(Gauge(
+    'llm_api_model_load_seconds',
+    'Load time of each resident model',
+    ('model',),
+    fn=lambda: {name: entry.load_time for name, entry in list(model_manager.models.items())}
+))
+registry.register(Gauge(
+    'llm_api_model_warmup_seconds',
+    'Warm-up time of each resident model',
+    ('model',),
+    fn=lambda: {name: entry.warmup_time for name, entry in list(model_manager.models.items())}
+))
+registry.register(Gauge(
+    'llm_api_cache_hit_ratio',
+    'Hit ratio of the caches',
+    ('cache',),
+    fn=lambda: {
+        "memory": memory_cache.stats()["hit_ratio"],
+        "response": response_cache.stats()["hit_ratio"]
+    }
+))
+registry.register(Gauge(
+    'llm_api_jobs',
+    'Background jobs by status',
+    ('status',),
+    fn=job_store.stats
+))
+
+@metrics.route('')
+class Metrics(Resource):
+    def get(self):
+        '''
+        Method to get the metrics of the server in the Prometheus text format.
+            - Requires an API key in the request header, unless Config.METRICS_PUBLIC is set.
+        '''
+        if not Config.METRICS_PUBLIC and not key_store.is_valid(request.headers.get("Authorization")):
+            return {"message": "Unauthorized"}, 401
+
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -1,9 +1,9 @@
 from flask_restx import Namespace, Resource
 from flask import request
-from utils.load_model import get_models, set_model
-import time
+from utils.load_model import get_models, get_model_configs, set_model
+from utils.model_manager import model_manager
+from utils.model_registry import model_registry
 from auth.authentication import *
-from colorama import Fore as c
 
 LLMmodels = Namespace('models', description='Model related operations')
 
@@ -12,21 +12,18 @@ class Models(Resource):
     @require_api_key
     def get(self):
         '''
-        Method to get the models available in the models folder.
+        Method to get the models available in the models folder with their header metadata (architecture, parameters,
+        quantization, context length and size), the model configs and the loaded models.
             - Requires an API key in the request header.
         '''
-        start_time = time.time()
         try:
             models = get_models()
+            configs = get_model_configs()
         except Exception as e:
             error_message = str(e)
             return LLMmodels.abort(500, error_message)
 
-        end_time = time.time()
-        execution_time = end_time - start_time
-        print(f"\n[ {c.WHITE}MODEL{c.RESET} ] Execution time in seconds: {execution_time}\n")
-
-        return {"models": models}
+        return {"models": models, "configs": configs, "pool": model_manager.stats(), "registry": model_registry.stats()}
     
 @LLMmodels.route('/model')
 class Model(Resource):
@@ -38,8 +35,6 @@ class Model(Resource):
             - Requires a model name in the request body.
             - Requires a model config name in the request body. You can set the model config name in the config.json file in data.
         '''
-        start_time = time.time()
-
         request_data = request.get_json()
         model_name = request_data.get("model")
         model_config_name = request_data.get("model_config")
@@ -58,8 +53,8 @@ class Model(Resource):
             error_message = str(e)
             return LLMmodels.abort(500, error_message)
         
-        end_time = time.time()
-        execution_time = end_time - start_time
-        print(f"\n[ {c.WHITE}MODEL{c.RESET} ] Execution time in seconds: {execution_time}\n")
+        # Load the new model in the background, the current one keeps serving until it is ready
+        if model == True:
+            model_manager.switch(model_config_name)
 
         return {"model_status": model}
\ No newline at end of file
@@ -0,0 +1,61 @@
+from flask_restx import Namespace, Resource
+from flask import request, send_from_directory
+import os
+from utils.profiler import profiler, DUMP_NAME
+from auth.authentication import *
+
+profiling = Namespace('profiling', description='Profiling related operations')
+
+@profiling.route('/')
+class Profiling(Resource):
+    @require_master_key
+    def get(self):
+        '''
+        Method to get the state of the profiler and the saved profiles, newest first.
+            - Requires a master API key in the request header.
+        '''
+        return {"profiler": profiler.stats(), "profiles": profiler.dumps()}
+
+    @require_master_key
+    def post(self):
+        '''
+        Method to profile the next requests. The body may have:
+            - requests: number of requests to profile (1 by default)
+            - mode: 'cprofile' (pstats dump) or 'sample' (speedscope dump), 'cprofile' by default
+            - path: only profile the requests whose path starts with it (e.g. /answer/)
+            - Requires a master API key in the request header.
+        '''
+        request_data = request.get_json(silent=True) or {}
+
+        try:
+            profiler.arm(
+                requests=request_data.get('requests', 1),
+                mode=request_data.get('mode', 'cprofile'),
+                path=request_data.get('path')
+            )
+        except ValueError as e:
+            return profiling.abort(400, str(e))
+
+        return {"profiler": profiler.stats()}
+
+    @require_master_key
+    def delete(self):
+        '''
+        Method to stop profiling the next requests.
+            - Requires a master API key in the request header.
+        '''
+        profiler.disarm()
+        return {"profiler": profiler.stats()}
+
+@profiling.route('/<string:name>')
+class ProfileDump(Resource):
+    @require_master_key
+    def get(self, name):
+        '''
+        Method to download a saved profile.
+            - Requires a master API key in the request header.
+        '''
+        if not DUMP_NAME.match(name) or not os.path.isfile(os.path.join(profiler.directory, name)):
+            return profiling.abort(404, "Profile not found")
+
+        return send_from_directory(os.path.abspath(profiler.directory), name, as_attachment=True)
@@ -1,5 +1,21 @@
 import os 
 
+def env_int(name:str=None):
+    '''
+    Method to read an integer environment variable, None if it is not set.
+    '''
+    value = os.getenv(name)
+    return int(value) if value not in (None, '') else None
+
+def env_bool(name:str=None):
+    '''
+    Method to read a boolean environment variable (true/false, 1/0), None if it is not set.
+    '''
+    value = os.getenv(name)
+    if value in (None, ''):
+        return None
+    return value.lower() in ('true', '1', 'yes')
+
 class Config:
     '''
     Class to store configuration variables
@@ -8,4 +24,138 @@ class Config:
     HOST = '0.0.0.0'
     PORT = 5000
     SECRET_KEY = '1234'
-    DEBUG = True
\ No newline at end of file
+    DEBUG = True
+
+    # Sessions
+    ## SESSION_BACKEND can be 'sqlite' (indexed, append-only turns) or 'json' (legacy sessions.json)
+    SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'sqlite')
+    SESSIONS_DB = os.getenv('SESSIONS_DB', 'data/sessions.db')
+    SESSIONS_JSON = os.getenv('SESSIONS_JSON', 'data/sessions.json')
+    ## Number of messages (Human + AI) loaded from the store when a session is resumed and kept in its memory.
+    ## The ones sent to the model are the most recent that fit in the history_tokens of the model config.
+    SESSION_LOAD_LIMIT = int(os.getenv('SESSION_LOAD_LIMIT', 40))
+    ## Sessions per page of GET /answer, by default and at most
+    SESSION_PAGE_SIZE = int(os.getenv('SESSION_PAGE_SIZE', 50))
+    SESSION_PAGE_MAX = int(os.getenv('SESSION_PAGE_MAX', 500))
+
+    # Rolling summary of sessions
+    ## Fold the turns older than the last SUMMARY_KEEP_MESSAGES into a running summary of the session. It runs in the
+    ## background, on the inference worker when no request is waiting, once SUMMARY_MIN_MESSAGES messages are pending.
+    SUMMARY = os.getenv('SUMMARY', 'false').lower() == 'true'
+    SUMMARY_KEEP_MESSAGES = int(os.getenv('SUMMARY_KEEP_MESSAGES', 10))
+    SUMMARY_MIN_MESSAGES = int(os.getenv('SUMMARY_MIN_MESSAGES', 10))
+    SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', 256))
+    SUMMARY_PROMPT = os.getenv(
+        'SUMMARY_PROMPT',
+        'Progressively summarize the lines of conversation provided, adding onto the previous summary and returning a new summary.'
+        '\n\nCurrent summary:\n{summary}\n\nNew lines of conversation:\n{new_lines}\n\nNew summary:'
+        )
+
+    # Memory cache
+    ## Max number of session memories kept in the process and seconds before an idle one is dropped
+    MEMORY_CACHE_SIZE = int(os.getenv('MEMORY_CACHE_SIZE', 64))
+    MEMORY_CACHE_TTL = float(os.getenv('MEMORY_CACHE_TTL', 1800))
+
+    # Inference scheduler
+    ## Max requests waiting for the model, max waiting per API key and seconds a request can wait before it is dropped
+    SCHEDULER_MAX_QUEUE = int(os.getenv('SCHEDULER_MAX_QUEUE', 32))
+    SCHEDULER_MAX_PER_KEY = int(os.getenv('SCHEDULER_MAX_PER_KEY', 8))
+    SCHEDULER_WAIT_TIMEOUT = float(os.getenv('SCHEDULER_WAIT_TIMEOUT', 300))
+    ## Priority of requests that do not set one (0 to 9, lower is served first)
+    SCHEDULER_DEFAULT_PRIORITY = int(os.getenv('SCHEDULER_DEFAULT_PRIORITY', 5))
+
+    # Token counts
+    ## Number of texts (stored messages, questions) whose token count is cached per loaded model
+    TOKEN_COUNT_CACHE_SIZE = int(os.getenv('TOKEN_COUNT_CACHE_SIZE', 4096))
+
+    # Model registry
+    ## Seconds between scans of the models folder (GET /models is served from memory in between)
+    MODEL_REGISTRY_INTERVAL = float(os.getenv('MODEL_REGISTRY_INTERVAL', 5))
+    ## Seconds between the scans forced by a lookup of a file that is not indexed (a file copied since the last scan)
+    MODEL_REGISTRY_MISS_INTERVAL = float(os.getenv('MODEL_REGISTRY_MISS_INTERVAL', 1))
+
+    # Prompt cache (llama.cpp state snapshots)
+    ## The static prefix of each template is evaluated once at load, and the state after every completion is kept,
+    ## so a request only evaluates the tokens that are not already cached. States are large (up to the KV cache size).
+    PROMPT_CACHE = os.getenv('PROMPT_CACHE', 'true').lower() == 'true'
+    ## 'ram' or 'disk'
+    PROMPT_CACHE_TYPE = os.getenv('PROMPT_CACHE_TYPE', 'ram')
+    ## Max size of the cache of each loaded model (split between its slots). RAM caches count for MODEL_MEMORY_BUDGET
+    PROMPT_CACHE_BYTES = int(os.getenv('PROMPT_CACHE_BYTES', 4 << 30))
+    PROMPT_CACHE_DIR = os.getenv('PROMPT_CACHE_DIR', 'data/prompt_cache')
+
+    # Model pool
+    ## Load the selected model (and MODEL_PRELOAD configs) when the server starts
+    MODEL_PRELOAD_ON_START = os.getenv('MODEL_PRELOAD_ON_START', 'true').lower() == 'true'
+    MODEL_PRELOAD = [name for name in os.getenv('MODEL_PRELOAD', '').split(',') if name]
+    ## Max bytes of model files (with their draft models and RAM prompt caches) kept loaded at the same time, 0 to keep
+    ## only the selected model and the last one used
+    MODEL_MEMORY_BUDGET = int(os.getenv('MODEL_MEMORY_BUDGET', 0))
+    ## Short generation run after loading a model, 0 tokens to disable it
+    MODEL_WARMUP_PROMPT = os.getenv('MODEL_WARMUP_PROMPT', 'Hello')
+    MODEL_WARMUP_TOKENS = int(os.getenv('MODEL_WARMUP_TOKENS', 4))
+
+    # llama.cpp performance overrides for this deployment
+    ## When set, they take precedence over the values of every model config in config.json
+    LLAMA_OVERRIDES = {
+        "n_threads": env_int('LLAMA_N_THREADS'),
+        "n_batch": env_int('LLAMA_N_BATCH'),
+        "use_mmap": env_bool('LLAMA_USE_MMAP'),
+        "use_mlock": env_bool('LLAMA_USE_MLOCK'),
+        "seed": env_int('LLAMA_SEED'),
+        "f16_kv": env_bool('LLAMA_F16_KV'),
+        "n_gpu_layers": env_int('LLAMA_N_GPU_LAYERS')
+    }
+    ## Decoding slots (llama.cpp contexts sharing the weights) of every model config
+    LLAMA_SLOTS = env_int('LLAMA_SLOTS')
+
+    # Response cache
+    ## Exact-match cache of answers, only used by model configs with deterministic sampling (temperature 0 or top_k 1)
+    RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', 'true').lower() == 'true'
+    RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 1024))
+    RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 86400))
+    ## Keep cached answers in SQLite too, so they survive restarts
+    RESPONSE_CACHE_DISK = os.getenv('RESPONSE_CACHE_DISK', 'false').lower() == 'true'
+    RESPONSE_CACHE_DB = os.getenv('RESPONSE_CACHE_DB', 'data/response_cache.db')
+
+    # ASGI server (serve.py)
+    ## Threads for regular requests (auth, sessions, models...)
+    ASGI_THREADS = int(os.getenv('ASGI_THREADS', 16))
+    ## Threads for requests that wait for a generation. They only wait on the inference queue, so there should be
+    ## at least as many as requests can be queued.
+    ASGI_INFERENCE_THREADS = int(os.getenv('ASGI_INFERENCE_THREADS', SCHEDULER_MAX_QUEUE + 1))
+    ASGI_INFERENCE_ROUTES = [('POST', '/answer/'), ('POST', '/answer/stream'), ('POST', '/answer/batch')]
+    ## Log level of uvicorn
+    ASGI_LOG_LEVEL = os.getenv('ASGI_LOG_LEVEL', 'warning')
+
+    # Multi-process mode (workers.py)
+    ## Number of worker processes and first local port they listen on (one port per worker)
+    WORKERS = int(os.getenv('WORKERS', 2))
+    WORKER_BASE_PORT = int(os.getenv('WORKER_BASE_PORT', PORT + 1))
+
+    # Batch answers
+    ## Max prompts in a POST /answer/batch request. The whole batch must fit in the inference queue.
+    BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 32))
+
+    # Background jobs
+    ## Seconds a finished job (POST /answer/jobs) is kept so its result can be polled
+    JOB_TTL = float(os.getenv('JOB_TTL', 3600))
+
+    # Metrics
+    ## Serve GET /metrics without an API key (e.g. for a Prometheus server in a private network)
+    METRICS_PUBLIC = os.getenv('METRICS_PUBLIC', 'false').lower() == 'true'
+
+    # Profiling
+    ## Directory of the profiles of requests (POST /profiling/ with the master key)
+    PROFILING_DIR = os.getenv('PROFILING_DIR', 'data/profiles')
+    ## Seconds between the stacks taken by the sampling profiler
+    PROFILING_INTERVAL = float(os.getenv('PROFILING_INTERVAL', 0.005))
+    ## Profile any request with the master key and an X-Profile header ('cprofile' or 'sample')
+    PROFILING_HEADER = os.getenv('PROFILING_HEADER', 'false').lower() == 'true'
+
+    # Logging
+    ## Level (DEBUG, INFO, WARNING, ERROR) and format ('text' or 'json', one object per line) of the server logs
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+    ## Print the rendered prompt of every answer (verbose of the LangChain chain)
+    LLM_VERBOSE = os.getenv('LLM_VERBOSE', 'false').lower() == 'true'
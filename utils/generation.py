@@ -0,0 +1,374 @@
+import time
+import queue
+from langchain.callbacks.base import BaseCallbackHandler
+from utils.model_manager import model_manager
+from utils.sessions import save_session
+from utils.memory_cache import memory_cache
+from utils.scheduler import scheduler
+from utils.summarizer import summarizer
+from utils.response_cache import response_cache, response_key, is_deterministic
+from utils.config import Config
+from utils.metrics import timed, observe_stage, PROMPT_TOKENS, COMPLETION_TOKENS, TOKENS_PER_SECOND
+from utils.logger import get_logger
+
+logger = get_logger('generation')
+
+class RequestError(Exception):
+    '''
+    Error in the fields of a request. status is the HTTP status to answer with.
+    '''
+
+    def __init__(self, status:int=400, message:str=None):
+        super().__init__(message)
+        self.status = status
+
+def parse_request(request_data:dict=None):
+    '''
+    Method to check the prompt, session_id and model_config of a request (or of an item of a batch) and get its model.
+    Returns (question, session_id, model_config, model). Raises RequestError if a field is not valid or the model
+    can not be loaded.
+    '''
+    if not isinstance(request_data, dict) or not request_data.get("prompt"):
+        raise RequestError(400, "Question not provided in the request")
+    session_id = request_data.get("session_id")
+    if session_id is not None and type(session_id) != int:
+        raise RequestError(400, "Session ID must be an integer")
+
+    model_config = request_data.get("model_config")
+    try:
+        model = model_manager.get(model_config)
+    except Exception as e:
+        raise RequestError(500, str(e))
+
+    return request_data["prompt"], session_id, model_config, model
+
+def response_cache_key(model=None, history:dict=None, question:str=None):
+    '''
+    Method to get the response cache key of a question, or None if the model config does not sample deterministically. Where:
+        - history: memory variables of the session (memory.load_memory_variables)
+    '''
+    if not Config.RESPONSE_CACHE or not is_deterministic(model.config):
+        return None
+    rendered = model.prompt.format(input=question, **history)
+    return response_key(model.config, rendered)
+
+def turn_tokens(model=None, question:str=None, answer:str=None):
+    '''
+    Method to count the tokens of a turn for the session catalog. The counts stay in the cache of the model, where the
+    history budget of the next request finds them.
+    '''
+    return model.count_tokens(question) + model.count_tokens(answer)
+
+def answer_from_cache(question:str=None, session_id:int=None, model_config:str=None, model=None):
+    '''
+    Method to get the answer of a question from the response cache, without queueing a generation.
+        - On a hit the turn is added to the memory and saved in the session, as if it was generated.
+        - Returns None on a miss or if the model config is not deterministic.
+    A request with a session reads the cache on the inference worker (see queued_answer), so a hit is saved in turn
+    with the generations of its session. Only requests without a session call it on the request thread.
+    '''
+    model = model or model_manager.get(model_config)
+    # Only deterministic configs are cached, the others do not need the memory of the session here
+    if not Config.RESPONSE_CACHE or not is_deterministic(model.config):
+        return None
+
+    with timed('session_load'):
+        memory = memory_cache.get(session_id=session_id).for_model(model)
+    key = response_cache_key(model=model, history=memory.load_memory_variables({"input": question}), question=question)
+    if key is None:
+        return None
+
+    result = response_cache.get(key)
+    if result is None:
+        return None
+
+    logger.debug('Answer found in response cache')
+    memory.save_context({"input": question}, {"text": result})
+    if session_id is not None:
+        with timed('session_save'):
+            save_session(session_id=session_id, question=question, answer=result, tokens=turn_tokens(model, question, result))
+        summarizer.schedule(session_id)
+
+    return result
+
+def generate_answer(question:str=None, session_id:int=None, model_config:str=None, callbacks:list=None, store:bool=True, model=None):
+    '''
+    Method to run the conversation chain for a question and save the turn in the session. Where:
+        - question: prompt of the user
+        - session_id: id of the session, None for a session that is not saved
+        - model_config: name of the model config in config.json, None for the selected one
+        - callbacks: LangChain callback handlers passed to the chain (e.g. to stream tokens)
+        - store: save the answer in the response cache (only for deterministic model configs)
+        - model: LoadedModel the job was queued for (see queue_answer), by default the one of model_config
+    '''
+    model = model or model_manager.get(model_config)
+
+    with timed('session_load'):
+        memory = memory_cache.get(session_id=session_id).for_model(model)
+
+    # The chain of the model is built once when it loads, the memory of the session is applied here:
+    # the history is trimmed to the token budget of this model and the turn is saved after the answer
+    stages = StageTimingHandler(model=model)
+    history = memory.load_memory_variables({"input": question})
+
+    # The key is computed before this turn is added to the memory
+    key = response_cache_key(model=model, history=history, question=question) if store else None
+
+    start_time = time.time()
+    with model.slot(session_id=session_id) as slot:
+        result = slot.chain.predict(input=question, callbacks=(callbacks or []) + [stages], **history)
+    memory.save_context({"input": question}, {"text": result})
+
+    if key is not None:
+        response_cache.put(key, result, generation_time=time.time() - start_time)
+
+    if session_id is not None:
+        with timed('session_save'):
+            save_session(session_id=session_id, question=question, answer=result, tokens=turn_tokens(model, question, result))
+        summarizer.schedule(session_id)
+
+    return result
+
+class StageTimingHandler(BaseCallbackHandler):
+    '''
+    Callback handler that records the stages of a generation in the metrics:
+        - prompt_render: from the start of the chain to the LLM call (history selection and template)
+        - prefill: from the LLM call to the first token
+        - generation: from the first token to the end
+    and the prompt and completion tokens of the model.
+    '''
+
+    def __init__(self, model=None):
+        self.model = model
+        self.chain_start = time.perf_counter()
+        self.llm_start = None
+        self.first_token = None
+        self.completion_tokens = 0
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.llm_start = time.perf_counter()
+        observe_stage('prompt_render', self.llm_start - self.chain_start)
+        PROMPT_TOKENS.inc(sum(self.model.count_tokens(prompt, cache=False) for prompt in prompts), model=self.model.name)
+
+    def on_llm_new_token(self, token:str, **kwargs):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+            observe_stage('prefill', self.first_token - self.llm_start)
+        self.completion_tokens += 1
+
+    def on_llm_end(self, response, **kwargs):
+        end = time.perf_counter()
+        if self.first_token is None:
+            observe_stage('prefill', end - self.llm_start)
+            return
+        generation_time = end - self.first_token
+        observe_stage('generation', generation_time)
+        COMPLETION_TOKENS.inc(self.completion_tokens, model=self.model.name)
+        self.model.record_generation(tokens=self.completion_tokens, seconds=generation_time)
+        if generation_time > 0:
+            TOKENS_PER_SECOND.observe(self.completion_tokens / generation_time, model=self.model.name)
+
+class TokenStreamHandler(BaseCallbackHandler):
+    '''
+    Callback handler that puts every new token of the LLM in a queue and times the generation.
+    '''
+
+    def __init__(self):
+        self.tokens = queue.Queue()
+        self.start_time = time.time()
+        self.first_token_time = None
+        self.token_count = 0
+
+    def on_llm_new_token(self, token:str, **kwargs):
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+        self.token_count += 1
+        self.tokens.put(token)
+
+    def timings(self):
+        '''
+        Method to get time to first token and tokens per second of the generation.
+        '''
+        end_time = time.time()
+        time_to_first_token = None
+        tokens_per_second = None
+        if self.first_token_time is not None:
+            time_to_first_token = self.first_token_time - self.start_time
+            generation_time = end_time - self.first_token_time
+            if generation_time > 0:
+                tokens_per_second = self.token_count / generation_time
+        return {
+            "time_to_first_token": time_to_first_token,
+            "tokens_per_second": tokens_per_second,
+            "completion_tokens": self.token_count,
+            "total_time": end_time - self.start_time
+        }
+
+_DONE = object()
+
+def queued_answer(question:str=None, session_id:int=None, model=None, callbacks:list=None, store:bool=True, read_cache:bool=False):
+    '''
+    Method run on the inference worker for a queued request: the answer from the response cache (with read_cache),
+    or a generation. Returns (result, cached). A cached answer is sent to the callbacks as a single token.
+    '''
+    if read_cache:
+        result = answer_from_cache(question=question, session_id=session_id, model=model)
+        if result is not None:
+            for callback in callbacks or []:
+                callback.on_llm_new_token(result)
+            return result, True
+    return generate_answer(question=question, session_id=session_id, callbacks=callbacks, store=store, model=model), False
+
+def queue_answer(question:str=None, session_id:int=None, model_config:str=None, client:str=None, priority:int=0, store:bool=True, callbacks:list=None, read_cache:bool=False):
+    '''
+    Method to queue a generation on the inference scheduler. Returns a Future with (result, cached).
+        - The job waits in the queue until the model has a free slot and no other generation of the session is running.
+        - Raises SchedulerError right away if the queue is full.
+    '''
+    model = model_manager.get(model_config)
+    return scheduler.submit(
+        lambda: queued_answer(question=question, session_id=session_id, model=model, callbacks=callbacks, store=store, read_cache=read_cache),
+        client=client,
+        priority=priority,
+        model=model,
+        session=session_id
+        )
+
+def run_answer(question:str=None, session_id:int=None, model_config:str=None, client:str=None, priority:int=0, store:bool=True, read_cache:bool=False):
+    '''
+    Method to queue a generation on the inference scheduler and wait for the answer. Returns (result, cached). Where:
+        - client: key for fairness between clients (the API key number)
+        - priority: lower values are served first
+        - store: save the answer in the response cache
+        - read_cache: look the answer up in the response cache first, on the worker
+        - Raises SchedulerError if the queue is full or the request waited too long.
+    '''
+    model = model_manager.get(model_config)
+    return scheduler.run(
+        lambda: queued_answer(question=question, session_id=session_id, model=model, store=store, read_cache=read_cache),
+        client=client,
+        priority=priority,
+        model=model,
+        session=session_id
+        )
+
+def stream_answer(question:str=None, session_id:int=None, model_config:str=None, client:str=None, priority:int=0, store:bool=True, read_cache:bool=False):
+    '''
+    Method to queue a generation on the inference scheduler and get a generator of its tokens.
+        - The generator yields ("token", text) for every token, then ("done", dict) with the result and timings, or ("error", message).
+        - Raises SchedulerError right away if the queue is full.
+    '''
+    handler = TokenStreamHandler()
+
+    future = queue_answer(
+        question=question,
+        session_id=session_id,
+        model_config=model_config,
+        client=client,
+        priority=priority,
+        store=store,
+        callbacks=[handler],
+        read_cache=read_cache
+        )
+    future.add_done_callback(lambda f: handler.tokens.put(_DONE))
+
+    def events():
+        while True:
+            token = handler.tokens.get()
+            if token is _DONE:
+                break
+            yield "token", token
+
+        error = future.exception()
+        if error is not None:
+            yield "error", str(error)
+        else:
+            result, cached = future.result()
+            yield "done", {"result": result, "cached": cached, **handler.timings()}
+
+    return events()
+
+
+def batch_answer(items:list=None, client:str=None, priority:int=0, read_cache:bool=True, store:bool=True):
+    '''
+    Method to answer a list of independent prompts. Where:
+        - items: list of dicts with "prompt" and optional "session_id" and "model_config"
+    Returns a generator of (index, dict) as the items complete. The dict has "result" or "error", "status", "cached" and the timings.
+        - Items are queued together, grouped by model config so consecutive generations reuse the loaded model and its
+          cached template prefix. Items of the same session stay in the group of the first one, and run one at a time
+          in their order in the batch.
+        - The response cache of an item with a session is read when the item runs on the worker, after the earlier
+          turns of its session are saved.
+        - Raises SchedulerError right away if the queue has no room for the whole batch.
+    '''
+    results = queue.Queue()
+    pending = []
+    # Group of each session
+    groups = {}
+
+    for index, item in enumerate(items):
+        submitted = time.time()
+        try:
+            question, session_id, _, model = parse_request(item)
+        except RequestError as e:
+            results.put((index, {"error": str(e), "status": e.status}))
+            continue
+
+        try:
+            cached = answer_from_cache(question=question, model=model) if read_cache and session_id is None else None
+        except Exception as e:
+            results.put((index, {"error": str(e), "status": 500}))
+            continue
+        if cached is not None:
+            results.put((index, {"result": cached, "status": 200, "cached": True, "total_time": time.time() - submitted}))
+            continue
+
+        group = model.name if session_id is None else groups.setdefault(session_id, model.name)
+        pending.append((index, question, session_id, model, submitted, read_cache and session_id is not None, group))
+
+    def job(index, question, session_id, model, submitted, read_cache, group):
+        def run():
+            start_time = time.time()
+            try:
+                result, cached = queued_answer(question=question, session_id=session_id, model=model, store=store, read_cache=read_cache)
+            except Exception as e:
+                results.put((index, {"error": str(e), "status": 500, "queue_time": start_time - submitted}))
+                return
+            end_time = time.time()
+            results.put((index, {
+                "result": result,
+                "status": 200,
+                "cached": cached,
+                "queue_time": start_time - submitted,
+                "generation_time": end_time - start_time,
+                "total_time": end_time - submitted
+            }))
+        return run
+
+    # Stable sort: same model config together, original order inside each group
+    pending.sort(key=lambda p: p[6])
+    futures = scheduler.submit_many(
+        [job(*p) for p in pending],
+        client=client,
+        priority=priority,
+        per_client_limit=False,
+        models=[p[3] for p in pending],
+        sessions=[p[2] for p in pending]
+        )
+
+    # Jobs that never ran (e.g. waited too long in the queue) report their error here
+    def report_error(index):
+        def callback(future):
+            error = future.exception()
+            if error is not None:
+                results.put((index, {"error": str(error), "status": getattr(error, 'status', 500)}))
+        return callback
+
+    for p, future in zip(pending, futures):
+        future.add_done_callback(report_error(p[0]))
+
+    def completed():
+        for i in range(len(items)):
+            yield results.get()
+
+    return completed()
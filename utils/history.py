@@ -0,0 +1,79 @@
+from typing import Any, Dict, List
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.schema.messages import BaseMessage, HumanMessage, SystemMessage, get_buffer_string
+from utils.config import Config
+
+class TokenBudgetMemory(BaseChatMemory):
+    '''
+    Conversation memory that sends the most recent messages that fit in the token budget of the model.
+        - The messages of a session are shared by every model: for_model returns a view of the same history that counts
+          tokens with the tokenizer of one model (see LoadedModel.history_budget).
+        - At most max_messages are kept in memory, older ones stay in the session store.
+        - A summary of the older turns (a system message before the other messages, see load_session) is always sent
+          and counted first.
+    '''
+
+    memory_key: str = "chat_history"
+    human_prefix: str = "Human"
+    ai_prefix: str = "AI"
+    max_messages: int = Config.SESSION_LOAD_LIMIT
+    loaded_model: Any = None
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    def for_model(self, loaded_model=None):
+        '''
+        Method to get a view of the memory for a LoadedModel. Turns saved through the view go to the shared history.
+        '''
+        return self.copy(update={"loaded_model": loaded_model})
+
+    def _line(self, message:BaseMessage=None):
+        if isinstance(message, SystemMessage):
+            prefix = "System"
+        else:
+            prefix = self.human_prefix if isinstance(message, HumanMessage) else self.ai_prefix
+        return f"{prefix}: {message.content}"
+
+    def _split(self):
+        messages = list(self.chat_memory.messages)
+        if messages and isinstance(messages[0], SystemMessage):
+            return messages[:1], messages[1:]
+        return [], messages
+
+    def history(self, question:str=None):
+        '''
+        Method to get the summary and the most recent messages that fit in the history budget of the model for a question.
+        '''
+        summary, messages = self._split()
+        messages = messages[-self.max_messages:]
+        if self.loaded_model is None:
+            return summary + messages
+
+        budget = self.loaded_model.history_budget(question or "")
+        for message in summary:
+            budget -= self.loaded_model.count_tokens(self._line(message)) + 1
+        selected = []
+        for message in reversed(messages):
+            # + 1 for the line break between messages
+            tokens = self.loaded_model.count_tokens(self._line(message)) + 1
+            if tokens > budget:
+                break
+            budget -= tokens
+            selected.append(message)
+        selected.reverse()
+        return summary + selected
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        messages = self.history(inputs.get("input"))
+        return {
+            self.memory_key: get_buffer_string(messages, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)
+        }
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        super().save_context(inputs, outputs)
+        summary, messages = self._split()
+        excess = len(messages) - self.max_messages
+        if excess > 0:
+            del self.chat_memory.messages[len(summary):len(summary) + excess]
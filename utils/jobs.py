@@ -0,0 +1,178 @@
+import os
+import time
+import uuid
+import threading
+from utils.logger import get_logger
+from utils.config import Config
+from utils.scheduler import scheduler
+from utils.model_manager import model_manager
+from utils.generation import generate_answer, TokenStreamHandler
+
+logger = get_logger('jobs')
+
+class GenerationCancelled(Exception):
+    pass
+
+class JobHandler(TokenStreamHandler):
+    '''
+    Callback handler of a job: keeps the partial output and stops the generation when the job is cancelled.
+        - raise_error makes LangChain propagate the exception of on_llm_new_token, which ends the llama.cpp token loop.
+    '''
+
+    raise_error = True
+
+    def __init__(self):
+        super().__init__()
+        self.cancelled = threading.Event()
+        self.parts = []
+
+    def on_llm_new_token(self, token:str, **kwargs):
+        if self.cancelled.is_set():
+            raise GenerationCancelled('Job cancelled')
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+        self.token_count += 1
+        self.parts.append(token)
+
+class Job:
+    '''
+    A generation that runs in the background. status is queued, running, done, failed or cancelled.
+    '''
+
+    def __init__(self, owner:str=None, question:str=None, session_id:int=None, model_config:str=None):
+        # In multi-process mode the ID starts with the port of the worker (see workers.py)
+        worker = os.getenv('WORKER_PORT')
+        self.id = f'{worker}-{uuid.uuid4().hex}' if worker else uuid.uuid4().hex
+        self.owner = owner
+        self.question = question
+        self.session_id = session_id
+        self.model_config = model_config
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.handler = JobHandler()
+        self.timings = None
+        self.future = None
+
+    def to_dict(self):
+        data = {
+            "id": self.id,
+            "status": self.status,
+            "session_id": self.session_id,
+            "model_config": self.model_config,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "queue_time": (self.started or self.finished or time.time()) - self.created,
+            "partial": ''.join(self.handler.parts)
+        }
+        if self.started is not None:
+            data.update(self.timings or self.handler.timings())
+        if self.status == 'done':
+            data["result"] = self.result
+        if self.error is not None:
+            data["error"] = self.error
+        return data
+
+class JobStore:
+    '''
+    In-memory store of jobs. Finished jobs are dropped ttl seconds after they end.
+    '''
+
+    def __init__(self, ttl:float=None):
+        self.ttl = ttl if ttl is not None else Config.JOB_TTL
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _cleanup(self):
+        now = time.time()
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job.finished is not None and now - job.finished > self.ttl
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def create(self, question:str=None, session_id:int=None, model_config:str=None, client:str=None, priority:int=0, store:bool=True):
+        '''
+        Method to queue a generation as a job and return it right away.
+            - Raises SchedulerError if the queue is full.
+        '''
+        self._cleanup()
+        job = Job(owner=client, question=question, session_id=session_id, model_config=model_config)
+        model = model_manager.get(model_config)
+
+        def run():
+            job.status = 'running'
+            job.started = time.time()
+            job.handler.start_time = job.started
+            try:
+                job.result = generate_answer(
+                    question=question,
+                    session_id=session_id,
+                    callbacks=[job.handler],
+                    store=store,
+                    model=model
+                    )
+                job.status = 'done'
+            except GenerationCancelled:
+                job.status = 'cancelled'
+            except Exception as e:
+                job.status = 'failed'
+                job.error = str(e)
+            finally:
+                job.timings = job.handler.timings()
+                job.finished = time.time()
+
+        def finished(future):
+            # Jobs that never ran: cancelled while queued, or dropped by the scheduler
+            if future.cancelled():
+                job.status = 'cancelled'
+            elif future.exception() is not None:
+                job.status = 'failed'
+                job.error = str(future.exception())
+            if job.finished is None:
+                job.finished = time.time()
+
+        job.future = scheduler.submit(run, client=client, priority=priority, model=model, session=session_id)
+        job.future.add_done_callback(finished)
+
+        with self._lock:
+            self._jobs[job.id] = job
+
+        logger.debug('Job %s queued', job.id)
+
+        return job
+
+    def get(self, job_id:str=None):
+        '''
+        Method to get a job, or None if it does not exist or expired.
+        '''
+        self._cleanup()
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id:str=None):
+        '''
+        Method to cancel a job. A queued job is removed from the queue, a running one stops at its next token.
+        '''
+        job = self.get(job_id)
+        if job is None:
+            return None
+        if job.finished is None:
+            # A queued job leaves the queue right away, a running one is stopped by its handler
+            if not scheduler.cancel(job.future):
+                job.handler.cancelled.set()
+            logger.info('Job %s cancelled', job.id)
+        return job
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in ('queued', 'running', 'done', 'failed', 'cancelled')}
+
+job_store = JobStore()
@@ -1,23 +1,135 @@
 import os
 import json
+import fcntl
+import threading
+from functools import lru_cache
 from langchain.llms import LlamaCpp
-from colorama import Fore as c
+from utils.logger import get_logger
+from utils.config import Config
+from utils.model_registry import model_registry, MODELS_DIR
+from utils.speculative import load_draft_model, check_draft_model, draft_settings
 
-def load_model():
+logger = get_logger('models')
+
+CONFIG_PATH = 'data/config.json'
+
+_config_cache = {"signature": None, "config": None}
+_config_lock = threading.Lock()
+
+def read_config():
     '''
-    Method to load the model. Gets the model name from config.json.
+    Method to get the content of config.json. The file is parsed again only when it changes on disk.
     '''
-    
-    print(f'\n[ {c.CYAN}MODEL{c.RESET} ] Loading model...\n')
+    stat = os.stat(CONFIG_PATH)
+    signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+    if signature != _config_cache["signature"]:
+        with _config_lock:
+            if signature != _config_cache["signature"]:
+                with open(CONFIG_PATH, 'r') as f:
+                    _config_cache["config"] = json.load(f)
+                _config_cache["signature"] = signature
+
+    return _config_cache["config"]
+
+@lru_cache(maxsize=1)
+def physical_cores():
+    '''
+    Method to get the number of physical CPU cores available to the process (hyper-threads are not counted).
+    '''
+    try:
+        available = os.sched_getaffinity(0)
+    except AttributeError:
+        available = None
+
+    try:
+        cores = set()
+        processor = None
+        physical_id = None
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                key = key.strip()
+                if key == 'processor':
+                    processor = int(value)
+                elif key == 'physical id':
+                    physical_id = value.strip()
+                elif key == 'core id' and (available is None or processor in available):
+                    cores.add((physical_id, value.strip()))
+        if cores:
+            return len(cores)
+    except (OSError, ValueError):
+        pass
+
+    return len(available) if available else (os.cpu_count() or 1)
+
+def slot_count(model_config:dict=None):
+    '''
+    Method to get the number of decoding slots of a model config: llama.cpp contexts that generate at the same time
+    over one mapped copy of the weights. Config.LLAMA_SLOTS, then slots in the model config, 1 by default.
+    '''
+    slots = Config.LLAMA_SLOTS
+    if slots is None:
+        slots = model_config.get("slots")
+    if slots is None:
+        slots = 1
+    if type(slots) != int or slots < 1:
+        raise ValueError(f'slots must be a positive integer, got {slots!r}')
+    return slots
+
+def performance_settings(model_config:dict=None):
+    '''
+    Method to get the llama.cpp performance settings of a model config. Where:
+        - model_config: model config from config.json
+    Values come from Config.LLAMA_OVERRIDES, then the model config, then the defaults. Raises ValueError if a value is not valid.
+        - By default the physical cores are split between the slots of the model.
+    '''
+    slots = slot_count(model_config)
+    defaults = {
+        "n_threads": max(1, physical_cores() // slots),
+        "n_batch": 512,
+        "use_mmap": True,
+        "use_mlock": False,
+        "seed": -1,
+        "f16_kv": True,
+        "n_gpu_layers": 0
+    }
+
+    settings = {}
+    for key, default in defaults.items():
+        value = Config.LLAMA_OVERRIDES.get(key)
+        if value is None:
+            value = model_config.get(key)
+        if value is None:
+            value = default
+        if type(value) != type(default):
+            raise ValueError(f'{key} must be of type {type(default).__name__}, got {value!r}')
+        settings[key] = value
+
+    if settings["n_threads"] < 1:
+        raise ValueError(f'n_threads must be at least 1, got {settings["n_threads"]}')
+    if not 1 <= settings["n_batch"] <= model_config['n_ctx']:
+        raise ValueError(f'n_batch must be between 1 and n_ctx ({model_config["n_ctx"]}), got {settings["n_batch"]}')
+    if settings["n_gpu_layers"] < 0:
+        raise ValueError(f'n_gpu_layers must be 0 or more, got {settings["n_gpu_layers"]}')
+    if slots > 1 and not settings["use_mmap"]:
+        raise ValueError('use_mmap is needed for more than one slot, so the slots share one copy of the weights')
 
-    # Read model name from config.json
-    with open('data/config.json', 'r') as f:
-        config = json.load(f)
+    return settings
 
-    model_name = config['SelectedModel']
+def load_model(model_config_name:str=None):
+    '''
+    Method to load the model. Where:
+        - model_config_name: name of the model config in config.json. By default the SelectedModel.
+    '''
+    
+    # Read model config from config.json
+    config = read_config()
+
+    model_name = model_config_name or config['SelectedModel']
     model_config = config[model_name]
 
-    model_path = f'./models/{model_config["model"]}'
+    model_path = os.path.join(MODELS_DIR, model_config["model"])
     n_ctx = model_config['n_ctx']
     temperature = model_config['temperature']
     max_tokens = model_config['max_tokens']
@@ -26,6 +138,15 @@ def load_model():
     verbose = model_config['verbose']
     template = model_config['template']
     repeat_penalty = model_config['repeat_penalty']
+    settings = performance_settings(model_config)
+
+    logger.info('Loading model %s', model_name, extra={"model": model_config['model'], "settings": settings})
+
+    # Speculative decoding: the draft model is passed to llama_cpp.Llama through model_kwargs
+    model_kwargs = {}
+    draft_model = load_draft_model(name=model_name, model_config=model_config, settings=settings)
+    if draft_model is not None:
+        model_kwargs["draft_model"] = draft_model
 
     llm = LlamaCpp(
         model_path=model_path, 
@@ -36,29 +157,61 @@ def load_model():
         top_k=top_k,
         verbose=verbose,
         repeat_penalty=repeat_penalty,
-        echo=True
+        echo=True,
+        streaming=True,
+        model_kwargs=model_kwargs,
+        **settings
         )
+    check_draft_model(llm)
     
-    print(f'\n[ {c.GREEN}MODEL{c.RESET} ] Model loaded\n')
+    logger.info('Model %s loaded', model_name)
 
     return llm, template
 
-def get_models():
+def get_model_configs():
     '''
-    Method to get the models available in the models folder.
+    Method to get the model configs of config.json with their resolved llama.cpp performance settings.
     '''
-    # Check if models folder exists
-    if not os.path.isdir('./models'):
-        os.mkdir('./models')
+    config = read_config()
+    configs = {}
+    for name in config:
+        if name == 'SelectedModel':
+            continue
+        try:
+            settings = performance_settings(config[name])
+            slots = slot_count(config[name])
+        except ValueError as e:
+            settings = {"error": str(e)}
+            slots = None
+        try:
+            draft = draft_settings(config[name])
+        except ValueError as e:
+            draft = {"error": str(e)}
+        configs[name] = {
+            "model": config[name]['model'],
+            "n_ctx": config[name]['n_ctx'],
+            "performance": settings,
+            "slots": slots,
+            "draft_model": draft
+        }
+    return configs
 
-    # Check files in models folder
-    print(f'\n[ {c.CYAN}MODEL{c.RESET} ] Getting models...')
-    models = []
-    for file in os.listdir('./models'):
-        models.append(file)
-    print(f'[ {c.GREEN}MODEL{c.RESET} ] Models obtained')
+def get_models():
+    '''
+    Method to get the models available in the models folder, with the metadata of their headers (see utils/model_registry.py).
+    '''
+    return model_registry.models()
 
-    return models
+def check_context(model_name:str=None, n_ctx:int=None):
+    '''
+    Method to check that n_ctx fits in the context the model was trained with. Returns an error message, or None
+    if it fits (or the model does not report its context length).
+    '''
+    metadata = model_registry.get(model_name) or {}
+    context_length = metadata.get("context_length")
+    if context_length and n_ctx > context_length:
+        return f'n_ctx {n_ctx} is larger than the context length of {model_name} ({context_length})'
+    return None
 
 def set_model(model_config_name:str, model_name:str): 
     '''
@@ -66,34 +219,42 @@ def set_model(model_config_name:str, model_name:str):
         - model_name: name of the model. You can get the models with get_models()
     '''
 
-    print(f'\n[ {c.CYAN}MODEL{c.RESET} ] Setting up model {model_name}')
     try:
-        models = get_models()
         # Check if model exists
-        if model_name not in models:
-            print(f'\n[ {c.RED}MODEL{c.RESET} ] Model {model_name} does not exist')
+        if model_registry.get(model_name) is None:
+            logger.warning('Model %s does not exist', model_name)
             return f'Model {model_name} does not exist'
         
-        # Write the model name in config.json
-        with open('data/config.json', 'r') as f:
-            config = json.load(f)
-
-        config_models = list(config.keys())
-        config_models.pop(0)
-
-        if model_config_name in config_models:
-            config['SelectedModel'] = model_config_name
-        else:
-            print(f'\n[ {c.RED}MODEL{c.RESET} ] Model {model_config_name} is not configured in config.json')
-            return f'Model {model_config_name} not configured in config.json'
-        
-        config[model_config_name]['model'] = model_name
-        with open('data/config.json', 'w') as f:
-            json.dump(config, f, indent=4)
-        
-        print(f'\n[ {c.GREEN}MODEL{c.RESET} ] Model {model_name} set up correctly')
+        # Write the model name in config.json. The lock file serializes writers of every process, and os.replace makes
+        # the workers that poll read_config see the old or the new file, never a partial one
+        with open(CONFIG_PATH + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            with open(CONFIG_PATH, 'r') as f:
+                config = json.load(f)
+
+            config_models = list(config.keys())
+            config_models.pop(0)
+
+            if model_config_name in config_models:
+                config['SelectedModel'] = model_config_name
+            else:
+                logger.warning('Model %s is not configured in config.json', model_config_name)
+                return f'Model {model_config_name} not configured in config.json'
+
+            error = check_context(model_name=model_name, n_ctx=config[model_config_name]['n_ctx'])
+            if error:
+                logger.warning(error)
+                return error
+
+            config[model_config_name]['model'] = model_name
+            with open(CONFIG_PATH + '.tmp', 'w') as f:
+                json.dump(config, f, indent=4)
+            os.replace(CONFIG_PATH + '.tmp', CONFIG_PATH)
+
+        logger.info('Model %s set up in %s', model_name, model_config_name)
 
         return True
-    except Exception as e:
-        print(e)
+    except Exception:
+        logger.exception('Error setting up model %s', model_name)
         return False
\ No newline at end of file
@@ -0,0 +1,131 @@
+import sys
+import json
+import queue
+import atexit
+import logging
+import datetime
+import threading
+import contextvars
+import logging.handlers
+from colorama import Fore as c
+from utils.config import Config
+
+LEVEL_COLORS = {
+    'DEBUG': c.WHITE,
+    'INFO': c.GREEN,
+    'WARNING': c.YELLOW,
+    'ERROR': c.RED,
+    'CRITICAL': c.RED
+}
+
+# Attributes of every LogRecord, the others come from extra={...}
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'request_id'}
+
+_request_id = contextvars.ContextVar('request_id', default=None)
+
+def set_request_id(request_id:str=None):
+    '''
+    Method to set the correlation id of the current request. Jobs of the inference worker keep the id of the
+    request that queued them.
+    '''
+    _request_id.set(request_id)
+
+def get_request_id():
+    return _request_id.get()
+
+class RequestIdFilter(logging.Filter):
+    '''
+    Adds the correlation id of the current request to every record, in the thread that logs it.
+    '''
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+def _extra(record:logging.LogRecord=None):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+class JSONFormatter(logging.Formatter):
+    '''
+    One JSON object per line, with the fields passed in extra={...}.
+    '''
+
+    def format(self, record):
+        data = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, 'request_id', None):
+            data["request_id"] = record.request_id
+        data.update(_extra(record))
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    '''
+    Human readable lines: [ LEVEL ] logger (request id) message key=value...
+    '''
+
+    def __init__(self, color:bool=False):
+        super().__init__()
+        self.color = color
+
+    def format(self, record):
+        level = f'{LEVEL_COLORS.get(record.levelname, "")}{record.levelname}{c.RESET}' if self.color else record.levelname
+        line = f'[ {level} ] {record.name}'
+        if getattr(record, 'request_id', None):
+            line += f' ({record.request_id})'
+        line += f' {record.getMessage()}'
+        extra = _extra(record)
+        if extra:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in extra.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+_listener = None
+_setup_lock = threading.Lock()
+
+def setup_logging(level:str=None, format:str=None):
+    '''
+    Method to configure the loggers of the server once per process. Where:
+        - level: Config.LOG_LEVEL by default
+        - format: 'text' or 'json', Config.LOG_FORMAT by default
+    Records are put in a queue and written to stdout by a background thread, so a request never waits on the output.
+    '''
+    global _listener
+
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        level = (level or Config.LOG_LEVEL).upper()
+        format = format or Config.LOG_FORMAT
+
+        stream = logging.StreamHandler(sys.stdout)
+        if format == 'json':
+            stream.setFormatter(JSONFormatter())
+        else:
+            stream.setFormatter(TextFormatter(color=sys.stdout.isatty()))
+
+        records = queue.SimpleQueue()
+        handler = logging.handlers.QueueHandler(records)
+        handler.addFilter(RequestIdFilter())
+
+        logger = logging.getLogger('llm_api')
+        logger.setLevel(level)
+        logger.addHandler(handler)
+        logger.propagate = False
+
+        _listener = logging.handlers.QueueListener(records, stream)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+def get_logger(name:str=None):
+    '''
+    Method to get the logger of a module, e.g. get_logger('sessions').
+    '''
+    return logging.getLogger(f'llm_api.{name}')
@@ -0,0 +1,115 @@
+import time
+import threading
+from collections import OrderedDict
+from langchain.memory import ChatMessageHistory
+from utils.logger import get_logger
+from utils.config import Config
+from utils.sessions import load_session
+from utils.history import TokenBudgetMemory
+
+logger = get_logger('memory_cache')
+
+class SessionMemoryCache:
+    '''
+    Bounded LRU cache of conversation memories keyed by session_id.
+        - On a miss the memory is rebuilt from the session store with load_session.
+        - Entries are evicted when the cache is over max_sessions (least recently used first) or idle for longer than ttl seconds.
+        - Turns are written to the session store by save_session as they happen, so evicting an entry never loses history.
+        - Each memory keeps the last max_messages of its session. The messages sent to the model are chosen by token budget
+          (see TokenBudgetMemory).
+    '''
+
+    def __init__(self, max_sessions:int=None, ttl:float=None, max_messages:int=None):
+        self.max_sessions = max_sessions if max_sessions is not None else Config.MEMORY_CACHE_SIZE
+        self.ttl = ttl if ttl is not None else Config.MEMORY_CACHE_TTL
+        self.max_messages = max_messages if max_messages is not None else Config.SESSION_LOAD_LIMIT
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _new_memory(self, session_id:int=None):
+        if session_id is None:
+            session = ChatMessageHistory()
+        else:
+            session = load_session(session_id=session_id, limit=self.max_messages)
+        return TokenBudgetMemory(
+            max_messages=self.max_messages,
+            memory_key="chat_history",
+            chat_memory=session
+            )
+
+    def _expire(self, now:float=None):
+        if not self.ttl:
+            return
+        while self._entries:
+            session_id, (memory, last_used) = next(iter(self._entries.items()))
+            if now - last_used <= self.ttl:
+                break
+            del self._entries[session_id]
+            self.expirations += 1
+
+    def get(self, session_id:int=None):
+        '''
+        Method to get the memory of a session, loading it from the session store if it is not cached. Where:
+            - session_id: id of the session, None for a memory that is not saved
+        Requests without a session get a new empty memory each time, it is never cached (it would be shared by all of them).
+        '''
+        if session_id is None:
+            return self._new_memory(session_id=None)
+
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                self._entries[session_id] = (entry[0], now)
+                self._entries.move_to_end(session_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # Load outside the lock so a slow read does not block other sessions
+        memory = self._new_memory(session_id=session_id)
+
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                # Another request loaded it first
+                memory = entry[0]
+            self._entries[session_id] = (memory, now)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_sessions:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        logger.debug('Session %s loaded into memory cache', session_id)
+
+        return memory
+
+    def invalidate(self, session_id:int=None):
+        '''
+        Method to drop a session from the cache.
+        '''
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def stats(self):
+        '''
+        Method to get the counters of the cache.
+        '''
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_sessions": self.max_sessions,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+memory_cache = SessionMemoryCache()
@@ -0,0 +1,220 @@
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Seconds, from a fast auth check to a long generation
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _format_labels(names:tuple=None, values:tuple=None, extra:str=None):
+    pairs = [
+        f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in zip(names or (), values or ())
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value:float=None):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric:
+    '''
+    Base class of the metrics, exported in the Prometheus text format.
+    '''
+
+    kind = 'untyped'
+
+    def __init__(self, name:str=None, help:str=None, labelnames:tuple=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels:dict=None):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{labels} {_format_value(value)}')
+        return '\n'.join(lines)
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def __init__(self, name:str=None, help:str=None, labelnames:tuple=()):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+
+    def inc(self, amount:float=1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [('', _format_labels(self.labelnames, key), value) for key, value in values.items()]
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name:str=None, help:str=None, labelnames:tuple=(), buckets:tuple=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+
+    def observe(self, value:float=None, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        samples = []
+        for key, (counts, total, count) in values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(bound) + '"'
+                samples.append(('_bucket', _format_labels(self.labelnames, key, le), cumulative))
+            samples.append(('_sum', _format_labels(self.labelnames, key), total))
+            samples.append(('_count', _format_labels(self.labelnames, key), count))
+        return samples
+
+class Gauge(Metric):
+    '''
+    Gauge read when the metrics are collected. fn returns a number, or a dict of label values (tuple) -> number.
+    '''
+
+    kind = 'gauge'
+
+    def __init__(self, name:str=None, help:str=None, labelnames:tuple=(), fn=None):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def samples(self):
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [
+            ('', _format_labels(self.labelnames, key if isinstance(key, tuple) else (key,)), value)
+            for key, value in values.items() if value is not None
+        ]
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric:Metric=None):
+        '''
+        Method to add a metric, or get the one already registered with the same name.
+        '''
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        '''
+        Method to get all the metrics in the Prometheus text format.
+        '''
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+registry = Registry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    'llm_api_stage_seconds',
+    'Time spent in each stage of a request (auth, queue, session_load, prompt_render, prefill, generation, session_save)',
+    ('stage',)
+))
+REQUEST_SECONDS = registry.register(Histogram(
+    'llm_api_request_seconds',
+    'Time to the response of each request, by endpoint and status',
+    ('method', 'endpoint', 'status')
+))
+AUTH_REQUESTS = registry.register(Counter('llm_api_auth_requests_total', 'API key checks by result', ('result',)))
+PROMPT_TOKENS = registry.register(Counter('llm_api_prompt_tokens_total', 'Prompt tokens sent to the model', ('model',)))
+COMPLETION_TOKENS = registry.register(Counter('llm_api_completion_tokens_total', 'Tokens generated by the model', ('model',)))
+TOKENS_PER_SECOND = registry.register(Histogram(
+    'llm_api_tokens_per_second',
+    'Generation speed of each answer',
+    ('model',),
+    buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200, 500)
+))
+
+class RequestTimings:
+    '''
+    Stage timings of one request, reported in its Server-Timing header.
+        - Stages that run on the inference worker are added to the timings of the request that queued them
+          (the scheduler runs each job in the context of its request).
+    '''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage:str=None, seconds:float=None):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self):
+        '''
+        Method to get the value of the Server-Timing header, in milliseconds.
+        '''
+        with self._lock:
+            stages = list(self.stages.items())
+        stages.append(('total', time.perf_counter() - self.start))
+        return ', '.join(f'{stage};dur={seconds * 1000:.2f}' for stage, seconds in stages)
+
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+def start_request():
+    '''
+    Method to start the timings of a new request in the current context.
+    '''
+    timings = RequestTimings()
+    _request_timings.set(timings)
+    return timings
+
+def current_request():
+    return _request_timings.get()
+
+def observe_stage(stage:str=None, seconds:float=None):
+    '''
+    Method to record the time of a stage in the histogram and in the timings of the current request, if any.
+    '''
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+@contextmanager
+def timed(stage:str=None):
+    '''
+    Context manager to time a stage with observe_stage.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
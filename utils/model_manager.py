@@ -0,0 +1,410 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from langchain.prompts import PromptTemplate
+from langchain.chains import LLMChain
+from utils.logger import get_logger
+from utils.config import Config
+from utils.load_model import load_model, read_config, slot_count
+from utils.scheduler import scheduler
+from utils.prompt_cache import enable_prompt_cache, prompt_cache_stats
+from utils.speculative import speculative_stats
+
+logger = get_logger('models')
+
+class Slot:
+    '''
+    A decoding slot of a model: one LlamaCpp instance (llama.cpp context and KV cache) and its chain.
+    '''
+
+    def __init__(self, index:int=0, llm=None, prompt:PromptTemplate=None):
+        self.index = index
+        self.llm = llm
+        self.chain = LLMChain(prompt=prompt, llm=llm, verbose=Config.LLM_VERBOSE)
+
+class LoadedModel:
+    '''
+    A model config of config.json with its loaded LlamaCpp instances, and its prompt and chains.
+        - The chain has no memory, the history of each request is passed to predict. A change of the config in
+          config.json loads a new LoadedModel, so the chain is rebuilt with it.
+        - Each of the slots of the model generates one answer at a time. All of them map the same model file, so
+          the weights are in memory once and only the contexts (KV caches) are per slot.
+        - A session goes back to the slot that answered it last when it is free, where its prompt is still in the
+          KV cache and the prompt cache.
+    '''
+
+    def __init__(self, name:str=None, config:dict=None, llm=None, template:str=None, load_time:float=0.0, llms:list=None):
+        self.name = name
+        self.config = config
+        self.template = template
+        self.prompt = PromptTemplate(template=template, input_variables=["chat_history", "input"])
+        self.slots = [Slot(index=i, llm=slot_llm, prompt=self.prompt) for i, slot_llm in enumerate(llms or [llm])]
+        # The first slot is used to count tokens and for the stats
+        self.llm = self.slots[0].llm
+        self.chain = self.slots[0].chain
+        self._free = list(self.slots)
+        self._slots_cond = threading.Condition()
+        self._affinity = OrderedDict()
+        self.busy_slots = 0
+        self.max_busy_slots = 0
+        self.slot_waits = 0
+        self.affinity_hits = 0
+        self.load_time = load_time
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.warmup_time = 0.0
+        self.prompt_cache = []
+        self._token_counts = OrderedDict()
+        self._token_lock = threading.Lock()
+        self._template_tokens = None
+        self.token_count_hits = 0
+        self.token_count_misses = 0
+        self.generated_tokens = 0
+        self.generation_time = 0.0
+        self._generation_lock = threading.Lock()
+        model_path = f'./models/{config["model"]}'
+        self.size_bytes = os.path.getsize(model_path) if os.path.isfile(model_path) else 0
+        # The draft model of speculative decoding is resident with the model, each slot loads its own
+        for slot in self.slots:
+            draft = getattr(getattr(slot.llm, 'client', None), 'draft_model', None)
+            self.size_bytes += getattr(draft, 'size_bytes', 0)
+
+    @contextmanager
+    def slot(self, session_id:int=None):
+        '''
+        Context manager to take a free slot of the model for a generation, waiting for one if all are busy. Where:
+            - session_id: the slot that answered this session last is preferred
+        '''
+        with self._slots_cond:
+            if not self._free:
+                self.slot_waits += 1
+                while not self._free:
+                    self._slots_cond.wait()
+            slot = self._free[0]
+            preferred = self._affinity.get(session_id) if session_id is not None else None
+            if preferred is not None and preferred in self._free:
+                slot = preferred
+                self.affinity_hits += 1
+            self._free.remove(slot)
+            self.busy_slots += 1
+            self.max_busy_slots = max(self.max_busy_slots, self.busy_slots)
+        try:
+            yield slot
+        finally:
+            with self._slots_cond:
+                if session_id is not None:
+                    self._affinity[session_id] = slot
+                    self._affinity.move_to_end(session_id)
+                    while len(self._affinity) > Config.MEMORY_CACHE_SIZE:
+                        self._affinity.popitem(last=False)
+                self._free.append(slot)
+                self.busy_slots -= 1
+                self._slots_cond.notify()
+
+    def record_generation(self, tokens:int=0, seconds:float=0.0):
+        with self._generation_lock:
+            self.generated_tokens += tokens
+            self.generation_time += seconds
+
+    def count_tokens(self, text:str=None, cache:bool=True):
+        '''
+        Method to count the tokens of a text with the tokenizer of the model.
+            - Counts are cached (LRU of Config.TOKEN_COUNT_CACHE_SIZE texts), so the stored messages of a session
+              are only tokenized once. Texts that do not repeat (e.g. whole prompts) are counted with cache=False.
+        '''
+        if cache:
+            with self._token_lock:
+                count = self._token_counts.get(text)
+                if count is not None:
+                    self._token_counts.move_to_end(text)
+                    self.token_count_hits += 1
+                    return count
+                self.token_count_misses += 1
+
+        client = getattr(self.llm, 'client', None)
+        if client is not None:
+            count = len(client.tokenize(text.encode('utf-8'), add_bos=False))
+        else:
+            count = self.llm.get_num_tokens(text)
+
+        if cache:
+            with self._token_lock:
+                self._token_counts[text] = count
+                while len(self._token_counts) > Config.TOKEN_COUNT_CACHE_SIZE:
+                    self._token_counts.popitem(last=False)
+        return count
+
+    def template_tokens(self):
+        '''
+        Method to get the tokens of the template without history and question, counted once per model.
+        '''
+        if self._template_tokens is None:
+            self._template_tokens = self.count_tokens(self.template.format(chat_history="", input="")) + 1
+        return self._template_tokens
+
+    def history_budget(self, question:str=None):
+        '''
+        Method to get the tokens of chat history that can be sent with a question. Where:
+            - history_tokens in config.json is the budget of the profile (half of n_ctx by default)
+            - the budget never goes over what is left of n_ctx after the template and the question
+        '''
+        n_ctx = self.config.get("n_ctx", 512)
+        budget = self.config.get("history_tokens")
+        if budget is None:
+            budget = n_ctx // 2
+        free = n_ctx - self.template_tokens() - self.count_tokens(question or "")
+        return max(0, min(budget, free))
+
+    def stats(self):
+        return {
+            "model": self.config["model"],
+            "size_bytes": self.size_bytes,
+            "load_time": self.load_time,
+            "warmup_time": self.warmup_time,
+            "template_tokens": self._template_tokens,
+            "token_count_cache": {
+                "size": len(self._token_counts),
+                "hits": self.token_count_hits,
+                "misses": self.token_count_misses
+            },
+            "loaded_at": self.loaded_at,
+            "last_used": self.last_used,
+            "prompt_cache": prompt_cache_stats(llms=[slot.llm for slot in self.slots], stats=self.prompt_cache),
+            "slots": {
+                "count": len(self.slots),
+                "busy": self.busy_slots,
+                "max_busy": self.max_busy_slots,
+                "waits": self.slot_waits,
+                "affinity_hits": self.affinity_hits
+            },
+            "tokens_per_second": self.generated_tokens / self.generation_time if self.generation_time else None,
+            "speculative": speculative_stats(self.llm)
+        }
+
+class ModelManager:
+    '''
+    Pool of loaded models, keyed by model config name.
+        - The selected model is preloaded and warmed up at startup, so the first request does not pay the load.
+        - Other configs are loaded on demand and kept resident while the sum of their file sizes fits in memory_budget.
+          The least recently used one is dropped first, never the selected one.
+        - switch loads the new model in the background and only then makes it the selected one. Requests that already
+          hold the previous model keep it until they finish.
+        - A resident model whose config changed keeps serving until its new config is loaded in the background.
+    '''
+
+    def __init__(self, memory_budget:int=None):
+        self.memory_budget = memory_budget if memory_budget is not None else Config.MODEL_MEMORY_BUDGET
+        self.models = OrderedDict()
+        self.selected = None
+        self._configured = None
+        self.switching = None
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._reloading = set()
+        self.loads = 0
+        self.evictions = 0
+        self.total_load_time = 0.0
+
+    def selected_name(self):
+        '''
+        Method to get the name of the selected model config.
+        '''
+        configured = read_config()['SelectedModel']
+        if self.selected is None:
+            self.selected = configured
+        elif configured != self._configured and configured != self.selected and configured != self.switching:
+            # config.json was changed by another process (or by hand): follow it
+            self.switch(configured)
+        self._configured = configured
+        return self.selected
+
+    def _resident(self, name:str=None, config:dict=None):
+        # A resident model is only valid while its config in config.json does not change
+        entry = self.models.get(name)
+        if entry is not None and entry.config == config:
+            self.models.move_to_end(name)
+            entry.last_used = time.time()
+            return entry
+        return None
+
+    def get(self, name:str=None):
+        '''
+        Method to get a loaded model, loading it if it is not resident. Where:
+            - name: name of the model config in config.json. By default the selected one.
+        If the config changed since the model was loaded (e.g. POST /models/model set another model file), the
+        resident model keeps serving while the new one loads in the background.
+        '''
+        name = name or self.selected_name()
+        config = read_config()
+        if name == 'SelectedModel' or name not in config:
+            raise ValueError(f'Model {name} not configured in config.json')
+
+        with self._lock:
+            entry = self._resident(name, config[name])
+            if entry is not None:
+                return entry
+            entry = self.models.get(name)
+            if entry is not None:
+                self.models.move_to_end(name)
+                entry.last_used = time.time()
+                self.reload(name)
+                return entry
+
+        return self.load(name)
+
+    def load(self, name:str=None):
+        '''
+        Method to load a model config in the calling thread, unless it is resident with its current config. The entry
+        in the pool is replaced only once the new model is ready.
+        '''
+        with self._lock:
+            loading = self._loading.setdefault(name, threading.Lock())
+
+        with loading:
+            config = read_config()[name]
+            with self._lock:
+                entry = self._resident(name, config)
+                if entry is not None:
+                    return entry
+
+            entry = self._load(name, config)
+
+            with self._lock:
+                self.models[name] = entry
+                self._evict(keep=name)
+
+        return entry
+
+    def reload(self, name:str=None):
+        '''
+        Method to load the current config of a resident model in a background thread, once at a time per config.
+        '''
+        if name in self._reloading:
+            return None
+
+        def run():
+            try:
+                self.load(name)
+            except Exception as e:
+                logger.error('Error reloading model %s: %s', name, e)
+            finally:
+                self._reloading.discard(name)
+
+        self._reloading.add(name)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def _load(self, name:str=None, config:dict=None):
+        start_time = time.time()
+        llms = []
+        for _ in range(slot_count(config)):
+            llm, template = load_model(model_config_name=name)
+            llms.append(llm)
+        entry = LoadedModel(name=name, config=config, template=template, load_time=time.time() - start_time, llms=llms)
+
+        # One inference worker per slot, so the slots generate at the same time
+        scheduler.ensure_workers(len(entry.slots))
+
+        # The slots share the mapped weights, warming up one of them pages them in for all
+        self.warmup(entry)
+
+        # Prefill the static prefix of every template configured for this model file
+        all_configs = read_config()
+        templates = [template] + [
+            all_configs[key]['template'] for key in all_configs
+            if key != 'SelectedModel' and all_configs[key].get('model') == config['model']
+        ]
+        # PROMPT_CACHE_BYTES is the RAM of the prompt cache of the model, split between its slots. The disk caches of
+        # the slots share one folder, each one with the whole capacity
+        capacity = Config.PROMPT_CACHE_BYTES
+        if Config.PROMPT_CACHE_TYPE != 'disk':
+            capacity //= len(entry.slots)
+        entry.prompt_cache = [
+            enable_prompt_cache(llm=slot.llm, templates=templates, capacity_bytes=capacity) for slot in entry.slots
+        ]
+        # The RAM caches are resident with the model
+        entry.size_bytes += sum(cache["capacity_bytes"] for cache in entry.prompt_cache if cache["type"] == 'ram')
+
+        self.loads += 1
+        self.total_load_time += entry.load_time
+
+        return entry
+
+    def warmup(self, entry:LoadedModel=None):
+        '''
+        Method to run a short generation on a loaded model, so its weights are paged in before the first request.
+        '''
+        if not Config.MODEL_WARMUP_TOKENS:
+            return
+        start_time = time.time()
+        try:
+            entry.llm.client.create_completion(prompt=Config.MODEL_WARMUP_PROMPT, max_tokens=Config.MODEL_WARMUP_TOKENS)
+        except Exception as e:
+            logger.warning('Warmup of %s failed: %s', entry.name, e)
+            return
+        entry.warmup_time = time.time() - start_time
+        logger.info('Model %s warmed up', entry.name, extra={"duration": round(entry.warmup_time, 3)})
+
+    def _evict(self, keep:str=None):
+        used = sum(entry.size_bytes for entry in self.models.values())
+        for name in list(self.models.keys()):
+            if self.memory_budget and used <= self.memory_budget:
+                break
+            if name in (keep, self.selected):
+                continue
+            entry = self.models.pop(name)
+            used -= entry.size_bytes
+            self.evictions += 1
+            logger.info('Model %s unloaded', name)
+
+    def preload(self, names:list=None):
+        '''
+        Method to load and warm up the selected model and the configs in names (Config.MODEL_PRELOAD by default).
+        '''
+        names = [self.selected_name()] + list(names if names is not None else Config.MODEL_PRELOAD)
+        for name in dict.fromkeys(names):
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.error('Error preloading model %s: %s', name, e)
+
+    def switch(self, name:str=None):
+        '''
+        Method to change the selected model. The model is loaded in a background thread and selected once it is ready.
+        '''
+        def run():
+            try:
+                self.load(name)
+                with self._lock:
+                    self.selected = name
+                    self._evict(keep=name)
+                logger.info('Model %s selected', name)
+            except Exception as e:
+                logger.error('Error switching to model %s: %s', name, e)
+            finally:
+                self.switching = None
+
+        self.switching = name
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        '''
+        Method to get the resident models and the counters of the pool.
+        '''
+        return {
+            "selected": self.selected,
+            "switching": self.switching,
+            "reloading": sorted(self._reloading),
+            "memory_budget": self.memory_budget,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "total_load_time": self.total_load_time,
+            "resident": {name: entry.stats() for name, entry in list(self.models.items())}
+        }
+
+model_manager = ModelManager()
@@ -0,0 +1,233 @@
+import os
+import time
+import struct
+import threading
+from utils.logger import get_logger
+from utils.config import Config
+
+logger = get_logger('models')
+
+MODELS_DIR = './models'
+
+GGUF_MAGIC = b'GGUF'
+
+# GGUF metadata value types: struct format of the scalar ones
+_SCALARS = {0: '<B', 1: '<b', 2: '<H', 3: '<h', 4: '<I', 5: '<i', 6: '<f', 7: '<?', 10: '<Q', 11: '<q', 12: '<d'}
+_STRING = 8
+_ARRAY = 9
+
+# general.file_type (llama_ftype of llama.cpp)
+FILE_TYPES = {
+    0: 'F32', 1: 'F16', 2: 'Q4_0', 3: 'Q4_1', 7: 'Q8_0', 8: 'Q5_0', 9: 'Q5_1', 10: 'Q2_K', 11: 'Q3_K_S', 12: 'Q3_K_M',
+    13: 'Q3_K_L', 14: 'Q4_K_S', 15: 'Q4_K_M', 16: 'Q5_K_S', 17: 'Q5_K_M', 18: 'Q6_K', 19: 'IQ2_XXS', 20: 'IQ2_XS',
+    21: 'Q2_K_S', 22: 'IQ3_XS', 23: 'IQ3_XXS', 24: 'IQ1_S', 25: 'IQ4_NL', 26: 'IQ3_S', 27: 'IQ3_M', 28: 'IQ2_S',
+    29: 'IQ2_M', 30: 'IQ4_XS', 31: 'IQ1_M', 32: 'BF16'
+}
+
+# ggml_type of the tensors, for files without general.file_type
+TENSOR_TYPES = {
+    0: 'F32', 1: 'F16', 2: 'Q4_0', 3: 'Q4_1', 6: 'Q5_0', 7: 'Q5_1', 8: 'Q8_0', 9: 'Q8_1', 10: 'Q2_K', 11: 'Q3_K',
+    12: 'Q4_K', 13: 'Q5_K', 14: 'Q6_K', 15: 'Q8_K', 30: 'BF16'
+}
+
+class GGUFReader:
+    '''
+    Reader of the header of a GGUF file: the metadata key/values and the tensor infos, without the tensor data.
+    '''
+
+    def __init__(self, f=None):
+        self.f = f
+        self.version = None
+
+    def _unpack(self, fmt:str=None):
+        size = struct.calcsize(fmt)
+        data = self.f.read(size)
+        if len(data) != size:
+            raise ValueError('Unexpected end of the GGUF header')
+        return struct.unpack(fmt, data)[0]
+
+    def _count(self):
+        # Version 1 used 32-bit counts and string lengths
+        return self._unpack('<I' if self.version == 1 else '<Q')
+
+    def _string(self):
+        length = self._count()
+        data = self.f.read(length)
+        if len(data) != length:
+            raise ValueError('Unexpected end of the GGUF header')
+        return data.decode('utf-8', errors='replace')
+
+    def _skip_string(self):
+        self.f.seek(self._count(), os.SEEK_CUR)
+
+    def _value(self, value_type:int=None, keep:bool=True):
+        if value_type in _SCALARS:
+            return self._unpack(_SCALARS[value_type])
+        if value_type == _STRING:
+            if keep:
+                return self._string()
+            self._skip_string()
+            return None
+        if value_type == _ARRAY:
+            item_type = self._unpack('<I')
+            count = self._count()
+            # Arrays are the tokenizer vocabularies (tens of thousands of items), they are skipped
+            if item_type in _SCALARS:
+                self.f.seek(struct.calcsize(_SCALARS[item_type]) * count, os.SEEK_CUR)
+            else:
+                for _ in range(count):
+                    self._value(item_type, keep=False)
+            return None
+        raise ValueError(f'Unknown GGUF value type {value_type}')
+
+    def read(self):
+        '''
+        Method to read the header. Returns (version, metadata, tensors) where tensors is a list of (shape, ggml type).
+        '''
+        if self.f.read(4) != GGUF_MAGIC:
+            raise ValueError('Not a GGUF file')
+        self.version = self._unpack('<I')
+        tensor_count = self._count()
+        kv_count = self._count()
+
+        metadata = {}
+        for _ in range(kv_count):
+            key = self._string()
+            metadata[key] = self._value(self._unpack('<I'))
+
+        tensors = []
+        for _ in range(tensor_count):
+            self._skip_string()
+            n_dims = self._unpack('<I')
+            shape = [self._unpack('<Q') for _ in range(n_dims)]
+            tensor_type = self._unpack('<I')
+            self._unpack('<Q')
+            tensors.append((shape, tensor_type))
+
+        return self.version, metadata, tensors
+
+def read_gguf_metadata(path:str=None):
+    '''
+    Method to get the metadata of a GGUF model from its header: architecture, parameter count, quantization type,
+    trained context length, embedding length and layers.
+    '''
+    with open(path, 'rb') as f:
+        version, metadata, tensors = GGUFReader(f).read()
+
+    architecture = metadata.get('general.architecture')
+    parameters = 0
+    types = {}
+    for shape, tensor_type in tensors:
+        count = 1
+        for dim in shape:
+            count *= dim
+        parameters += count
+        types[tensor_type] = types.get(tensor_type, 0) + count
+
+    quantization = FILE_TYPES.get(metadata.get('general.file_type'))
+    if quantization is None and types:
+        # Most of the weights are in the quantization type of the file
+        tensor_type = max(types, key=types.get)
+        quantization = TENSOR_TYPES.get(tensor_type, f'type {tensor_type}')
+
+    return {
+        "format": "gguf",
+        "version": version,
+        "name": metadata.get('general.name'),
+        "architecture": architecture,
+        "parameters": parameters,
+        "quantization": quantization,
+        "context_length": metadata.get(f'{architecture}.context_length'),
+        "embedding_length": metadata.get(f'{architecture}.embedding_length'),
+        "layers": metadata.get(f'{architecture}.block_count')
+    }
+
+class ModelRegistry:
+    '''
+    In-memory index of the models folder with the header metadata of each GGUF file.
+        - The folder is scanned again at most every Config.MODEL_REGISTRY_INTERVAL seconds, when it is read.
+        - A lookup of a file that is not indexed scans it again, at most every Config.MODEL_REGISTRY_MISS_INTERVAL
+          seconds, so repeated lookups of a missing file are answered from memory.
+        - A file is only parsed again when its size, mtime or inode change (e.g. while it is being downloaded).
+        - Parsing reads the header only, not the weights, so the whole folder is indexed in milliseconds.
+    '''
+
+    def __init__(self, directory:str=None, interval:float=None, miss_interval:float=None):
+        self.directory = directory or MODELS_DIR
+        self.interval = interval if interval is not None else Config.MODEL_REGISTRY_INTERVAL
+        self.miss_interval = miss_interval if miss_interval is not None else Config.MODEL_REGISTRY_MISS_INTERVAL
+        self._entries = {}
+        self._signatures = {}
+        self._checked = None
+        self._lock = threading.Lock()
+        self.scans = 0
+        self.parsed = 0
+
+    def _scan(self):
+        try:
+            files = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        except FileNotFoundError:
+            files = []
+
+        entries = {}
+        signatures = {}
+        for entry in files:
+            stat = entry.stat()
+            signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+            signatures[entry.name] = signature
+            if self._signatures.get(entry.name) == signature:
+                entries[entry.name] = self._entries[entry.name]
+                continue
+
+            metadata = {"format": None}
+            if entry.name.endswith('.gguf'):
+                try:
+                    metadata = read_gguf_metadata(entry.path)
+                except (OSError, ValueError) as e:
+                    metadata = {"format": "gguf", "error": str(e)}
+                    logger.warning('Could not read the header of %s: %s', entry.name, e)
+                self.parsed += 1
+            metadata["size_bytes"] = stat.st_size
+            entries[entry.name] = metadata
+
+        self._entries = dict(sorted(entries.items()))
+        self._signatures = signatures
+        self.scans += 1
+
+    def refresh(self, force:bool=False, interval:float=None):
+        '''
+        Method to scan the models folder if the last scan is older than interval seconds (self.interval by default),
+        or always with force.
+        '''
+        interval = self.interval if interval is None else interval
+        now = time.monotonic()
+        if not force and self._checked is not None and now - self._checked < interval:
+            return
+        with self._lock:
+            if force or self._checked is None or now - self._checked >= interval:
+                self._scan()
+                self._checked = time.monotonic()
+
+    def models(self):
+        '''
+        Method to get a dict of file name -> metadata of the models folder.
+        '''
+        self.refresh()
+        return dict(self._entries)
+
+    def get(self, name:str=None):
+        '''
+        Method to get the metadata of a model file, None if it is not in the models folder.
+        '''
+        self.refresh()
+        entry = self._entries.get(name)
+        if entry is None and self._checked is not None:
+            # A file copied since the last scan is found without waiting for the next one
+            self.refresh(interval=self.miss_interval)
+            entry = self._entries.get(name)
+        return entry
+
+    def stats(self):
+        return {"models": len(self._entries), "scans": self.scans, "parsed": self.parsed}
+
+model_registry = ModelRegistry()
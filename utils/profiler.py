@@ -0,0 +1,296 @@
+import os
+import re
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextvars
+from utils.config import Config
+from utils.logger import get_logger, get_request_id
+
+logger = get_logger('profiler')
+
+MODES = ('cprofile', 'sample')
+DUMP_NAME = re.compile(r'^[\w.-]+\.(prof|speedscope\.json)$')
+
+_session = contextvars.ContextVar('profile_session', default=None)
+
+def _enable(profile:cProfile.Profile=None):
+    # Since Python 3.12 only one cProfile can be enabled at a time in the process
+    try:
+        profile.enable()
+    except ValueError:
+        logger.warning('Another profiler is running, this part of the request is not profiled')
+        return False
+    return True
+
+def current_session():
+    '''
+    Method to get the profile session of the current request, None if it is not profiled.
+    '''
+    return _session.get()
+
+class ProfileSession:
+    '''
+    Profile of one request, from its thread and from the inference worker jobs it queues.
+        - cprofile: deterministic profile of every call (pstats dump, open it with snakeviz or python -m pstats).
+        - sample: stacks of the threads of the request every interval seconds (speedscope dump, open it in speedscope.app).
+    The dump is written when the response is closed and every job of the request has finished.
+    '''
+
+    def __init__(self, mode:str=None, name:str=None, interval:float=None):
+        self.mode = mode
+        self.name = name
+        self.interval = interval or Config.PROFILING_INTERVAL
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._refs = 1
+        self._profiles = []
+        self._active = {}
+        self._samples = {}
+        self._stopped = threading.Event()
+
+        if mode == 'cprofile':
+            self._request_profile = cProfile.Profile()
+            self._request_enabled = _enable(self._request_profile)
+        else:
+            self._active[threading.get_ident()] = 'request'
+            threading.Thread(target=self._sample, name='profile-sampler', daemon=True).start()
+
+    def stop_request_thread(self):
+        '''
+        Method to stop profiling the thread of the request. Called from that thread.
+        '''
+        if self.mode == 'cprofile':
+            if not self._request_enabled:
+                return
+            self._request_profile.disable()
+            with self._lock:
+                self._profiles.append(self._request_profile)
+        else:
+            with self._lock:
+                self._active.pop(threading.get_ident(), None)
+
+    def wrap(self, fn=None):
+        '''
+        Method to wrap a job of the request so it is profiled on the thread that runs it. release must be called
+        when the job is done, even if it never runs.
+        '''
+        with self._lock:
+            self._refs += 1
+
+        def run():
+            if self.mode == 'cprofile':
+                profile = cProfile.Profile()
+                if not _enable(profile):
+                    return fn()
+                try:
+                    return fn()
+                finally:
+                    profile.disable()
+                    with self._lock:
+                        self._profiles.append(profile)
+
+            ident = threading.get_ident()
+            with self._lock:
+                self._active[ident] = threading.current_thread().name
+            try:
+                return fn()
+            finally:
+                with self._lock:
+                    self._active.pop(ident, None)
+
+        return run
+
+    def release(self, *args):
+        with self._lock:
+            self._refs -= 1
+            done = self._refs == 0
+        if done:
+            self._stopped.set()
+            profiler.save(self)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                active = dict(self._active)
+            for ident, label in active.items():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                stack.reverse()
+                self._samples.setdefault((ident, label), []).append(stack)
+
+    def duration(self):
+        return time.perf_counter() - self._start
+
+    def dump(self, path:str=None):
+        '''
+        Method to write the profile to path.
+        '''
+        if self.mode == 'cprofile':
+            with self._lock:
+                profiles = list(self._profiles)
+            if not profiles:
+                raise ValueError('Nothing was profiled')
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(path)
+            return
+
+        frames = []
+        index = {}
+        profiles = []
+        for (ident, label), stacks in self._samples.items():
+            samples = []
+            for stack in stacks:
+                sample = []
+                for key in stack:
+                    if key not in index:
+                        index[key] = len(frames)
+                        frames.append({"name": key[0], "file": key[1], "line": key[2]})
+                    sample.append(index[key])
+                samples.append(sample)
+            profiles.append({
+                "type": "sampled",
+                "name": f'{label} ({ident})',
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": len(samples) * self.interval,
+                "samples": samples,
+                "weights": [self.interval] * len(samples)
+            })
+        with open(path, 'w') as f:
+            json.dump({
+                "$schema": "https://www.speedscope.app/file-format-schema.json",
+                "shared": {"frames": frames},
+                "profiles": profiles,
+                "name": self.name,
+                "exporter": "Local-LLM-API"
+            }, f)
+
+class RequestProfiler:
+    '''
+    On-demand profiling of live requests, controlled with the /profiling endpoints (master key).
+        - arm profiles the next N requests (optionally only the ones under a path).
+        - With Config.PROFILING_HEADER, a request with the master key and an X-Profile header (cprofile or sample) is profiled.
+        - active is False unless one of them is on, and it is the only check a request pays when profiling is off.
+    '''
+
+    def __init__(self, directory:str=None):
+        self.directory = directory or Config.PROFILING_DIR
+        self.remaining = 0
+        self.mode = 'cprofile'
+        self.path = None
+        self.active = Config.PROFILING_HEADER
+        self.profiled = 0
+        self._lock = threading.Lock()
+
+    def arm(self, requests:int=1, mode:str='cprofile', path:str=None):
+        '''
+        Method to profile the next requests. Where:
+            - requests: number of requests to profile
+            - mode: 'cprofile' or 'sample'
+            - path: only profile requests whose path starts with it
+        '''
+        if mode not in MODES:
+            raise ValueError(f'Unknown profiling mode {mode}, use one of {", ".join(MODES)}')
+        if type(requests) != int or requests < 1:
+            raise ValueError('requests must be a positive integer')
+        with self._lock:
+            self.remaining = requests
+            self.mode = mode
+            self.path = path
+            self.active = True
+        logger.info('Profiling the next %s requests', requests, extra={"mode": mode, "path": path})
+
+    def disarm(self):
+        with self._lock:
+            self.remaining = 0
+            self.active = Config.PROFILING_HEADER
+
+    def start(self, method:str=None, path:str=None, header:str=None, is_master=None):
+        '''
+        Method to start the profile of a request if it has to be profiled. Returns the session or None. Where:
+            - header: value of the X-Profile header of the request
+            - is_master: function that tells if the request has the master key
+        '''
+        mode = None
+        if path.startswith('/profiling'):
+            return None
+        if header and Config.PROFILING_HEADER and is_master():
+            mode = header if header in MODES else self.mode
+        elif self.remaining and (not self.path or path.startswith(self.path)):
+            with self._lock:
+                if self.remaining > 0:
+                    self.remaining -= 1
+                    mode = self.mode
+                    if not self.remaining:
+                        self.active = Config.PROFILING_HEADER
+        if mode is None:
+            return None
+
+        slug = re.sub(r'[^\w]+', '_', path).strip('_') or 'root'
+        name = f'{int(time.time() * 1000)}-{get_request_id() or "request"}-{method}-{slug}'
+        session = ProfileSession(mode=mode, name=name)
+        _session.set(session)
+        return session
+
+    def finish_request(self, session:ProfileSession=None):
+        '''
+        Method to stop profiling the thread of the request, at the end of the request (same thread).
+        '''
+        session.stop_request_thread()
+        _session.set(None)
+
+    def save(self, session:ProfileSession=None):
+        os.makedirs(self.directory, exist_ok=True)
+        extension = 'prof' if session.mode == 'cprofile' else 'speedscope.json'
+        path = os.path.join(self.directory, f'{session.name}.{extension}')
+        try:
+            session.dump(path)
+        except Exception:
+            logger.exception('Error saving profile %s', session.name)
+            return
+        self.profiled += 1
+        logger.info('Profile saved in %s', path, extra={"duration": round(session.duration(), 3)})
+
+    def dumps(self):
+        '''
+        Method to get the saved profiles, newest first.
+        '''
+        if not os.path.isdir(self.directory):
+            return []
+        dumps = []
+        for name in os.listdir(self.directory):
+            if not DUMP_NAME.match(name):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            dumps.append({
+                "name": name,
+                "format": "pstats" if name.endswith('.prof') else "speedscope",
+                "size_bytes": stat.st_size,
+                "created": stat.st_mtime
+            })
+        return sorted(dumps, key=lambda dump: dump["created"], reverse=True)
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "remaining": self.remaining,
+            "mode": self.mode,
+            "path": self.path,
+            "header": Config.PROFILING_HEADER,
+            "profiled": self.profiled,
+            "directory": self.directory
+        }
+
+profiler = RequestProfiler()
@@ -0,0 +1,110 @@
+import re
+import time
+from utils.logger import get_logger
+from utils.config import Config
+
+logger = get_logger('prompt_cache')
+
+def template_prefix(template:str=None):
+    '''
+    Method to get the static part of a template, before its first variable.
+    '''
+    match = re.search(r'(?<!\{)\{[^{}]*\}', template)
+    prefix = template[:match.start()] if match else template
+    return prefix.replace('{{', '{').replace('}}', '}')
+
+def warm_prefix(client=None, prefix:str=None):
+    '''
+    Method to evaluate a prompt prefix once and store the llama.cpp state in the prompt cache. Where:
+        - client: llama_cpp.Llama instance with a cache set
+        - prefix: text of the prefix
+    Returns the number of tokens of the prefix.
+    '''
+    tokens = client.tokenize(prefix.encode('utf-8'))
+    if not tokens:
+        return 0
+    client.reset()
+    client.eval(tokens)
+    client.cache[tokens] = client.save_state()
+    return len(tokens)
+
+def enable_prompt_cache(llm=None, templates:list=None, capacity_bytes:int=None):
+    '''
+    Method to attach a llama.cpp state cache to a loaded model and prefill the static prefix of its templates. Where:
+        - llm: LangChain LlamaCpp instance
+        - templates: templates that are used with this model
+        - capacity_bytes: max size of the cache, Config.PROMPT_CACHE_BYTES by default
+        - Every completion saves its state in the cache, so the next request of a session only evaluates the new turn,
+          and a new session restores the state of its template prefix instead of evaluating the preamble again.
+    Returns a dict with the state of the cache for prompt_cache_stats.
+    '''
+    stats = {
+        "enabled": False,
+        "type": None,
+        "capacity_bytes": 0,
+        "prefixes": {},
+        "prefix_tokens": 0,
+        "warmup_time": 0.0
+    }
+
+    if not Config.PROMPT_CACHE:
+        return stats
+
+    try:
+        from llama_cpp import LlamaRAMCache, LlamaDiskCache
+    except ImportError as e:
+        logger.warning('Prompt cache not available in this llama-cpp-python version: %s', e)
+        return stats
+
+    client = llm.client
+    start_time = time.time()
+    capacity_bytes = capacity_bytes if capacity_bytes is not None else Config.PROMPT_CACHE_BYTES
+
+    if Config.PROMPT_CACHE_TYPE == 'disk':
+        cache = LlamaDiskCache(cache_dir=Config.PROMPT_CACHE_DIR, capacity_bytes=capacity_bytes)
+    else:
+        cache = LlamaRAMCache(capacity_bytes=capacity_bytes)
+    client.set_cache(cache)
+
+    stats["enabled"] = True
+    stats["type"] = Config.PROMPT_CACHE_TYPE
+    stats["capacity_bytes"] = capacity_bytes
+
+    for template in templates or []:
+        prefix = template_prefix(template)
+        if not prefix.strip() or prefix in stats["prefixes"]:
+            continue
+        try:
+            n_tokens = warm_prefix(client=client, prefix=prefix)
+        except Exception as e:
+            logger.error('Error prefilling template prefix: %s', e)
+            continue
+        stats["prefixes"][prefix] = n_tokens
+        stats["prefix_tokens"] += n_tokens
+
+    stats["warmup_time"] = time.time() - start_time
+    logger.info('%s template prefixes cached', len(stats["prefixes"]), extra={"prefix_tokens": stats["prefix_tokens"], "duration": round(stats["warmup_time"], 3)})
+
+    return stats
+
+def prompt_cache_stats(llms:list=None, stats:list=None):
+    '''
+    Method to get the state of the prompt caches of a model, summed over its slots (disk caches share one folder). Where:
+        - llms: LlamaCpp instances of the slots
+        - stats: dicts returned by enable_prompt_cache, one per slot
+    '''
+    stats = stats or []
+    result = {
+        "enabled": any(slot["enabled"] for slot in stats),
+        "type": next((slot["type"] for slot in stats if slot["type"]), None),
+        "caches": sum(1 for slot in stats if slot["enabled"]),
+        "capacity_bytes": (max if Config.PROMPT_CACHE_TYPE == 'disk' else sum)([slot["capacity_bytes"] for slot in stats] or [0]),
+        "cached_prefixes": max((len(slot["prefixes"]) for slot in stats), default=0),
+        "prefix_tokens": sum(slot["prefix_tokens"] for slot in stats),
+        "warmup_time": sum(slot["warmup_time"] for slot in stats)
+    }
+    caches = [getattr(getattr(llm, 'client', None), 'cache', None) for llm in llms or []]
+    caches = [cache for cache in caches if cache is not None]
+    if caches:
+        result["size_bytes"] = sum(cache.cache_size for cache in caches)
+    return result
@@ -0,0 +1,142 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from utils.config import Config
+
+def is_deterministic(model_config:dict=None):
+    '''
+    Method to check if a model config samples deterministically (greedy decoding), so the same prompt gives the same answer.
+    '''
+    return model_config.get('temperature') == 0 or model_config.get('top_k') == 1
+
+def response_key(model_config:dict=None, prompt:str=None):
+    '''
+    Method to get the cache key of a rendered prompt for a model config (model file and sampling params included).
+    '''
+    data = json.dumps({"config": model_config, "prompt": prompt}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    '''
+    Exact-match cache of answers, keyed by response_key.
+        - In memory: LRU with max_entries and ttl seconds.
+        - Optional on-disk tier in SQLite, checked on a memory miss and promoted to memory on a hit.
+    '''
+
+    def __init__(self, max_entries:int=None, ttl:float=None, disk_path:str=None):
+        self.max_entries = max_entries if max_entries is not None else Config.RESPONSE_CACHE_SIZE
+        self.ttl = ttl if ttl is not None else Config.RESPONSE_CACHE_TTL
+        self.disk_path = disk_path if disk_path is not None else (Config.RESPONSE_CACHE_DB if Config.RESPONSE_CACHE_DISK else None)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.saved_time = 0.0
+
+        if self.disk_path:
+            with self._connection() as conn:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY,
+                        result TEXT NOT NULL,
+                        generation_time REAL,
+                        created REAL
+                    )
+                ''')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.disk_path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _expired(self, created:float=None):
+        return bool(self.ttl) and time.time() - created > self.ttl
+
+    def get(self, key:str=None):
+        '''
+        Method to get a cached answer, or None.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                result, generation_time, created = entry
+                if not self._expired(created):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self.saved_time += generation_time
+                    return result
+                del self._entries[key]
+
+        if self.disk_path:
+            row = self._connection().execute(
+                'SELECT result, generation_time, created FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is not None and not self._expired(row[2]):
+                self._put_memory(key, row)
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self.saved_time += row[1]
+                return row[0]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _put_memory(self, key:str=None, entry:tuple=None):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def put(self, key:str=None, result:str=None, generation_time:float=0.0):
+        '''
+        Method to store an answer and the time it took to generate it.
+        '''
+        entry = (result, generation_time, time.time())
+        self._put_memory(key, entry)
+        self.stores += 1
+
+        if self.disk_path:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO responses (key, result, generation_time, created) VALUES (?, ?, ?, ?)',
+                    (key, *entry)
+                )
+                if self.ttl:
+                    conn.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.ttl,))
+
+    def stats(self):
+        '''
+        Method to get the counters of the cache.
+        '''
+        lookups = self.hits + self.misses
+        return {
+            "enabled": Config.RESPONSE_CACHE,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "disk": bool(self.disk_path),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "saved_generation_time": self.saved_time
+        }
+
+response_cache = ResponseCache()
@@ -0,0 +1,345 @@
+import time
+import heapq
+import itertools
+import threading
+import contextvars
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from utils.config import Config
+from utils.metrics import observe_stage
+from utils.profiler import current_session
+
+class SchedulerError(Exception):
+    '''
+    Base error of the scheduler. status is the HTTP status to answer with.
+    '''
+    status = 503
+
+class QueueFullError(SchedulerError):
+    status = 429
+
+class QueueTimeoutError(SchedulerError):
+    status = 503
+
+class _Job:
+
+    def __init__(self, fn, client, priority, tag, seq, model=None, session=None):
+        self.fn = fn
+        self.client = client
+        # The job takes a slot of model and writes to session, it waits in the queue until both are free
+        self.model = model
+        self.session = session
+        self.priority = priority
+        self.tag = tag
+        self.seq = seq
+        self.future = Future()
+        self.enqueued = time.time()
+        # The job runs in the context of the request that queued it (e.g. its stage timings)
+        self.context = contextvars.copy_context()
+
+    def __lt__(self, other):
+        return (self.priority, self.tag, self.seq) < (other.priority, other.tag, other.seq)
+
+def _remove(heap:list=None, job:_Job=None):
+    i = heap.index(job)
+    heap[i] = heap[-1]
+    heap.pop()
+    heapq.heapify(heap)
+
+class InferenceScheduler:
+    '''
+    Bounded priority queue in front of the model, served by dedicated inference worker threads.
+        - Lower priority values are served first.
+        - Within a priority, clients (API keys) are served round-robin with start-time fair queuing, so one client
+          sending many requests does not starve the others.
+        - A request is rejected with QueueFullError when the queue (or the client's share of it) is full, and with
+          QueueTimeoutError when it waited longer than wait_timeout before reaching the worker.
+        - A job that names a model is only taken by a worker when the model has a free decoding slot, so the workers
+          are never blocked on a busy model while other models could run. The jobs waiting for it keep their place.
+        - Jobs of the same session run one at a time, in queue order, so each one sees the turns of the previous ones.
+    '''
+
+    def __init__(self, max_queue:int=None, max_per_client:int=None, wait_timeout:float=None, workers:int=1):
+        self.max_queue = max_queue if max_queue is not None else Config.SCHEDULER_MAX_QUEUE
+        self.max_per_client = max_per_client if max_per_client is not None else Config.SCHEDULER_MAX_PER_KEY
+        self.wait_timeout = wait_timeout if wait_timeout is not None else Config.SCHEDULER_WAIT_TIMEOUT
+        self.workers = workers
+        # Jobs that can run as soon as their model has a free slot, one heap per model (None for no model)
+        self._ready = {}
+        # Queued jobs of each session, in queue order. Only the first one is in _ready, once the session is not running
+        self._session_queues = {}
+        self._queued_jobs = {}
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._virtual_time = 0
+        self._last_tag = {}
+        self._queued_per_client = {}
+        self._threads = []
+        self._busy_slots = {}
+        self._running_sessions = set()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.total_service_time = 0.0
+
+    def _start(self):
+        for i in range(len(self._threads), self.workers):
+            thread = threading.Thread(target=self._work, name=f'inference-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def ensure_workers(self, workers:int=1):
+        '''
+        Method to have at least workers inference worker threads (e.g. one per decoding slot of a loaded model).
+        '''
+        with self._cond:
+            if workers > self.workers:
+                self.workers = workers
+                if self._threads:
+                    self._start()
+
+    def submit(self, fn, client:str=None, priority:int=0, model=None, session:int=None):
+        '''
+        Method to queue a call to fn on the inference worker. Returns a Future with its result. Where:
+            - fn: function without arguments that runs the generation
+            - client: key used for fairness between clients (e.g. the API key number)
+            - priority: lower values are served first
+            - model: LoadedModel whose slot fn takes (with model.slot), None if it does not use one
+            - session: session_id that fn reads and writes, None for no session
+        '''
+        return self.submit_many([fn], client=client, priority=priority, models=[model], sessions=[session])[0]
+
+    def submit_many(self, fns:list=None, client:str=None, priority:int=0, per_client_limit:bool=True, models:list=None, sessions:list=None):
+        '''
+        Method to queue several calls at once, all or none. Returns a list of Futures in the same order. Where:
+            - per_client_limit: apply max_per_client to the calls (batches are bounded by their own size limit instead)
+            - models, sessions: model and session of each call (see submit)
+        Within the client, the calls are served in order, interleaved with the requests of other clients.
+        '''
+        models = models or [None] * len(fns)
+        sessions = sessions or [None] * len(fns)
+        with self._cond:
+            self._start()
+
+            if self.queued + len(fns) > self.max_queue:
+                self.rejected += len(fns)
+                raise QueueFullError(f'Server overloaded: {self.queued} requests in queue')
+            if per_client_limit and self.max_per_client and self._queued_per_client.get(client, 0) + len(fns) > self.max_per_client:
+                self.rejected += len(fns)
+                raise QueueFullError(f'Too many queued requests for this API key ({self.max_per_client} max)')
+
+            # Jobs of a profiled request are profiled on the inference worker too
+            session = current_session()
+
+            jobs = []
+            for fn, model, session_id in zip(fns, models, sessions):
+                tag = max(self._virtual_time, self._last_tag.get(client, 0)) + 1
+                self._last_tag[client] = tag
+                self._queued_per_client[client] = self._queued_per_client.get(client, 0) + 1
+
+                job = _Job(session.wrap(fn) if session else fn, client, priority, tag, next(self._seq), model=model, session=session_id)
+                if session:
+                    job.future.add_done_callback(session.release)
+                self._enqueue(job)
+                jobs.append(job)
+
+            # A waiting worker may not be able to take the new jobs, but another one can
+            self._cond.notify_all()
+
+        return [job.future for job in jobs]
+
+    def run(self, fn, client:str=None, priority:int=0, model=None, session:int=None):
+        '''
+        Method to queue a call to fn and wait for its result. Raises QueueTimeoutError as soon as the call has waited
+        wait_timeout in the queue, it does not wait for the jobs ahead of it to finish.
+        '''
+        future = self.submit(fn, client=client, priority=priority, model=model, session=session)
+        if not self.wait_timeout:
+            return future.result()
+        try:
+            return future.result(timeout=self.wait_timeout)
+        except FutureTimeoutError:
+            if self.cancel(future):
+                with self._cond:
+                    self.timed_out += 1
+                raise QueueTimeoutError(f'Request waited {self.wait_timeout:.1f}s in queue')
+        # It is already running
+        return future.result()
+
+    def cancel(self, future:Future=None):
+        '''
+        Method to remove a queued call from the queue. Returns False if it is already running or done.
+        '''
+        with self._cond:
+            job = self._queued_jobs.get(future)
+            if job is None:
+                return False
+            if job.session is None:
+                self._remove_ready(job)
+            else:
+                queue = self._session_queues[job.session]
+                first = queue[0] is job
+                _remove(queue, job)
+                if first and job.session not in self._running_sessions:
+                    self._remove_ready(job)
+                    if queue:
+                        # The next job of the session can run now
+                        self._push_ready(queue[0])
+                        self._cond.notify_all()
+                if not queue:
+                    del self._session_queues[job.session]
+            self._dequeued(job)
+        future.cancel()
+        return True
+
+    def _push_ready(self, job:_Job=None):
+        heapq.heappush(self._ready.setdefault(job.model, []), job)
+
+    def _remove_ready(self, job:_Job=None):
+        queue = self._ready[job.model]
+        _remove(queue, job)
+        if not queue:
+            del self._ready[job.model]
+
+    def _enqueue(self, job:_Job=None):
+        self._queued_jobs[job.future] = job
+        self.queued += 1
+        if job.session is None:
+            self._push_ready(job)
+            return
+        queue = self._session_queues.setdefault(job.session, [])
+        first = queue[0] if queue else None
+        heapq.heappush(queue, job)
+        if job.session in self._running_sessions or queue[0] is first:
+            return
+        # The job comes first in its session (e.g. a higher priority), it replaces the previous first job
+        if first is not None:
+            self._remove_ready(first)
+        self._push_ready(job)
+
+    def _dequeued(self, job:_Job=None):
+        del self._queued_jobs[job.future]
+        self.queued -= 1
+        self._queued_per_client[job.client] -= 1
+        if not self._queued_per_client[job.client]:
+            del self._queued_per_client[job.client]
+            self._last_tag.pop(job.client, None)
+
+    def _take(self):
+        # The first job in queue order whose model has a free slot and whose session is not running: the first of
+        # the ready jobs of the models with a free slot
+        best = None
+        for model, queue in self._ready.items():
+            if model is not None and self._busy_slots.get(model, 0) >= len(model.slots):
+                continue
+            if best is None or queue[0] < best[0]:
+                best = queue
+        if best is None:
+            return None
+        job = heapq.heappop(best)
+        if not best:
+            del self._ready[job.model]
+        if job.session is not None:
+            queue = self._session_queues[job.session]
+            heapq.heappop(queue)
+            if not queue:
+                del self._session_queues[job.session]
+        return job
+
+    def _next_job(self):
+        with self._cond:
+            job = self._take()
+            while job is None:
+                self._cond.wait()
+                job = self._take()
+            self._virtual_time = max(self._virtual_time, job.tag)
+            self._dequeued(job)
+            if job.model is not None:
+                self._busy_slots[job.model] = self._busy_slots.get(job.model, 0) + 1
+            if job.session is not None:
+                self._running_sessions.add(job.session)
+            return job
+
+    def _release(self, job:_Job=None):
+        # Called with the queue lock held, when the job is done or dropped
+        if job.model is not None:
+            self._busy_slots[job.model] -= 1
+            if not self._busy_slots[job.model]:
+                del self._busy_slots[job.model]
+        if job.session is not None:
+            self._running_sessions.discard(job.session)
+            queue = self._session_queues.get(job.session)
+            if queue:
+                # The next job of the session can run now
+                self._push_ready(queue[0])
+        if job.model is not None or job.session is not None:
+            self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if not job.future.set_running_or_notify_cancel():
+                with self._cond:
+                    self._release(job)
+                continue
+
+            wait_time = time.time() - job.enqueued
+            if self.wait_timeout and wait_time > self.wait_timeout:
+                with self._cond:
+                    self.timed_out += 1
+                    self._release(job)
+                job.future.set_exception(QueueTimeoutError(f'Request waited {wait_time:.1f}s in queue'))
+                continue
+
+            # With several workers the counters are updated under the queue lock
+            with self._cond:
+                self.running += 1
+            start_time = time.time()
+            result, error = None, None
+            try:
+                job.context.run(observe_stage, 'queue', wait_time)
+                result = job.context.run(job.fn)
+            except BaseException as e:
+                error = e
+
+            # The slot and the session are free before the caller gets the result and sends its next turn
+            service_time = time.time() - start_time
+            with self._cond:
+                self._release(job)
+                self.running -= 1
+                if error is not None:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+                self.total_wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+                self.total_service_time += service_time
+
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+
+    def stats(self):
+        '''
+        Method to get queue depth, wait time and service time of the scheduler.
+        '''
+        served = self.completed + self.failed
+        return {
+            "queue_depth": self.queued,
+            "max_queue": self.max_queue,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait_time": self.total_wait_time / served if served else 0.0,
+            "max_wait_time": self.max_wait_time,
+            "avg_service_time": self.total_service_time / served if served else 0.0
+        }
+
+scheduler = InferenceScheduler()
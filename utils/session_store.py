@@ -0,0 +1,501 @@
+import os
+import json
+import math
+import time
+import base64
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from utils.logger import get_logger
+from utils.config import Config
+
+logger = get_logger('sessions')
+
+# Order of each sort of the session catalog: column, newest/first rows first
+SESSION_SORTS = {
+    'updated': ('updated', 'DESC'),
+    'created': ('created', 'DESC'),
+    'name': ('name', 'ASC')
+}
+
+def encode_cursor(values:tuple=None):
+    '''
+    Method to get the opaque cursor of a page of sessions from the sort key of its last session.
+    '''
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode('utf-8')).decode('ascii')
+
+# Type of the sort column of each sort in a cursor
+CURSOR_TYPES = {
+    'updated': (int, float),
+    'created': (int, float),
+    'name': (str,)
+}
+
+def decode_cursor(cursor:str=None, sort:str='updated'):
+    '''
+    Method to get the sort key of a cursor made by encode_cursor for the same sort. Raises ValueError if the cursor is
+    not valid, so it never reaches the query.
+    '''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    if type(values) != list or len(values) != 2:
+        raise ValueError('Invalid cursor')
+    value, session_id = values
+    if type(value) not in CURSOR_TYPES[sort] or type(session_id) != str:
+        raise ValueError('Invalid cursor')
+    if type(value) == float and not math.isfinite(value):
+        raise ValueError('Invalid cursor')
+    return value, session_id
+
+def session_entry(session_id:str=None, name:str=None, created:float=None, updated:float=None, turns:int=0, tokens:int=0):
+    return {
+        "id": session_id,
+        "name": name,
+        "created": created,
+        "updated": updated,
+        "turns": turns,
+        "tokens": tokens
+    }
+
+class SessionStore(ABC):
+    '''
+    Base class for the session backends. A session is a list of messages, each one a (role, content) tuple
+    where role is "Human" or "AI".
+    '''
+
+    @abstractmethod
+    def append_turn(self, session_id:int=None, question:str=None, answer:str=None, name:str=None, tokens:int=0):
+        '''
+        Method to append a Human/AI turn to a session, creating it if it does not exist. Where:
+            - session_id: id of the session
+            - question: Human message
+            - answer: AI message
+            - name: name of the session, only used when the session is created
+            - tokens: tokens of the turn, added to the total of the session in the catalog
+        '''
+        pass
+
+    @abstractmethod
+    def load_messages(self, session_id:int=None, limit:int=None):
+        '''
+        Method to get the last messages of a session, oldest first. Where:
+            - session_id: id of the session
+            - limit: max number of messages, None for the whole history
+        '''
+        pass
+
+    @abstractmethod
+    def list_sessions(self, limit:int=50, cursor:str=None, sort:str='updated', prefix:str=None):
+        '''
+        Method to get a page of the session catalog. Returns (sessions, next_cursor), next_cursor is None on the last page. Where:
+            - limit: max number of sessions in the page
+            - cursor: next_cursor of the previous page, None for the first one
+            - sort: 'updated' (last activity first), 'created' (newest first) or 'name'
+            - prefix: only the sessions whose name starts with it
+        Each session is a dict with its id, name, created and updated timestamps, turns and tokens.
+        '''
+        pass
+
+    @abstractmethod
+    def count_messages(self, session_id:int=None):
+        pass
+
+    @abstractmethod
+    def load_range(self, session_id:int=None, start:int=0, count:int=None):
+        '''
+        Method to get count messages of a session from position start (0 is the first message), oldest first.
+        '''
+        pass
+
+    @abstractmethod
+    def get_summary(self, session_id:int=None):
+        '''
+        Method to get the running summary of a session. Returns (summary, summarized) where summarized is the number
+        of messages (from the first one) folded into the summary. (None, 0) if the session has no summary.
+        '''
+        pass
+
+    @abstractmethod
+    def set_summary(self, session_id:int=None, summary:str=None, summarized:int=0):
+        pass
+
+class SQLiteSessionStore(SessionStore):
+    '''
+    Session backend on SQLite in WAL mode.
+        - Each turn is an INSERT of two rows, no other session is read or rewritten.
+        - Messages are indexed by (session_id, id), so loading the last N messages of a session is an index range scan.
+    '''
+
+    def __init__(self, path:str=None):
+        self.path = path or Config.SESSIONS_DB
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._create_schema()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _create_schema(self):
+        conn = self._connection()
+        with conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    name TEXT,
+                    created REAL,
+                    updated REAL,
+                    turns INTEGER NOT NULL DEFAULT 0,
+                    summary TEXT,
+                    summarized INTEGER NOT NULL DEFAULT 0,
+                    tokens INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    created REAL
+                );
+                CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+            ''')
+            # Databases created before summaries were added
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(sessions)')]
+            if 'summary' not in columns:
+                conn.execute('ALTER TABLE sessions ADD COLUMN summary TEXT')
+                conn.execute('ALTER TABLE sessions ADD COLUMN summarized INTEGER NOT NULL DEFAULT 0')
+            # And before the catalog counted tokens
+            if 'tokens' not in columns:
+                conn.execute('ALTER TABLE sessions ADD COLUMN tokens INTEGER NOT NULL DEFAULT 0')
+            # The active session is no longer kept
+            conn.execute("DELETE FROM meta WHERE key = 'Active'")
+            # The catalog is listed in pages by a range scan of one of these
+            conn.executescript('''
+                CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated, id);
+                CREATE INDEX IF NOT EXISTS sessions_created ON sessions (created, id);
+                CREATE INDEX IF NOT EXISTS sessions_name ON sessions (name, id);
+            ''')
+
+    def append_turn(self, session_id:int=None, question:str=None, answer:str=None, name:str=None, tokens:int=0):
+        now = time.time()
+        conn = self._connection()
+        with self._write_lock, conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO sessions (id, name, created, updated, turns) VALUES (?, ?, ?, ?, 0)',
+                (str(session_id), name, now, now)
+            )
+            conn.executemany(
+                'INSERT INTO messages (session_id, role, content, created) VALUES (?, ?, ?, ?)',
+                [(str(session_id), 'Human', question, now), (str(session_id), 'AI', answer, now)]
+            )
+            conn.execute(
+                'UPDATE sessions SET updated = ?, turns = turns + 1, tokens = tokens + ? WHERE id = ?',
+                (now, tokens or 0, str(session_id))
+            )
+
+    def load_messages(self, session_id:int=None, limit:int=None):
+        conn = self._connection()
+        if limit is None:
+            rows = conn.execute(
+                'SELECT role, content FROM messages WHERE session_id = ? ORDER BY id',
+                (str(session_id),)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                'SELECT role, content FROM ('
+                'SELECT id, role, content FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?'
+                ') ORDER BY id',
+                (str(session_id), limit)
+            ).fetchall()
+        return [(role, content) for role, content in rows]
+
+    def list_sessions(self, limit:int=50, cursor:str=None, sort:str='updated', prefix:str=None):
+        column, order = SESSION_SORTS[sort]
+        where = []
+        params = []
+        if prefix:
+            # Range on the name instead of LIKE, so it can use the name index
+            where.append('name >= ? AND name < ?')
+            params += [prefix, prefix + '\U0010ffff']
+        if cursor is not None:
+            where.append(f'({column}, id) {"<" if order == "DESC" else ">"} (?, ?)')
+            params += list(decode_cursor(cursor, sort))
+
+        rows = self._connection().execute(
+            'SELECT id, name, created, updated, turns, tokens FROM sessions'
+            + (' WHERE ' + ' AND '.join(where) if where else '')
+            + f' ORDER BY {column} {order}, id {order} LIMIT ?',
+            params + [limit + 1]
+        ).fetchall()
+
+        sessions = [session_entry(*row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = sessions[-1]
+            next_cursor = encode_cursor((last[column], last["id"]))
+        return sessions, next_cursor
+
+    def count_messages(self, session_id:int=None):
+        row = self._connection().execute(
+            'SELECT COUNT(*) FROM messages WHERE session_id = ?', (str(session_id),)
+        ).fetchone()
+        return row[0]
+
+    def load_range(self, session_id:int=None, start:int=0, count:int=None):
+        rows = self._connection().execute(
+            'SELECT role, content FROM messages WHERE session_id = ? ORDER BY id LIMIT ? OFFSET ?',
+            (str(session_id), -1 if count is None else count, start)
+        ).fetchall()
+        return [(role, content) for role, content in rows]
+
+    def get_summary(self, session_id:int=None):
+        row = self._connection().execute(
+            'SELECT summary, summarized FROM sessions WHERE id = ?', (str(session_id),)
+        ).fetchone()
+        return (row[0], row[1]) if row else (None, 0)
+
+    def set_summary(self, session_id:int=None, summary:str=None, summarized:int=0):
+        conn = self._connection()
+        with self._write_lock, conn:
+            conn.execute(
+                'UPDATE sessions SET summary = ?, summarized = ? WHERE id = ?',
+                (summary, summarized, str(session_id))
+            )
+
+    def get_meta(self, key:str=None):
+        row = self._connection().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key:str=None, value:str=None):
+        conn = self._connection()
+        with self._write_lock, conn:
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def import_session(self, session_id:int=None, name:str=None, messages:list=None, created:float=None, updated:float=None, tokens:int=0):
+        '''
+        Method to write a whole session at once, used by the migration. Where:
+            - messages: list of (role, content) tuples
+            - created, updated: timestamps of the session in the catalog
+            - tokens: tokens of the whole history
+        '''
+        conn = self._connection()
+        with self._write_lock, conn:
+            conn.execute('DELETE FROM messages WHERE session_id = ?', (str(session_id),))
+            conn.execute(
+                'INSERT OR REPLACE INTO sessions (id, name, created, updated, turns, summary, summarized, tokens) VALUES (?, ?, ?, ?, ?, NULL, 0, ?)',
+                (str(session_id), name or '', created, updated, len(messages) // 2, tokens or 0)
+            )
+            conn.executemany(
+                'INSERT INTO messages (session_id, role, content, created) VALUES (?, ?, ?, ?)',
+                [(str(session_id), role, content, updated) for role, content in messages]
+            )
+
+class JSONSessionStore(SessionStore):
+    '''
+    Legacy session backend on sessions.json. Every call reads the whole file and every write rewrites it,
+    listing included.
+    '''
+
+    def __init__(self, path:str=None):
+        self.path = path or Config.SESSIONS_JSON
+        self._lock = threading.Lock()
+
+    def _read(self):
+        with open(self.path, "r", encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write(self, data):
+        with open(self.path, "w", encoding='utf-8') as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+
+    def append_turn(self, session_id:int=None, question:str=None, answer:str=None, name:str=None, tokens:int=0):
+        now = time.time()
+        with self._lock:
+            data = self._read()
+            if str(session_id) not in data:
+                data[str(session_id)] = {"name": name, "history": [], "created": now}
+            session = data[str(session_id)]
+            session["history"] += ['Human: ' + question, 'AI: ' + answer]
+            session["updated"] = now
+            session["tokens"] = session.get("tokens", 0) + (tokens or 0)
+            self._write(data)
+
+    def load_messages(self, session_id:int=None, limit:int=None):
+        data = self._read()
+        if str(session_id) not in data:
+            return []
+        messages = parse_legacy_history(data[str(session_id)]["history"])
+        return messages if limit is None else messages[-limit:] if limit else []
+
+    def list_sessions(self, limit:int=50, cursor:str=None, sort:str='updated', prefix:str=None):
+        column, order = SESSION_SORTS[sort]
+        data = self._read()
+        sessions = [
+            session_entry(
+                session_id=key,
+                name=data[key].get("name") or '',
+                created=data[key].get("created", 0),
+                updated=data[key].get("updated", 0),
+                turns=len(data[key]["history"]) // 2,
+                tokens=data[key].get("tokens", 0)
+            )
+            for key in data if key != "Active"
+        ]
+        if prefix:
+            sessions = [session for session in sessions if session["name"].startswith(prefix)]
+        sessions.sort(key=lambda session: (session[column], session["id"]), reverse=order == 'DESC')
+        if cursor is not None:
+            after = decode_cursor(cursor, sort)
+            if order == 'DESC':
+                sessions = [session for session in sessions if (session[column], session["id"]) < after]
+            else:
+                sessions = [session for session in sessions if (session[column], session["id"]) > after]
+
+        page = sessions[:limit]
+        next_cursor = encode_cursor((page[-1][column], page[-1]["id"])) if len(sessions) > limit else None
+        return page, next_cursor
+
+    def count_messages(self, session_id:int=None):
+        data = self._read()
+        return len(data[str(session_id)]["history"]) if str(session_id) in data else 0
+
+    def load_range(self, session_id:int=None, start:int=0, count:int=None):
+        messages = self.load_messages(session_id=session_id)
+        return messages[start:] if count is None else messages[start:start + count]
+
+    def get_summary(self, session_id:int=None):
+        session = self._read().get(str(session_id))
+        if not session:
+            return None, 0
+        return session.get("summary"), session.get("summarized", 0)
+
+    def set_summary(self, session_id:int=None, summary:str=None, summarized:int=0):
+        with self._lock:
+            data = self._read()
+            if str(session_id) in data:
+                data[str(session_id)]["summary"] = summary
+                data[str(session_id)]["summarized"] = summarized
+                self._write(data)
+
+def parse_legacy_history(history:list=None):
+    '''
+    Method to convert a sessions.json history ("Human: ..." / "AI: ..." strings, alternating) into (role, content) tuples.
+    '''
+    messages = []
+    speaker = 0
+    for i in history:
+        if speaker == 0:
+            messages.append(('Human', i[len("Human:"):].strip()))
+            speaker = 1
+        else:
+            messages.append(('AI', i[len("AI:"):].strip()))
+            speaker = 0
+    return messages
+
+def legacy_token_counter():
+    '''
+    Method to get a function that counts the tokens of a text for the migration, with the tokenizer of the selected
+    model. Only the vocabulary of the GGUF file is loaded, not the weights. If the model can not be opened, tokens are
+    estimated at 4 characters each.
+    '''
+    try:
+        from llama_cpp import Llama
+        from utils.load_model import read_config
+        from utils.model_registry import MODELS_DIR
+
+        config = read_config()
+        model_path = os.path.join(MODELS_DIR, config[config['SelectedModel']]["model"])
+        llm = Llama(model_path, vocab_only=True, verbose=False)
+    except Exception as e:
+        logger.warning('Token counts of the migrated sessions are estimated: %s', e)
+        return lambda text: math.ceil(len(text) / 4)
+
+    return lambda text: len(llm.tokenize(text.encode('utf-8'), add_bos=False))
+
+def migrate_json_sessions(store:SQLiteSessionStore=None, json_path:str=None, force:bool=False):
+    '''
+    Method to import the sessions of a legacy sessions.json into a SQLite store. Runs once, unless force is set. Where:
+        - store: destination store
+        - json_path: path of sessions.json
+    '''
+    json_path = json_path or Config.SESSIONS_JSON
+
+    if not force and store.get_meta('migrated_json'):
+        return 0
+    if not os.path.isfile(json_path):
+        store.set_meta('migrated_json', json.dumps(time.time()))
+        return 0
+
+    logger.info('Migrating sessions from %s', json_path)
+    with open(json_path, "r", encoding='utf-8') as f:
+        data = json.load(f)
+
+    # Sessions saved before the JSON backend stamped them get the last write of the file
+    modified = os.path.getmtime(json_path)
+    count_tokens = None
+
+    migrated = 0
+    for key in data:
+        # Legacy files also have the id of the last active session
+        if key == "Active":
+            continue
+        session = data[key]
+        messages = parse_legacy_history(session.get("history", []))
+        tokens = session.get("tokens")
+        if tokens is None and messages:
+            if count_tokens is None:
+                count_tokens = legacy_token_counter()
+            tokens = sum(count_tokens(content) for role, content in messages)
+        store.import_session(
+            session_id=key,
+            name=session.get("name"),
+            messages=messages,
+            created=session.get("created", modified),
+            updated=session.get("updated", modified),
+            tokens=tokens
+        )
+        migrated += 1
+
+    store.set_meta('migrated_json', json.dumps(time.time()))
+    logger.info('%s sessions migrated', migrated)
+
+    return migrated
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_session_store():
+    '''
+    Method to get the process-wide session store, configured by Config.SESSION_BACKEND.
+        - The first time the SQLite store is opened, sessions.json is migrated into it.
+    '''
+    global _store
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if Config.SESSION_BACKEND == 'json':
+                    _store = JSONSessionStore()
+                elif Config.SESSION_BACKEND == 'sqlite':
+                    store = SQLiteSessionStore()
+                    migrate_json_sessions(store=store)
+                    _store = store
+                else:
+                    raise ValueError(f'Unknown session backend {Config.SESSION_BACKEND}')
+
+    return _store
+
+if __name__ == '__main__':
+    # One-shot migration: python -m utils.session_store
+    migrate_json_sessions(store=SQLiteSessionStore(), force=True)
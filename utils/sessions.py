@@ -1,130 +1,77 @@
-import json
 from langchain.memory import ChatMessageHistory
-from colorama import Fore as c
+from langchain.schema.messages import SystemMessage
+from utils.logger import get_logger
+from utils.config import Config
+from utils.session_store import get_session_store
 
-def new_session(session_id:int=None, name:str=None): 
+logger = get_logger('sessions')
+
+def session_name(question:str=None):
     '''
-    Method to create a new session. Where:
-        - session_id: id of the session
-        - name: name of the session
+    Method to get the name of a new session from its first question.
     '''
+    name = question.strip()
+    if len(name) > 30:
+        name = name[:30] + '...'
+    return name
 
-    # Read sessions.json
-    with open(f"./data/sessions.json", "r") as f:
-        data = json.load(f)
-    
-    # Set ActiveSession to session_id
-    data["Active"] = session_id
-    # Add session_id to sessions
-    data[str(session_id)] = {
-        "name":name,
-        "history":[]
-    }
-
-    return data
-
-def load_session(session_id:int=None):
+def load_session(session_id:int=None, limit:int=None):
     '''
     Method to load a existing session. Where:
         - session_id: id of the session
+        - limit: number of messages to load, Config.SESSION_LOAD_LIMIT by default
+    With Config.SUMMARY, the running summary of the session comes first (as a system message), followed by the
+    recent messages that are not in the summary.
     '''
-    
-    # Load sessions.json
-    with open(f"./data/sessions.json", "r") as f:
-        data = json.load(f)
 
-    # Check if session_id is exists in sessions.json
-    if str(session_id) in data.keys():
-        print(f'\n[ {c.GREEN}SESSION{c.RESET} ] Session exists')
-        history = data[str(session_id)]["history"]
+    if limit is None:
+        limit = Config.SESSION_LOAD_LIMIT
 
-        # Create a new ChatMessageHistory object
-        session = ChatMessageHistory()
-        # Add history to session
-        speaker = 0
-        for i in history:
-            if speaker == 0:
-                new_i = i[len("Human:"):].strip()
-                session.add_user_message(new_i)
-                speaker = 1
-            else:
-                new_i = i[len("AI:"):].strip()
-                session.add_ai_message(new_i)
-                speaker = 0
+    store = get_session_store()
+    messages = store.load_messages(session_id=session_id, limit=limit)
 
-        return session
-    else:
-        print(f'\n[ {c.YELLOW}SESSION{c.RESET} ] Session does not exist')
-        session = ChatMessageHistory()
-        return session
+    # Create a new ChatMessageHistory object
+    session = ChatMessageHistory()
 
-def check_session():
-    '''
-    Method to check the active session in sessions.json
-    '''
-
-    with open(f"./data/sessions.json", "r") as f:
-        data = json.load(f)
-
-    active = data["Active"]
+    if messages:
+        logger.debug('Session %s loaded', session_id, extra={"messages": len(messages)})
+    else:
+        logger.debug('Session %s does not exist', session_id)
+
+    if Config.SUMMARY and messages:
+        summary, summarized = store.get_summary(session_id=session_id)
+        if summary:
+            session.add_message(SystemMessage(content=summary))
+            recent = store.count_messages(session_id=session_id) - summarized
+            messages = messages[-recent:] if recent > 0 else []
+
+    # Add history to session
+    for role, content in messages:
+        if role == 'Human':
+            session.add_user_message(content)
+        else:
+            session.add_ai_message(content)
 
-    return active
+    return session
 
-def set_session(session_id:int=None):
+def save_session(session_id:int=None, question:str=None, answer:str=None, tokens:int=0):
     '''
-    Method to set the active session in sessions.json. Where:
+    Method to append the last Human/AI turn to the session. Where:
         - session_id: id of the session
+        - question: Human message of the turn
+        - answer: AI message of the turn
+        - tokens: tokens of the question and the answer, for the session catalog
     '''
-    # Change active session in sessions.json
-    with open(f"./data/sessions.json", "r") as f:
-        data = json.load(f)
-        data["Active"] = session_id
 
-    # Save sessions.json
-    with open(f"./data/sessions.json", "w") as f:
-        json.dump(data, f, indent=4)
-
-def save_session(history:list=None):
-    '''
-    Method to save the history of the session in sessions.json. Where:
-        - history: history of the actual session
-    '''
-
-    # Check the last session id in sessions.json
     try:
-        with open(f"./data/sessions.json", "r") as f:
-            data = json.load(f)
-            
-        session_id = int(data["Active"])
-
-        new_history = []
-
-        speaker = 0
-        for part in history:
-            if speaker == 0:
-                new_history.append('Human: ' + part.content)
-                speaker = 1
-            else:
-                new_history.append('AI: ' + part.content)
-                speaker = 0
-        
-        name = new_history[0]
-        name = name[len("Human:"):].strip()
-        if len(name) > 30:
-            name = name[:30] + '...'
-
-        if str(session_id) not in data.keys():
-            print(f'\n[ {c.CYAN}SESSION{c.RESET} ] Session does not exist. Creating new session...')
-            data = new_session(session_id=session_id, name=name)
-            data[str(session_id)]["history"] = new_history
-        else:
-            print(f'\n[ {c.CYAN}SESSION{c.RESET} ] Session exists. Saving history...')
-            data[str(session_id)]["history"] = new_history
-
-        # Save sessions.json
-        with open(f"./data/sessions.json", "w", encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-
-    except Exception as e:
-        print(f"[ {c.RED}SESSION{c.RESET} ] Error saving session: {e}")
-        return 'Error saving session.'
\ No newline at end of file
+        store = get_session_store()
+        store.append_turn(
+            session_id=session_id,
+            question=question,
+            answer=answer,
+            name=session_name(question),
+            tokens=tokens
+        )
+    except Exception:
+        logger.exception('Error saving session %s', session_id)
+        return 'Error saving session.'
@@ -0,0 +1,167 @@
+import os
+import inspect
+import threading
+from utils.logger import get_logger
+from utils.metrics import registry, Counter
+from utils.model_registry import model_registry, MODELS_DIR
+
+logger = get_logger('speculative')
+
+DRAFT_TOKENS = registry.register(Counter(
+    'llm_api_draft_tokens_total',
+    'Tokens proposed by the draft model of speculative decoding, by result (accepted or rejected by the main model)',
+    ('model', 'result')
+))
+
+try:
+    from llama_cpp.llama_speculative import LlamaDraftModel as _DraftBase
+except ImportError:
+    _DraftBase = object
+
+def draft_settings(model_config:dict=None):
+    '''
+    Method to get the speculative decoding settings of a model config, None if it has no draft model. Where:
+        - draft_model in config.json is the file name of the draft model, or a dict with "model" and "num_pred_tokens"
+    Raises ValueError if the draft model is not in the models folder.
+    '''
+    draft = model_config.get("draft_model")
+    if not draft:
+        return None
+    if isinstance(draft, str):
+        draft = {"model": draft}
+
+    settings = {
+        "model": draft.get("model"),
+        "num_pred_tokens": draft.get("num_pred_tokens", 8)
+    }
+    if type(settings["num_pred_tokens"]) != int or settings["num_pred_tokens"] < 1:
+        raise ValueError(f'num_pred_tokens of the draft model must be a positive integer, got {settings["num_pred_tokens"]!r}')
+    if model_registry.get(settings["model"]) is None:
+        raise ValueError(f'Draft model {settings["model"]} does not exist')
+    return settings
+
+class DraftModel(_DraftBase):
+    '''
+    Draft model for the speculative decoding of llama-cpp-python: a small GGUF model with the same vocabulary as the
+    main one proposes the next num_pred_tokens tokens greedily, and the main model checks them all in one batched
+    evaluation. Every token is still sampled by the main model, so the output has the same distribution as without
+    the draft, and each accepted draft token saves a sequential evaluation of the main model.
+        - The draft keeps its own KV cache, so each call only evaluates the tokens added since the last one.
+        - A proposal is accepted up to the first token the main model samples differently.
+    '''
+
+    def __init__(self, model_path:str=None, num_pred_tokens:int=8, name:str=None, **params):
+        from llama_cpp import Llama
+
+        self.name = name
+        self.model_path = model_path
+        self.num_pred_tokens = num_pred_tokens
+        self.llm = Llama(model_path, verbose=False, **params)
+        self.size_bytes = os.path.getsize(model_path)
+        self.proposed = 0
+        self.accepted = 0
+        self._last_input = None
+        self._last_draft = None
+        self._lock = threading.Lock()
+
+    def _count_accepted(self, input_ids=None):
+        # The tokens added since the last call are the accepted part of the last draft and one token of the main model
+        last_input, last_draft = self._last_input, self._last_draft
+        if last_input is None or not len(last_draft):
+            return
+        n = len(last_input)
+        if len(input_ids) <= n or input_ids[n - 1] != last_input[-1]:
+            # A new generation: the last draft of the previous one was never checked
+            return
+        accepted = 0
+        for proposed, actual in zip(last_draft, input_ids[n:]):
+            if proposed != actual:
+                break
+            accepted += 1
+        self.proposed += len(last_draft)
+        self.accepted += accepted
+        DRAFT_TOKENS.inc(accepted, model=self.name, result='accepted')
+        DRAFT_TOKENS.inc(len(last_draft) - accepted, model=self.name, result='rejected')
+
+    def __call__(self, input_ids=None, **kwargs):
+        import numpy as np
+
+        with self._lock:
+            self._count_accepted(input_ids)
+
+            draft = []
+            eos = self.llm.token_eos()
+            for token in self.llm.generate(input_ids.tolist(), temp=0.0, top_k=1):
+                if token == eos:
+                    break
+                draft.append(token)
+                if len(draft) >= self.num_pred_tokens:
+                    break
+
+            self._last_input = input_ids.copy()
+            self._last_draft = draft
+            return np.array(draft, dtype=np.intc)
+
+    def stats(self):
+        return {
+            "draft_model": os.path.basename(self.model_path),
+            "num_pred_tokens": self.num_pred_tokens,
+            "proposed": self.proposed,
+            "accepted": self.accepted,
+            "acceptance_rate": self.accepted / self.proposed if self.proposed else 0.0
+        }
+
+def load_draft_model(name:str=None, model_config:dict=None, settings:dict=None):
+    '''
+    Method to load the draft model of a model config, None if it has no draft model or speculative decoding is not
+    available in the installed llama-cpp-python. Where:
+        - name: name of the model config
+        - settings: resolved performance settings of the main model (threads and batch are shared with the draft)
+    '''
+    draft = draft_settings(model_config)
+    if draft is None:
+        return None
+
+    try:
+        from llama_cpp import Llama
+    except ImportError as e:
+        logger.warning('Speculative decoding not available: %s', e)
+        return None
+    if 'draft_model' not in inspect.signature(Llama.__init__).parameters:
+        logger.warning('Speculative decoding not available in this llama-cpp-python version, %s runs without draft model', name)
+        return None
+
+    logger.info('Loading draft model %s for %s', draft["model"], name)
+    return DraftModel(
+        model_path=os.path.join(MODELS_DIR, draft["model"]),
+        num_pred_tokens=draft["num_pred_tokens"],
+        name=name,
+        n_ctx=model_config['n_ctx'],
+        n_threads=settings["n_threads"],
+        n_batch=settings["n_batch"],
+        use_mmap=settings["use_mmap"],
+        use_mlock=settings["use_mlock"],
+        n_gpu_layers=settings["n_gpu_layers"]
+    )
+
+def check_draft_model(llm=None):
+    '''
+    Method to turn off the draft model of a loaded model if its vocabulary does not match the main model.
+    '''
+    client = getattr(llm, 'client', None)
+    draft = getattr(client, 'draft_model', None)
+    if not isinstance(draft, DraftModel):
+        return
+    if draft.llm.n_vocab() != client.n_vocab():
+        logger.warning(
+            'Draft model %s has a different vocabulary (%s tokens) than the main model (%s tokens), it is not used',
+            draft.model_path, draft.llm.n_vocab(), client.n_vocab()
+        )
+        client.draft_model = None
+
+def speculative_stats(llm=None):
+    '''
+    Method to get the acceptance rate of the draft model of a loaded model, None if it has no draft model.
+    '''
+    draft = getattr(getattr(llm, 'client', None), 'draft_model', None)
+    return draft.stats() if isinstance(draft, DraftModel) else None
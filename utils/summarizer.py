@@ -0,0 +1,138 @@
+import time
+import threading
+from langchain.schema.messages import get_buffer_string, HumanMessage, AIMessage
+from utils.logger import get_logger
+from utils.config import Config
+from utils.scheduler import scheduler, SchedulerError
+from utils.model_manager import model_manager
+from utils.memory_cache import memory_cache
+from utils.session_store import get_session_store
+
+logger = get_logger('summarizer')
+
+# Request priorities go from 0 to 9, so summaries only run when no request is waiting
+SUMMARY_PRIORITY = 10
+
+class SessionSummarizer:
+    '''
+    Folds the old turns of a session into a running summary, in the background.
+        - After a turn is saved, schedule queues a summary of the session if at least Config.SUMMARY_MIN_MESSAGES messages
+          older than the last Config.SUMMARY_KEEP_MESSAGES are not in its summary yet.
+        - The summary runs on the inference worker with the lowest priority, so it never delays a queued request.
+        - Then the session is dropped from the memory cache, and its next request loads the summary plus the recent turns.
+    '''
+
+    def __init__(self):
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.failures = 0
+        self.folded_messages = 0
+        self.total_time = 0.0
+
+    def _due(self, store=None, session_id:int=None):
+        # Returns (summary, summarized, total) if the session has enough messages to fold, None otherwise
+        summary, summarized = store.get_summary(session_id=session_id)
+        total = store.count_messages(session_id=session_id)
+        if total - Config.SUMMARY_KEEP_MESSAGES - summarized < Config.SUMMARY_MIN_MESSAGES:
+            return None
+        return summary, summarized, total
+
+    def schedule(self, session_id:int=None):
+        '''
+        Method to queue the summary of a session if it is due. Does nothing if Config.SUMMARY is off.
+        '''
+        if not Config.SUMMARY or session_id is None:
+            return
+        if self._due(store=get_session_store(), session_id=session_id) is None:
+            return
+
+        with self._lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+
+        try:
+            model = model_manager.get()
+            future = scheduler.submit(
+                lambda: self.summarize(session_id, model=model),
+                client='summarizer',
+                priority=SUMMARY_PRIORITY,
+                model=model,
+                session=session_id
+                )
+        except SchedulerError:
+            # The queue is full: it will be tried again after the next turn
+            with self._lock:
+                self._pending.discard(session_id)
+            return
+        except Exception as e:
+            with self._lock:
+                self._pending.discard(session_id)
+            self.failures += 1
+            logger.error('Error summarizing session %s: %s', session_id, e)
+            return
+
+        def finished(future):
+            with self._lock:
+                self._pending.discard(session_id)
+            if not future.cancelled() and future.exception() is not None:
+                self.failures += 1
+                logger.error('Error summarizing session %s: %s', session_id, future.exception())
+
+        future.add_done_callback(finished)
+
+    def summarize(self, session_id:int=None, model=None):
+        '''
+        Method to fold the pending old messages of a session into its summary, with the selected model (or model).
+        '''
+        store = get_session_store()
+        due = self._due(store=store, session_id=session_id)
+        if due is None:
+            return
+        summary, summarized, total = due
+
+        start_time = time.time()
+        model = model or model_manager.get()
+
+        messages = store.load_range(
+            session_id=session_id,
+            start=summarized,
+            count=total - Config.SUMMARY_KEEP_MESSAGES - summarized
+        )
+
+        # Fold only what fits in the context with the prompt and the current summary
+        budget = model.history_budget(Config.SUMMARY_PROMPT.format(summary=summary or "", new_lines=""))
+        folded = []
+        for role, content in messages:
+            message = HumanMessage(content=content) if role == 'Human' else AIMessage(content=content)
+            tokens = model.count_tokens(get_buffer_string([message])) + 1
+            if folded and tokens > budget:
+                break
+            budget -= tokens
+            folded.append(message)
+
+        prompt = Config.SUMMARY_PROMPT.format(summary=summary or "", new_lines=get_buffer_string(folded))
+        with model.slot() as slot:
+            new_summary = slot.llm.predict(prompt, max_tokens=Config.SUMMARY_MAX_TOKENS, echo=False).strip()
+
+        store.set_summary(session_id=session_id, summary=new_summary, summarized=summarized + len(folded))
+        memory_cache.invalidate(session_id)
+
+        elapsed = time.time() - start_time
+        self.runs += 1
+        self.folded_messages += len(folded)
+        self.total_time += elapsed
+        logger.info('Session %s summarized', session_id, extra={"folded_messages": len(folded), "duration": round(elapsed, 3)})
+
+    def stats(self):
+        return {
+            "enabled": Config.SUMMARY,
+            "pending": len(self._pending),
+            "runs": self.runs,
+            "failures": self.failures,
+            "folded_messages": self.folded_messages,
+            "avg_time": self.total_time / self.runs if self.runs else 0.0
+        }
+
+summarizer = SessionSummarizer()
@@ -1,11 +1,24 @@
-from flask import Flask
+from flask import Flask, request
 from flask_restx import Api
 from services.answer_services import answer
 from services.auth_services import Auth
 from services.model_services import LLMmodels
+from services.metrics_services import metrics
+from services.profiling_services import profiling
+from utils.metrics import start_request, current_request, REQUEST_SECONDS
+from utils.profiler import profiler, current_session
+from auth.authentication import key_store
+from utils.logger import setup_logging, set_request_id, get_request_id, get_logger
+import re
+import time
+import uuid
+
+logger = get_logger('http')
 
 def create_app(config):
 
+    setup_logging()
+
     # Initialize flask app
     app = Flask(__name__)
     app.config.from_object(config)
@@ -15,5 +28,49 @@ def create_app(config):
     api.add_namespace(answer)
     api.add_namespace(Auth)
     api.add_namespace(LLMmodels)
+    api.add_namespace(metrics)
+    api.add_namespace(profiling)
+
+    @app.before_request
+    def start_timings():
+        start_request()
+        # Correlation id of the request: the one sent by the client (or a proxy) in X-Request-ID, or a new one
+        request_id = request.headers.get("X-Request-ID", "")
+        if not re.fullmatch(r'[\w.:-]{1,64}', request_id):
+            request_id = uuid.uuid4().hex[:16]
+        set_request_id(request_id)
+        # Only checked while profiling is armed (or the X-Profile header is allowed)
+        if profiler.active:
+            profiler.start(
+                method=request.method,
+                path=request.path,
+                header=request.headers.get("X-Profile"),
+                is_master=lambda: key_store.is_master(request.headers.get("Authorization"))
+                )
+
+    @app.after_request
+    def add_timings(response):
+        # Streamed responses only report the stages done before their first byte
+        timings = current_request()
+        if timings is not None:
+            duration = time.perf_counter() - timings.start
+            REQUEST_SECONDS.observe(
+                duration,
+                method=request.method,
+                endpoint=request.url_rule.rule if request.url_rule else 'unmatched',
+                status=response.status_code
+                )
+            response.headers["Server-Timing"] = timings.server_timing()
+            logger.info(
+                '%s %s %s', request.method, request.path, response.status_code,
+                extra={"duration_ms": round(duration * 1000, 2)}
+                )
+        response.headers["X-Request-ID"] = get_request_id()
+        session = current_session()
+        if session is not None:
+            profiler.finish_request(session)
+            # The profile is saved once the response is sent (streams included) and its jobs are done
+            response.call_on_close(session.release)
+        return response
 
-    return app
\ No newline at end of file
+    return app
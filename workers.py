@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import asyncio
+import itertools
+import threading
+import multiprocessing
+import uvicorn
+from utils.logger import get_logger, setup_logging
+from utils.config import Config
+from utils.load_model import physical_cores
+from utils.session_store import get_session_store
+
+logger = get_logger('workers')
+
+HOP_BY_HOP = {b'connection', b'keep-alive', b'transfer-encoding', b'upgrade', b'proxy-connection', b'te', b'trailer'}
+
+def run_worker(port:int=None):
+    '''
+    Method to run one worker process: the ASGI app (asgi.py) on a local port.
+    '''
+    # Job IDs start with the port, so the dispatcher sends the polls of a job to the worker that runs it
+    os.environ['WORKER_PORT'] = str(port)
+    uvicorn.run('asgi:app', host='127.0.0.1', port=port, workers=1, log_level=Config.ASGI_LOG_LEVEL)
+
+class Supervisor:
+    '''
+    Starts the worker processes and restarts the ones that exit.
+        - Workers are spawned (not forked), each one loads the model with use_mmap, so the weights are shared by all of them
+          through the OS page cache instead of being copied in every process.
+        - The CPU threads of llama.cpp are split between the workers, unless LLAMA_N_THREADS is set.
+    '''
+
+    def __init__(self, workers:int=None, base_port:int=None):
+        self.workers = workers or Config.WORKERS
+        self.base_port = base_port or Config.WORKER_BASE_PORT
+        self.ports = [self.base_port + i for i in range(self.workers)]
+        self.processes = {}
+        self.restarts = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._stopping = threading.Event()
+
+    def _spawn(self, port:int=None):
+        process = self._context.Process(target=run_worker, args=(port,), name=f'llm-worker-{port}', daemon=True)
+        process.start()
+        self.processes[port] = process
+        logger.info('Worker %s listening on 127.0.0.1:%s', process.pid, port)
+
+    def start(self):
+        os.environ['LLAMA_USE_MMAP'] = 'true'
+        if not os.getenv('LLAMA_N_THREADS'):
+            os.environ['LLAMA_N_THREADS'] = str(max(1, physical_cores() // self.workers))
+
+        for port in self.ports:
+            self._spawn(port)
+
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _watch(self):
+        while not self._stopping.wait(1):
+            for port, process in list(self.processes.items()):
+                if not process.is_alive() and not self._stopping.is_set():
+                    logger.error('Worker on port %s exited with code %s, restarting', port, process.exitcode)
+                    self.restarts += 1
+                    self._spawn(port)
+
+    def stop(self):
+        self._stopping.set()
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=10)
+
+class Dispatcher:
+    '''
+    Front-end ASGI app that forwards every request to a worker.
+        - Requests with an integer session_id in their JSON body always go to the same worker (session_id % workers),
+          so the memory cache and the llama.cpp state of a session stay in one process.
+        - Requests of a job (/answer/jobs/<job_id>) go to the worker in the prefix of the job ID.
+        - Other requests are spread round-robin.
+    '''
+
+    def __init__(self, ports:list=None):
+        self.ports = ports
+        self._next = itertools.cycle(ports)
+
+    def route(self, body:bytes=None, path:str=None):
+        '''
+        Method to get the port of the worker for a request.
+        '''
+        if path and path.startswith('/answer/jobs/'):
+            prefix = path[len('/answer/jobs/'):].split('-', 1)[0]
+            if prefix.isdigit() and int(prefix) in self.ports:
+                return int(prefix)
+
+        session_id = None
+        if body:
+            try:
+                data = json.loads(body)
+                if isinstance(data, dict):
+                    session_id = data.get("session_id")
+            except ValueError:
+                pass
+        if type(session_id) == int:
+            return self.ports[session_id % len(self.ports)]
+        return next(self._next)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        body = b''
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        port = self.route(body, scope['path'])
+        try:
+            await self.forward(port, scope, body, send)
+        except OSError as e:
+            logger.error('Worker on port %s unavailable: %s', port, e)
+            await send({'type': 'http.response.start', 'status': 502, 'headers': [(b'content-type', b'application/json')]})
+            await send({'type': 'http.response.body', 'body': b'{"message": "Worker unavailable"}'})
+
+    async def forward(self, port:int=None, scope:dict=None, body:bytes=None, send=None):
+        '''
+        Method to send a request to a worker and stream its response back.
+            - HTTP/1.0 with Connection: close, so the response body is not chunked and ends when the worker closes.
+        '''
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            target = scope.get('raw_path') or scope['path'].encode('utf-8')
+            if scope.get('query_string'):
+                target += b'?' + scope['query_string']
+            lines = [scope['method'].encode('latin-1') + b' ' + target + b' HTTP/1.0']
+            for name, value in scope.get('headers', []):
+                if name.lower() not in HOP_BY_HOP and name.lower() != b'content-length':
+                    lines.append(name + b': ' + value)
+            client = scope.get('client')
+            if client:
+                lines.append(b'x-forwarded-for: ' + client[0].encode('latin-1'))
+            lines.append(b'content-length: ' + str(len(body)).encode())
+            lines.append(b'connection: close')
+            writer.write(b'\r\n'.join(lines) + b'\r\n\r\n' + body)
+            await writer.drain()
+
+            status_line = await reader.readline()
+            status = int(status_line.split(b' ', 2)[1])
+            headers = []
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.rstrip(b'\r\n').partition(b':')
+                # date and server are set again by the front-end server
+                if name.strip().lower() not in HOP_BY_HOP | {b'date', b'server'}:
+                    headers.append((name.strip().lower(), value.strip()))
+
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            writer.close()
+
+if __name__ == '__main__':
+
+    setup_logging()
+
+    if Config.SESSION_BACKEND == 'json':
+        sys.exit('The json session backend can not be shared by several processes, use SESSION_BACKEND=sqlite')
+
+    # Migrate sessions.json once, before the workers open the store
+    get_session_store()
+
+    supervisor = Supervisor()
+    supervisor.start()
+
+    try:
+        uvicorn.run(
+            Dispatcher(supervisor.ports),
+            host=Config.HOST,
+            port=Config.PORT,
+            log_level=Config.ASGI_LOG_LEVEL
+            )
+    finally:
+        supervisor.stop()